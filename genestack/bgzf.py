@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reading and writing of BGZF files, the blocked gzip used by ``bgzip``, TABIX and BAM.
+
+BGZF file is a series of gzip members (blocks) with at most 64K of uncompressed data each,
+so it can be read by any gzip reader. Position in BGZF file is a virtual offset::
+
+    compressed offset of block << 16 | offset in uncompressed data of block
+
+and any position is reached by decompressing a single block.
+``.gzi`` index maps compressed offsets of blocks to offsets in uncompressed data
+(same format as written by ``bgzip --index``), it allows to seek by uncompressed offset.
+"""
+
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from genestack.genestack_exceptions import GenestackException
+
+BGZF_EXTENSION = '.bgz'
+GZI_EXTENSION = '.gzi'
+
+MAX_BLOCK_DATA_SIZE = 0xff00  # same as in bgzip, compressed block of such data always fits into 64K
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN, SI1, SI2, SLEN, BSIZE
+_HEADER_STRUCT = struct.Struct('<BBBBIBBHBBHH')
+_FIXED_HEADER_STRUCT = struct.Struct('<BBBBIBBH')
+_TRAILER_STRUCT = struct.Struct('<II')  # CRC32, ISIZE
+_SUBFIELD_STRUCT = struct.Struct('<ccH')  # SI1, SI2, SLEN
+_GZI_COUNT_STRUCT = struct.Struct('<Q')
+_GZI_ENTRY_STRUCT = struct.Struct('<QQ')
+
+_GZIP_MAGIC = '\x1f\x8b\x08'
+_FLAG_EXTRA = 4
+_BLOCK_HEADER_PREFIX = _HEADER_STRUCT.pack(0x1f, 0x8b, 8, _FLAG_EXTRA, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, 0)[:-2]
+# empty block that marks the end of file
+EOF_BLOCK = _BLOCK_HEADER_PREFIX + struct.pack('<H', 27) + '\x03\x00' + _TRAILER_STRUCT.pack(0, 0)
+
+
+def make_virtual_offset(block_offset, data_offset):
+    """
+    Return virtual offset.
+
+    :param block_offset: offset of block in compressed file
+    :type block_offset: int
+    :param data_offset: offset in uncompressed data of block, less than 64K
+    :type data_offset: int
+    :rtype: int
+    """
+    return (block_offset << 16) | data_offset
+
+
+def split_virtual_offset(virtual_offset):
+    """
+    Return tuple of block offset in compressed file and offset in uncompressed data of block.
+
+    :param virtual_offset: virtual offset
+    :type virtual_offset: int
+    :rtype: (int, int)
+    """
+    return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+def _compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER_STRUCT.size + len(deflated) + _TRAILER_STRUCT.size
+    return ''.join((_BLOCK_HEADER_PREFIX, struct.pack('<H', block_size - 1), deflated,
+                    _TRAILER_STRUCT.pack(zlib.crc32(data) & 0xffffffff, len(data))))
+
+
+def _read_block_size(handle, block_offset):
+    """
+    Read header of block and return total size of the block, or ``None`` at the end of file.
+    File position is moved after header.
+    """
+    header = handle.read(_FIXED_HEADER_STRUCT.size)
+    if not header:
+        return None
+    if len(header) < _FIXED_HEADER_STRUCT.size or not header.startswith(_GZIP_MAGIC):
+        raise GenestackException('Invalid BGZF block at offset %d' % block_offset)
+    flags, extra_size = _FIXED_HEADER_STRUCT.unpack(header)[3::4]
+    extra = handle.read(extra_size)
+    position = 0
+    if flags & _FLAG_EXTRA:
+        while position + _SUBFIELD_STRUCT.size <= len(extra):
+            si1, si2, length = _SUBFIELD_STRUCT.unpack_from(extra, position)
+            position += _SUBFIELD_STRUCT.size
+            if si1 == 'B' and si2 == 'C' and length == 2:
+                return struct.unpack_from('<H', extra, position)[0] + 1
+            position += length
+    raise GenestackException('Block at offset %d is not a BGZF block' % block_offset)
+
+
+def _read_block(handle, block_offset):
+    """
+    Read block that starts at the current position of the file.
+
+    :return: tuple of uncompressed data and offset of the next block, or ``None`` at the end of file
+    :rtype: (str, int)
+    """
+    block_size = _read_block_size(handle, block_offset)
+    if block_size is None:
+        return None
+    header_size = handle.tell() - block_offset
+    body = handle.read(block_size - header_size)
+    if len(body) != block_size - header_size:
+        raise GenestackException('BGZF block at offset %d is truncated' % block_offset)
+    data = zlib.decompress(body[:-_TRAILER_STRUCT.size], -zlib.MAX_WBITS)
+    crc, size = _TRAILER_STRUCT.unpack(body[-_TRAILER_STRUCT.size:])
+    if size != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise GenestackException('BGZF block at offset %d is corrupted' % block_offset)
+    return data, block_offset + block_size
+
+
+def read_gzi(path):
+    """
+    Read ``.gzi`` index.
+
+    :param path: path to index
+    :type path: str
+    :return: list of tuples (compressed offset, uncompressed offset) of blocks, starting with ``(0, 0)``
+    :rtype: list[(int, int)]
+    """
+    with open(path, 'rb') as f:
+        count = _GZI_COUNT_STRUCT.unpack(f.read(_GZI_COUNT_STRUCT.size))[0]
+        data = f.read(count * _GZI_ENTRY_STRUCT.size)
+    if len(data) != count * _GZI_ENTRY_STRUCT.size:
+        raise GenestackException('Index file is truncated: %s' % path)
+    entries = [(0, 0)]
+    entries.extend(_GZI_ENTRY_STRUCT.unpack_from(data, x) for x in xrange(0, len(data), _GZI_ENTRY_STRUCT.size))
+    return entries
+
+
+def write_gzi(path, entries):
+    """
+    Write ``.gzi`` index.
+
+    :param path: path to index
+    :type path: str
+    :param entries: list of tuples (compressed offset, uncompressed offset) of blocks,
+                    the first block ``(0, 0)`` is not written if present
+    :type entries: list[(int, int)]
+    :return: None
+    """
+    if entries and entries[0] == (0, 0):
+        entries = entries[1:]
+    with open(path, 'wb') as f:
+        f.write(_GZI_COUNT_STRUCT.pack(len(entries)))
+        for entry in entries:
+            f.write(_GZI_ENTRY_STRUCT.pack(*entry))
+
+
+def scan_blocks(path):
+    """
+    Build the same block index as stored in ``.gzi`` file by reading headers and sizes of blocks,
+    data is not decompressed.
+
+    :param path: path to BGZF file
+    :type path: str
+    :return: list of tuples (compressed offset, uncompressed offset) of blocks, starting with ``(0, 0)``
+    :rtype: list[(int, int)]
+    """
+    entries = [(0, 0)]
+    block_offset = 0
+    data_offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            block_size = _read_block_size(f, block_offset)
+            if block_size is None:
+                break
+            f.seek(block_offset + block_size - 4)
+            size_data = f.read(4)
+            if len(size_data) != 4:
+                raise GenestackException('BGZF block at offset %d is truncated' % block_offset)
+            block_offset += block_size
+            data_offset += struct.unpack('<I', size_data)[0]
+            entries.append((block_offset, data_offset))
+    return entries
+
+
+class BgzfReader(object):
+    """
+    Reader of BGZF file, that supports seeking by virtual offsets.
+
+    :py:meth:`tell` returns virtual offset of the current position that can be passed to :py:meth:`seek`,
+    :py:meth:`seek_uncompressed` moves to offset in uncompressed data using ``.gzi`` index.
+    """
+
+    def __init__(self, path, mode='rb'):
+        """
+        :param path: path to BGZF file
+        :type path: str
+        :param mode: ``'r'`` or ``'rb'``, file is always read in binary mode
+        :type mode: str
+        """
+        if mode not in ('r', 'rb'):
+            raise GenestackException('Invalid mode for BGZF reader: %s' % repr(mode))
+        self.name = path
+        self.__handle = open(path, 'rb')
+        self.__block_index = None
+        self.__index_data_offsets = None
+        self.__block_offset = 0
+        self.__data = ''
+        self.__data_offset = 0
+        self.__next_block_offset = 0
+        self.__load_block(0)
+
+    def __load_block(self, block_offset):
+        if block_offset != self.__next_block_offset:
+            self.__handle.seek(block_offset)
+        block = _read_block(self.__handle, block_offset)
+        self.__block_offset = block_offset
+        self.__data_offset = 0
+        if block is None:
+            self.__data = ''
+            self.__next_block_offset = None
+            self.__handle.seek(block_offset)
+        else:
+            self.__data, self.__next_block_offset = block
+
+    def __next_block(self):
+        """
+        Load the next block, return ``False`` at the end of file.
+        """
+        if self.__next_block_offset is None:
+            return False
+        self.__load_block(self.__next_block_offset)
+        return True
+
+    def read(self, size=-1):
+        """
+        Read at most ``size`` bytes, read until the end of file if ``size`` is negative.
+        """
+        chunks = []
+        while size:
+            if self.__data_offset >= len(self.__data):
+                if not self.__next_block():
+                    break
+                continue
+            end = len(self.__data) if size < 0 else min(len(self.__data), self.__data_offset + size)
+            chunks.append(self.__data[self.__data_offset:end])
+            if size > 0:
+                size -= end - self.__data_offset
+            self.__data_offset = end
+        return ''.join(chunks)
+
+    def readline(self):
+        """
+        Read line including line break, return empty string at the end of file.
+        """
+        chunks = []
+        while True:
+            if self.__data_offset >= len(self.__data):
+                if not self.__next_block():
+                    break
+                continue
+            end = self.__data.find('\n', self.__data_offset) + 1
+            if end:
+                line = self.__data[self.__data_offset:end]
+                self.__data_offset = end
+                if not chunks:
+                    return line
+                chunks.append(line)
+                break
+            chunks.append(self.__data[self.__data_offset:])
+            self.__data_offset = len(self.__data)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        """
+        Return virtual offset of the current position.
+
+        :rtype: int
+        """
+        return make_virtual_offset(self.__block_offset, self.__data_offset)
+
+    def seek(self, virtual_offset):
+        """
+        Move to virtual offset returned by :py:meth:`tell` or found in TABIX index.
+
+        :param virtual_offset: virtual offset
+        :type virtual_offset: int
+        :return: None
+        """
+        block_offset, data_offset = split_virtual_offset(virtual_offset)
+        if block_offset != self.__block_offset:
+            self.__load_block(block_offset)
+        if data_offset > len(self.__data):
+            raise GenestackException('Invalid virtual offset %d, block has only %d bytes' % (
+                virtual_offset, len(self.__data)))
+        self.__data_offset = data_offset
+
+    def get_block_index(self):
+        """
+        Return block index from ``.gzi`` file if it exists, otherwise it is built from block headers.
+
+        :return: list of tuples (compressed offset, uncompressed offset) of blocks, starting with ``(0, 0)``
+        :rtype: list[(int, int)]
+        """
+        if self.__block_index is None:
+            index_path = self.name + GZI_EXTENSION
+            if os.path.exists(index_path):
+                self.__block_index = read_gzi(index_path)
+            else:
+                self.__block_index = scan_blocks(self.name)
+        return self.__block_index
+
+    def seek_uncompressed(self, offset):
+        """
+        Move to offset in uncompressed data, same as ``seek`` of decompressed file.
+
+        :param offset: offset in uncompressed data
+        :type offset: int
+        :return: None
+        """
+        index = self.get_block_index()
+        if self.__index_data_offsets is None:
+            self.__index_data_offsets = [x[1] for x in index]
+        block_offset, data_offset = index[max(bisect_right(self.__index_data_offsets, offset) - 1, 0)]
+        self.__load_block(block_offset)
+        data_offset = offset - data_offset
+        # skip empty blocks
+        while data_offset > len(self.__data) and self.__next_block_offset is not None:
+            data_offset -= len(self.__data)
+            self.__load_block(self.__next_block_offset)
+        self.__data_offset = min(data_offset, len(self.__data))
+
+    def close(self):
+        self.__handle.close()
+
+    @property
+    def closed(self):
+        return self.__handle.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BgzfWriter(object):
+    """
+    Writer of BGZF file. Blocks are compressed by a thread pool if ``threads`` is greater than one,
+    ``zlib`` releases GIL while compressing, so blocks are compressed in parallel.
+
+    :py:meth:`tell` returns virtual offset of the current position,
+    it waits until all complete blocks are written.
+    """
+
+    def __init__(self, path, mode='wb', level=DEFAULT_COMPRESSION_LEVEL, threads=1, write_index=False):
+        """
+        :param path: path to BGZF file
+        :type path: str
+        :param mode: ``'w'`` or ``'wb'``, file is always written in binary mode
+        :type mode: str
+        :param level: compression level from 1 to 9
+        :type level: int
+        :param threads: number of compression threads
+        :type threads: int
+        :param write_index: write ``.gzi`` index next to the file on close
+        :type write_index: bool
+        """
+        if mode not in ('w', 'wb'):
+            raise GenestackException('Invalid mode for BGZF writer: %s' % repr(mode))
+        self.name = path
+        self.level = level
+        self.threads = threads
+        self.__handle = open(path, 'wb')
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__block_offset = 0
+        self.__data_offset = 0
+        self.__block_index = [(0, 0)] if write_index else None
+        self.__pool = ThreadPool(threads) if threads > 1 else None
+        self.__pending = deque()
+
+    def __write_block(self, compressed, size):
+        self.__handle.write(compressed)
+        self.__block_offset += len(compressed)
+        self.__data_offset += size
+        if self.__block_index is not None:
+            self.__block_index.append((self.__block_offset, self.__data_offset))
+
+    def __add_block(self, data):
+        if self.__pool is None:
+            self.__write_block(_compress_block(data, self.level), len(data))
+            return
+        if len(self.__pending) >= 2 * self.threads:
+            self.__write_pending_block()
+        self.__pending.append((self.__pool.apply_async(_compress_block, (data, self.level)), len(data)))
+
+    def __write_pending_block(self):
+        result, size = self.__pending.popleft()
+        self.__write_block(result.get(), size)
+
+    def __write_pending_blocks(self):
+        while self.__pending:
+            self.__write_pending_block()
+
+    def write(self, data):
+        if not data:
+            return
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+        if self.__buffer_size < MAX_BLOCK_DATA_SIZE:
+            return
+        data = ''.join(self.__buffer)
+        end = len(data) - len(data) % MAX_BLOCK_DATA_SIZE
+        for start in xrange(0, end, MAX_BLOCK_DATA_SIZE):
+            self.__add_block(data[start:start + MAX_BLOCK_DATA_SIZE])
+        self.__buffer = [data[end:]] if end < len(data) else []
+        self.__buffer_size = len(data) - end
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """
+        Write buffered data as a block, so the current position is the start of a new block.
+        """
+        if self.__buffer:
+            self.__add_block(''.join(self.__buffer))
+            self.__buffer = []
+            self.__buffer_size = 0
+        self.__write_pending_blocks()
+        self.__handle.flush()
+
+    def tell(self):
+        """
+        Return virtual offset of the current position.
+
+        :rtype: int
+        """
+        self.__write_pending_blocks()
+        return make_virtual_offset(self.__block_offset, self.__buffer_size)
+
+    def close(self):
+        """
+        Write remaining data, end-of-file marker and ``.gzi`` index if it is requested.
+        """
+        if self.__handle.closed:
+            return
+        try:
+            self.flush()
+            self.__handle.write(EOF_BLOCK)
+        finally:
+            self.__handle.close()
+            if self.__pool is not None:
+                self.__pool.terminate()
+                self.__pool.join()
+        if self.__block_index is not None:
+            write_gzi(self.name + GZI_EXTENSION, self.__block_index)
+
+    @property
+    def closed(self):
+        return self.__handle.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
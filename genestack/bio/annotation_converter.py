@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming conversion between GFF3 and GTF annotation formats.
+
+Output has the same layout as output of ``gffread`` from Cufflinks, that is used as a fallback:
+  - GTF: ``exon`` lines and then ``CDS`` lines of every transcript,
+    with ``transcript_id``, ``gene_id`` and ``gene_name`` (if it is known) attributes
+  - GFF3: ``mRNA`` line of every transcript with ``ID``, ``geneID`` and ``gene_name`` attributes,
+    followed by its ``exon`` and ``CDS`` lines with ``Parent`` attribute
+
+Transcripts of each contig are written in order of their starts.
+If transcript does not have exons, they are made from its CDS and UTR parts.
+Ensembl ``gene:`` and ``transcript:`` prefixes are removed from identifiers.
+
+Source file can be compressed, lines are grouped by contig and only features of the current contig
+are kept in memory, so lines of each contig should go one after another.
+"""
+
+from genestack.bio.reference_genome.annotation_parser import parse_attributes, read_contig_lines
+from genestack.genestack_exceptions import GenestackException
+
+_ID_PREFIXES = ('gene:', 'transcript:')
+
+_GFF3_ESCAPED_CHARACTERS = {x: '%%%02X' % ord(x) for x in '\t\n\r%;=&,'}
+
+
+class UnsupportedAnnotationLayoutException(GenestackException):
+    """
+    Raised if lines of the file are valid, but their layout is not supported by the streaming conversion,
+    such file can be converted by ``gffread``.
+    """
+    pass
+
+
+def _strip_id_prefix(value):
+    for prefix in _ID_PREFIXES:
+        if value.startswith(prefix):
+            return value[len(prefix):]
+    return value
+
+
+def _escape_gff3_value(value):
+    if any(x in value for x in _GFF3_ESCAPED_CHARACTERS):
+        return ''.join(_GFF3_ESCAPED_CHARACTERS.get(x, x) for x in value)
+    return value
+
+
+def _merge_segments(segments):
+    """
+    Merge overlapping and adjacent segments.
+
+    :param segments: list of (start, end), 1-based, inclusive
+    :type segments: list[(int, int)]
+    :rtype: list[(int, int)]
+    """
+    merged = []
+    for start, end in sorted(segments):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = merged[-1][0], end
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class _Transcript(object):
+    __slots__ = ('id', 'gene_id', 'gene_name', 'source', 'strand', 'start', 'end', 'exons', 'cds', 'utrs')
+
+    def __init__(self, transcript_id):
+        self.id = transcript_id
+        self.gene_id = None
+        self.gene_name = None
+        self.source = None
+        self.strand = None
+        self.start = None
+        self.end = None
+        self.exons = []  # (start, end)
+        self.cds = []  # (start, end, phase)
+        self.utrs = []  # (start, end)
+
+    def add_segment(self, kind, source, start, end, strand, phase):
+        if self.source is None:
+            self.source = source
+            self.strand = strand
+        if kind == 'exon':
+            self.exons.append((start, end))
+        elif kind == 'CDS':
+            self.cds.append((start, end, phase))
+        else:
+            self.utrs.append((start, end))
+
+    def finish(self):
+        """
+        Sort segments, make exons if they are absent and compute transcript bounds.
+        """
+        if self.exons:
+            self.exons.sort()
+        else:
+            self.exons = _merge_segments(self.utrs + [(start, end) for start, end, _ in self.cds])
+        self.cds.sort()
+        self.start = min(start for start, _ in self.exons)
+        self.end = max(end for _, end in self.exons)
+        if self.gene_id is None:
+            self.gene_id = self.id
+
+
+def _get_segment_kind(feature_type):
+    if feature_type == 'exon' or feature_type == 'CDS':
+        return feature_type
+    if 'UTR' in feature_type:
+        return 'UTR'
+    return None
+
+
+def _split_line(line):
+    parts = line.split('\t')
+    if len(parts) < 9:
+        raise GenestackException('Annotation line should have 9 columns: %s' % line)
+    try:
+        start = int(parts[3])
+        end = int(parts[4])
+    except ValueError:
+        raise GenestackException('Invalid location in annotation line: %s' % line)
+    attributes, _ = parse_attributes(parts[8]) if parts[8] not in ('', '.') else ({}, False)
+    return parts, start, end, attributes
+
+
+def _read_gff3_transcripts(lines):
+    transcripts = {}
+    features = {}  # ID -> (source, strand, attributes) of the first line with this ID
+    for line in lines:
+        parts, start, end, attributes = _split_line(line)
+        feature_id = attributes.get('ID')
+        if feature_id:
+            features.setdefault(_strip_id_prefix(feature_id[0]), (parts[1], parts[6], attributes))
+        kind = _get_segment_kind(parts[2])
+        if kind is None:
+            continue
+        for parent_id in attributes.get('Parent', ()):
+            parent_id = _strip_id_prefix(parent_id)
+            transcript = transcripts.get(parent_id)
+            if transcript is None:
+                transcript = transcripts[parent_id] = _Transcript(parent_id)
+            transcript.add_segment(kind, parts[1], start, end, parts[6], parts[7])
+
+    for transcript in transcripts.itervalues():
+        feature = features.get(transcript.id)
+        if feature is None:
+            continue
+        source, strand, attributes = feature
+        transcript.source = source
+        transcript.strand = strand
+        gene_id = attributes.get('Parent', [None])[0]
+        if gene_id is not None:
+            transcript.gene_id = _strip_id_prefix(gene_id)
+        gene_name = attributes.get('gene_name')
+        if gene_name:
+            transcript.gene_name = gene_name[0]
+        elif transcript.gene_id in features:
+            transcript.gene_name = features[transcript.gene_id][2].get('Name', [None])[0]
+    return transcripts.values()
+
+
+def _read_gtf_transcripts(lines):
+    transcripts = {}
+    for line in lines:
+        parts, start, end, attributes = _split_line(line)
+        kind = _get_segment_kind(parts[2])
+        transcript_id = attributes.get('transcript_id')
+        if kind is None or not transcript_id:
+            continue
+        transcript = transcripts.get(transcript_id[0])
+        if transcript is None:
+            transcript = transcripts[transcript_id[0]] = _Transcript(transcript_id[0])
+            transcript.gene_id = attributes.get('gene_id', [None])[0]
+            transcript.gene_name = attributes.get('gene_name', [None])[0]
+        transcript.add_segment(kind, parts[1], start, end, parts[6], parts[7])
+    return transcripts.values()
+
+
+def _write_gtf_transcript(f, contig, transcript):
+    attributes = 'transcript_id "%s"; gene_id "%s";' % (transcript.id, transcript.gene_id)
+    if transcript.gene_name:
+        attributes += ' gene_name "%s";' % transcript.gene_name
+    prefix = '%s\t%s\t' % (contig, transcript.source)
+    for start, end in transcript.exons:
+        f.write('%sexon\t%d\t%d\t.\t%s\t.\t%s\n' % (prefix, start, end, transcript.strand, attributes))
+    for start, end, phase in transcript.cds:
+        f.write('%sCDS\t%d\t%d\t.\t%s\t%s\t%s\n' % (prefix, start, end, transcript.strand, phase, attributes))
+
+
+def _write_gff3_transcript(f, contig, transcript):
+    transcript_id = _escape_gff3_value(transcript.id)
+    attributes = 'ID=%s;geneID=%s' % (transcript_id, _escape_gff3_value(transcript.gene_id))
+    if transcript.gene_name:
+        attributes += ';gene_name=%s' % _escape_gff3_value(transcript.gene_name)
+    prefix = '%s\t%s\t' % (contig, transcript.source)
+    f.write('%smRNA\t%d\t%d\t.\t%s\t.\t%s\n' % (prefix, transcript.start, transcript.end,
+                                                transcript.strand, attributes))
+    for start, end in transcript.exons:
+        f.write('%sexon\t%d\t%d\t.\t%s\t.\tParent=%s\n' % (prefix, start, end, transcript.strand, transcript_id))
+    for start, end, phase in transcript.cds:
+        f.write('%sCDS\t%d\t%d\t.\t%s\t%s\tParent=%s\n' % (prefix, start, end, transcript.strand, phase,
+                                                          transcript_id))
+
+
+def _convert(source_path, output_path, read_transcripts, write_transcript, header=None):
+    written_ids = set()
+    with open(output_path, 'w') as f:
+        if header:
+            f.write(header)
+        for contig, lines in read_contig_lines(source_path):
+            transcripts = read_transcripts(lines)
+            for transcript in transcripts:
+                if transcript.id in written_ids:
+                    raise UnsupportedAnnotationLayoutException('Transcript "%s" is found on several contigs '
+                                                               'or its lines are not grouped by contig' %
+                                                               transcript.id)
+                transcript.finish()
+            transcripts.sort(key=lambda x: (x.start, x.end))
+            for transcript in transcripts:
+                written_ids.add(transcript.id)
+                write_transcript(f, contig, transcript)
+
+
+def convert_gff3_to_gtf_file(source_path, output_path):
+    """
+    Convert GFF3 file to GTF.
+
+    :param source_path: path to GFF3 file, can be compressed by gzip, bzip2 or zip
+    :type source_path: str
+    :param output_path: path to result GTF file
+    :type output_path: str
+    :return: None
+    """
+    _convert(source_path, output_path, _read_gff3_transcripts, _write_gtf_transcript)
+
+
+def convert_gtf_to_gff3_file(source_path, output_path):
+    """
+    Convert GTF file to GFF3.
+
+    :param source_path: path to GTF file, can be compressed by gzip, bzip2 or zip
+    :type source_path: str
+    :param output_path: path to result GFF3 file
+    :type output_path: str
+    :return: None
+    """
+    _convert(source_path, output_path, _read_gtf_transcripts, _write_gff3_transcript, header='##gff-version 3\n')
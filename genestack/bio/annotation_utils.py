@@ -4,10 +4,13 @@ import os
 from plumbum import local
 import re
 
+from genestack.bio.annotation_converter import (convert_gff3_to_gtf_file, convert_gtf_to_gff3_file,
+                                                UnsupportedAnnotationLayoutException)
 from genestack.cla import Toolset, RUN
-from genestack.compression import get_last_non_archive_extension, decompress_file
+from genestack.compression import get_last_non_archive_extension, decompress_file, ARCHIVE_EXTENSIONS
 from genestack.genestack_exceptions import GenestackException
-from genestack.utils import get_unique_name, makedirs_p
+from genestack.sniffing import read_head, sniff_format
+from genestack.utils import get_unique_name, makedirs_p, log_warning
 from shutil import move, copy
 
 
@@ -24,6 +27,8 @@ AVAILABLE_ANNOTATION_FORMATS = (GFF2, GFF3, GTF)
 def determine_annotation_file_format(annotation_path):
     """
     Return enum constant that represents annotation file format.
+    Format is chosen by extension, only the beginning of file is read for ``.gff`` files
+    and files with unknown extension.
 
     :param annotation_path: path to annotation file
     :type annotation_path: str
@@ -36,27 +41,22 @@ def determine_annotation_file_format(annotation_path):
     elif file_extension == '.gtf':
         return GTF
     elif file_extension == '.gff':
-        decompressed_file_path = decompress_file(annotation_path, remove_source=False)
-        try:
-            with open(decompressed_file_path) as f:
-                first_line = f.readline()
-            match_object = re.match('##gff-version\s+(\S+)', first_line)
-            if match_object:
-                version = match_object.group(1)
-                if version == '3':
-                    return GFF3
-                else:
-                    raise GenestackException(
-                        'Unsupported gff version %s in file %s' % (version, annotation_path)
-                    )
-            return GFF2
-        finally:
-            if os.path.abspath(decompressed_file_path) != os.path.abspath(annotation_path):
-                try:
-                    os.remove(decompressed_file_path)
-                except OSError:
-                    pass
+        first_line = read_head(annotation_path).split('\n', 1)[0]
+        match_object = re.match('##gff-version\s+(\S+)', first_line)
+        if match_object:
+            version = match_object.group(1)
+            if version == '3':
+                return GFF3
+            else:
+                raise GenestackException(
+                    'Unsupported gff version %s in file %s' % (version, annotation_path)
+                )
+        return GFF2
     else:
+        # extension is unknown, try to detect format by content
+        file_format = sniff_format(annotation_path)
+        if file_format in AVAILABLE_ANNOTATION_FORMATS:
+            return file_format
         raise GenestackException('Unknown annotation file format %s' % annotation_path)
 
 
@@ -119,19 +119,90 @@ def convert(file_path, annotation_fmt_from, annotation_fmt_to,
     return converter(file_path, working_dir, remove_source=remove_source)
 
 
-def convert_gff3_to_gtf(file_path, dest_folder=None, remove_source=True):
+def convert_gff3_to_gtf(file_path, dest_folder=None, remove_source=True, use_gffread=False):
     """
     Convert annotation file and return path to the created gtf-file.
 
+    File is converted in process, see :py:mod:`~genestack.bio.annotation_converter`.
+    ``gffread`` is used instead if ``use_gffread`` is ``True`` or if layout of the file
+    is not supported by the in-process conversion.
+
     :param file_path: path to the (possible compressed) annotation file
     :type file_path: str
     :param dest_folder: place to put file
     :type dest_folder: str
     :param remove_source: flag if source file should be removed. Default ``True``
     :type remove_source: bool
+    :param use_gffread: flag if ``gffread`` should be used for conversion. Default ``False``
+    :type use_gffread: bool
     :return: path to the created gtf-file (which is not compressed)
     :rtype: str
     """
+    if not use_gffread:
+        output_file_name = _convert_in_process(convert_gff3_to_gtf_file, file_path, dest_folder,
+                                               remove_source, '.gtf')
+        if output_file_name is not None:
+            return output_file_name
+    return _convert_gff3_to_gtf_with_gffread(file_path, dest_folder, remove_source)
+
+
+def convert_gtf_to_gff3(file_path, dest_folder=None, remove_source=True, use_gffread=False):
+    """
+    Convert gtf to gff3, return path to the created gff3-file.
+
+    File is converted in process, see :py:mod:`~genestack.bio.annotation_converter`.
+    ``gffread`` is used instead if ``use_gffread`` is ``True`` or if layout of the file
+    is not supported by the in-process conversion.
+
+    :param file_path: path to the (possible compressed) annotation file
+    :type file_path: str
+    :param dest_folder: place to put file
+    :type dest_folder: str
+    :param remove_source: flag if source file should be removed. Default ``True``
+    :type remove_source: bool
+    :param use_gffread: flag if ``gffread`` should be used for conversion. Default ``False``
+    :type use_gffread: bool
+    :return: path to the created gff3-file (which is not compressed)
+    :rtype: str
+    """
+    if not use_gffread:
+        output_file_name = _convert_in_process(convert_gtf_to_gff3_file, file_path, dest_folder,
+                                               remove_source, '.gff3')
+        if output_file_name is not None:
+            return output_file_name
+    return _convert_gtf_to_gff3_with_gffread(file_path, dest_folder, remove_source)
+
+
+def _convert_in_process(converter, file_path, dest_folder, remove_source, extension):
+    """
+    Convert file by converter from :py:mod:`~genestack.bio.annotation_converter`,
+    return path to the created file or ``None`` if layout of the file is not supported by the converter.
+    Other errors are raised.
+    """
+    dest_folder = dest_folder or os.curdir
+    makedirs_p(dest_folder)
+
+    base_file_name, ext = os.path.splitext(os.path.basename(file_path))
+    while ext in ARCHIVE_EXTENSIONS:
+        base_file_name, ext = os.path.splitext(base_file_name)
+    output_file_name = get_unique_name(os.path.join(dest_folder, base_file_name + extension))
+    try:
+        converter(file_path, output_file_name)
+    except UnsupportedAnnotationLayoutException as e:
+        log_warning('Cannot convert "%s" in process, gffread is used: %s' % (file_path, e))
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        return None
+    except:
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        raise
+    if remove_source:
+        os.remove(file_path)
+    return os.path.relpath(output_file_name)
+
+
+def _convert_gff3_to_gtf_with_gffread(file_path, dest_folder, remove_source):
     decompressed_file_name = decompress_file(file_path, dest_folder=dest_folder,
                                              remove_source=remove_source)
 
@@ -166,19 +237,7 @@ def convert_gff3_to_gtf(file_path, dest_folder=None, remove_source=True):
     return os.path.relpath(output_file_name)
 
 
-def convert_gtf_to_gff3(file_path, dest_folder=None, remove_source=True):
-    """
-    Convert gtf to gff3, return path to the created gff3-file.
-
-    :param file_path: path to the (possible compressed) annotation file
-    :type file_path: str
-    :param dest_folder: place to put file
-    :type dest_folder: str
-    :param remove_source: flag if source file should be removed. Default ``True``
-    :type remove_source: bool
-    :return: path to the created gff3-file (which is not compressed)
-    :rtype: str
-    """
+def _convert_gtf_to_gff3_with_gffread(file_path, dest_folder, remove_source):
     decompressed_file_name = decompress_file(file_path, dest_folder, remove_source=remove_source)
 
     dest_folder = dest_folder or os.curdir
@@ -196,7 +255,7 @@ def convert_gtf_to_gff3(file_path, dest_folder=None, remove_source=True):
     if remove_source:
         for path in (file_path, decompressed_file_name):
             if os.path.exists(path):
-                os.remove(file_path)
+                os.remove(path)
     return os.path.relpath(output_file_name)
 
 
@@ -19,15 +19,19 @@ class BED(File):
     # Deprecated in 0.44.0, will be removed in 0.47.0
     SOURCE_KEY = Metainfo.SOURCE_DATA
 
-    def put_with_index(self, path):
+    def put_with_index(self, path, binned_index=False, tabix=False):
         """
         PUT bed file to storage and create index for it.
 
         :param path: path to bed file
         :param path: str
+        :param binned_index: use hierarchical binning index format
+        :type binned_index: bool
+        :param tabix: also store BGZIP compressed and TABIX indexed copy of each track
+        :type tabix: bool
         :return: None
         """
-        indexer = BEDIndexer(self)
+        indexer = BEDIndexer(self, binned_index=binned_index, tabix=tabix)
         indexer.create_index(path)
 
     def get_bed(self, working_dir=None):
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from binning import reg2bins
+from genestack.bgzf import BgzfReader
+from genestack.genestack_exceptions import GenestackException
+from genestack.sniffing import is_bgzf
+
+# descriptions of numpy dtypes of big-endian packed records, same layout as written by BEDIndexer;
+# numpy is imported by the methods that use it to avoid crash then using pypy
+BLOCK_RECORD_DTYPE = [('start', '>i8'), ('end', '>i8'), ('offset', '>i8'), ('size', '>i4')]
+BINNED_RECORD_DTYPE = [('bin', '>u4'), ('start', '>i8'), ('end', '>i8'), ('offset', '>i8'), ('size', '>i4')]
+
+
+class BEDIndexReader(object):
+    """
+    Reader of the index cache folder created by :py:class:`~genestack.bio.BEDIndexer`.
+
+    Index files are memory-mapped as numpy structured arrays and searched with binary search,
+    so only the parts of index related to the requested region are read from disk.
+
+    Supports both index formats:
+      - version ``1``: fixed size blocks, ``>qqqi`` records (start, end, offset, size) sorted by start;
+        the first query of a contig scans all its data in data file once (see :py:meth:`find_chunks`)
+      - version ``2``: hierarchical binning, ``>Iqqqi`` records (bin, start, end, offset, size) sorted by bin
+    """
+
+    def __init__(self, index_folder, version='1', data_path=None):
+        """
+        :param index_folder: path to the index cache folder
+        :type index_folder: str
+        :param version: value of the ``BEDIndexer.INDEXING_VERSION_METAINFO_KEY`` of the BED file
+        :type version: str
+        :param data_path: path to the sorted BED file created by indexer, required for :py:meth:`fetch`;
+                          it can be compressed by ``bgzip``, then offsets of the index are found
+                          in uncompressed data by ``.gzi`` block index (or by block headers if it is absent)
+        :type data_path: str
+        """
+        if version not in ('1', '2'):
+            raise GenestackException('Unsupported BED index version: %s' % version)
+        self.index_folder = index_folder
+        self.version = version
+        self.data_path = data_path
+        self.__records = {}
+        self.__max_ends = {}
+        self.__data_file = None
+        self.__seek = None
+
+    def get_index_path(self, track_index, contig):
+        return os.path.join(self.index_folder, '%s.%s.index' % (track_index, contig))
+
+    def __get_records(self, track_index, contig):
+        import numpy as np
+        key = track_index, contig
+        records = self.__records.get(key)
+        if records is None:
+            dtype = BINNED_RECORD_DTYPE if self.version == '2' else BLOCK_RECORD_DTYPE
+            path = self.get_index_path(track_index, contig)
+            if not os.path.exists(path) or not os.path.getsize(path):
+                records = np.zeros(0, dtype=dtype)
+            else:
+                records = np.memmap(path, dtype=dtype, mode='r')
+            self.__records[key] = records
+        return records
+
+    def __get_data_file(self):
+        if self.data_path is None:
+            raise GenestackException('Path to BED data file is not specified')
+        if self.__data_file is None:
+            if is_bgzf(self.data_path):
+                self.__data_file = BgzfReader(self.data_path)
+                self.__seek = self.__data_file.seek_uncompressed
+            else:
+                self.__data_file = open(self.data_path, 'rb')
+                self.__seek = self.__data_file.seek
+        return self.__data_file
+
+    def __read_block(self, offset, size):
+        """
+        Return lines of the data file chunk and their (start, end) tuples.
+        """
+        data_file = self.__get_data_file()
+        self.__seek(offset)
+        for line in data_file.read(size).splitlines():
+            fields = line.split('\t', 3)
+            feature_start, feature_end = int(fields[1]), int(fields[2])
+            if feature_start > feature_end:
+                feature_start, feature_end = feature_end, feature_start
+            yield line, feature_start, feature_end
+
+    def __get_max_ends(self, track_index, contig):
+        """
+        Return array of the maximal feature end among all blocks up to each block of version 1 index.
+        End of a block in the index is the end of its last feature, other features of the block can end later,
+        so maximal ends are read from the data file.
+        The first call for a contig reads all its data once, results are cached until :py:meth:`close`.
+        Return ``None`` if data file is not specified.
+        """
+        import numpy as np
+        if self.data_path is None:
+            return None
+        key = track_index, contig
+        max_ends = self.__max_ends.get(key)
+        if max_ends is None:
+            records = self.__get_records(track_index, contig)
+            block_ends = np.array(records['end'], dtype=np.int64)
+            for index, (offset, size) in enumerate(zip(records['offset'].tolist(), records['size'].tolist())):
+                for _, _, feature_end in self.__read_block(offset, size):
+                    if feature_end > block_ends[index]:
+                        block_ends[index] = feature_end
+            max_ends = np.maximum.accumulate(block_ends)
+            self.__max_ends[key] = max_ends
+        return max_ends
+
+    def find_chunks(self, track_index, contig, start, end):
+        """
+        Return chunks of the BED data file that may contain features overlapping the region.
+        Adjacent chunks are merged.
+
+        For version ``1`` index blocks that end before the region are skipped only if data file is specified,
+        maximal ends of blocks are read from it at the first query of the contig.
+        This query scans all data of the contig once, so it costs as much as reading the contig,
+        next queries of the contig use cached ends and read only index records.
+
+        :param track_index: index of track in BED file, starting from 0
+        :type track_index: int
+        :param contig: normalized contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :return: sorted list of tuples (offset, size)
+        :rtype: list[(int, int)]
+        """
+        import numpy as np
+        records = self.__get_records(track_index, contig)
+        if self.version == '2':
+            bins = np.array(reg2bins(start, end))
+            lows = np.searchsorted(records['bin'], bins, side='left')
+            highs = np.searchsorted(records['bin'], bins, side='right')
+            parts = [records[low:high] for low, high in zip(lows, highs) if low < high]
+            if not parts:
+                return []
+            selected = np.concatenate(parts)
+            selected = selected[(selected['start'] < end) & (selected['end'] > start)]
+        else:
+            high = np.searchsorted(records['start'], end, side='left')
+            max_ends = self.__get_max_ends(track_index, contig)
+            low = np.searchsorted(max_ends, start, side='right') if max_ends is not None else 0
+            selected = records[low:high]
+
+        chunks = []
+        for offset, size in sorted(zip(selected['offset'].tolist(), selected['size'].tolist())):
+            if chunks and chunks[-1][0] + chunks[-1][1] == offset:
+                chunks[-1][1] += size
+            else:
+                chunks.append([offset, size])
+        return [tuple(x) for x in chunks]
+
+    def fetch(self, track_index, contig, start, end):
+        """
+        Return BED lines of features overlapping the region.
+
+        :param track_index: index of track in BED file, starting from 0
+        :type track_index: int
+        :param contig: normalized contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :return: list of lines without line breaks, in order of the data file
+        :rtype: list[str]
+        """
+        self.__get_data_file()
+        result = []
+        for offset, size in self.find_chunks(track_index, contig, start, end):
+            for line, feature_start, feature_end in self.__read_block(offset, size):
+                if feature_start < end and feature_end > start:
+                    result.append(line)
+        return result
+
+    def close(self):
+        if self.__data_file is not None:
+            self.__data_file.close()
+            self.__data_file = None
+            self.__seek = None
+        self.__records.clear()
+        self.__max_ends.clear()
@@ -3,14 +3,18 @@
 import os
 import struct
 import subprocess
+import time
 from itertools import izip
+from multiprocessing.dummy import Pool
 from tempfile import mkdtemp
 
 import validate
+from binning import reg2bin
+from genestack.cla import get_tool, RUN
 from genestack.frontend_object import StorageUnit
 from genestack.genestack_exceptions import GenestackException
 from genestack.metainfo import StringValue
-from genestack.utils import opener, normalize_contig_name
+from genestack.utils import opener, normalize_contig_name, get_cpu_count, log_info, format_tdelta
 
 validators = [validate.text_validator,
               validate.number_validator,
@@ -41,8 +45,17 @@ names = ['contig name',
          ]
 
 
+batch_patterns = {
+    validate.number_validator: validate.number_pattern,
+    validate.float_validator: validate.float_pattern,
+    validate.rgb_validator: validate.rgb_pattern,
+    validate.block_validator: validate.block_pattern,
+}
+
 FEATURE_POSSIBLE_LENGTH = [3, 4, 5, 6, 8, 9, 12]
 
+COPY_BUFFER_SIZE = 2 ** 20
+
 
 def validate_feature(feature):
     """
@@ -67,21 +80,89 @@ def validate_feature(feature):
             raise GenestackException('Number of blocks does not match number of sizes')
 
 
+def _is_valid_batch(features):
+    feature_length = len(features[0])
+    if feature_length not in FEATURE_POSSIBLE_LENGTH and feature_length < 12:
+        return False
+    if any(len(feature) != feature_length for feature in features):
+        return False
+
+    for index, validator in enumerate(validators[:feature_length]):
+        pattern = batch_patterns.get(validator)
+        if pattern is None:
+            continue
+        column = '\n'.join([feature[index] for feature in features])
+        if len(pattern.findall(column)) != len(features):
+            return False
+
+    if feature_length == 12:
+        for feature in features:
+            block_size = int(feature[9])
+            if block_size != feature[10].count(',') + 1 or block_size != feature[11].count(',') + 1:
+                return False
+    return True
+
+
+def validate_features(features):
+    """
+    Validate list of features, raises :py:class:`~genestack.GenestackException` for the first invalid feature.
+
+    Each column is checked for all features at once with a single regular expression,
+    features are validated one by one with :py:func:`validate_feature` only if some column does not match.
+    Errors are the same as :py:func:`validate_feature` raises.
+
+    :param features: list of features, each feature is a list of fields
+    :type features: list[list[str]]
+
+    raises: GenestackException
+    """
+    if not features or _is_valid_batch(features):
+        return
+    for feature in features:
+        validate_feature(feature)
+
+
 class BEDIndexer(object):
     CONTIG_CACHE_LOCATION = 'genestack.location:index_cache'
     TRACKS_INDEX_LOCATION = 'genestack.location:tracks'
+    TABIX_LOCATION = 'genestack.location:tabix'
     INDEXING_VERSION_METAINFO_KEY = "genestack.indexing:version"
     VERSION = '1'
+    BINNED_INDEX_VERSION = '2'
 
-    def __init__(self, bed, output_dir=None):
+    SORT_BUFFER_SIZE_MB = 1024  # memory used by all sort processes together
+    VALIDATION_BATCH_SIZE = 10000
+
+    def __init__(self, bed, output_dir=None, binned_index=False, tabix=False):
+        """
+        :param bed: BED file
+        :type bed: genestack.bio.BED
+        :param output_dir: directory to store files, default is current directory
+        :type output_dir: str
+        :param binned_index: write index in hierarchical binning format (:py:class:`BinnedBlock`),
+                             instead of the fixed size blocks (:py:class:`Block`)
+        :type binned_index: bool
+        :param tabix: additionally create BGZIP compressed and TABIX indexed copy of each sorted track,
+                      ``bcftools`` toolset is required
+        :type tabix: bool
+        """
         self.bed = bed
         self.output_dir = output_dir or os.getcwd()
-        output_temp_dir = mkdtemp(prefix="bed_init_", dir=self.output_dir)
-        self.output = os.path.join(output_temp_dir, 'file.bed')
-        self.tracks = os.path.join(output_temp_dir, 'tracks.txt')
-        self.index_cache_folder = os.path.join(output_temp_dir, 'index.cache')
+        if binned_index:
+            self.version = self.BINNED_INDEX_VERSION
+            self.block_class = BinnedBlock
+        else:
+            self.version = self.VERSION
+            self.block_class = Block
+        self.temp_dir = mkdtemp(prefix="bed_init_", dir=self.output_dir)
+        self.output = os.path.join(self.temp_dir, 'file.bed')
+        self.tracks = os.path.join(self.temp_dir, 'tracks.txt')
+        self.index_cache_folder = os.path.join(self.temp_dir, 'index.cache')
         if not os.path.exists(self.index_cache_folder):
             os.makedirs(os.path.abspath(self.index_cache_folder))
+        self.tabix_folder = os.path.join(self.temp_dir, 'tabix') if tabix else None
+        if self.tabix_folder and not os.path.exists(self.tabix_folder):
+            os.makedirs(os.path.abspath(self.tabix_folder))
 
     def create_index(self, bed_path):
         """
@@ -91,14 +172,22 @@ class BEDIndexer(object):
             self.index_cache_folder  # folder there index files stored
             self.output  path to sorted bam file
             result.tracks path to file there track info are stored
-
+            self.tabix_folder  # folder with `<track index>.bed.bgz` files and their TABIX indexes,
+                               # if indexer was created with ``tabix=True``
+
+        Features of each track are written to the output and indexed in the same pass
+        while they are sorted by start within contig and every contig is contiguous.
+        As soon as a track turns out to be unsorted, its features are moved to a temporary track file,
+        which is sorted after the whole input is read and written to the space reserved for it in the output.
+        Sorting does not change the size of a track, so the offsets of the following tracks remain valid.
         """
         track_feature_length = None  # check to test all features in track has same length
         tracks = []
-        track_file = None
+        track = None
+        unsorted_tracks = []
 
-        with opener(bed_path) as f:
-            for line in f:
+        with opener(bed_path) as source, open(self.output, 'w+b') as f:
+            for line in source:
                 line = line.strip()
                 # TODO: NP: does this mean we just ignore browser instructions?
                 # SA: this is ucsc.edu special attributes for their genome browser
@@ -107,14 +196,13 @@ class BEDIndexer(object):
                 if line.startswith('track'):
                     # an array of size = size of file?
                     tracks.append(line)
-                    if track_file is not None:
-                        track_file.close()
-                    track_file = open(self._get_track_path(len(tracks) - 1), 'w')
+                    offset = self._finish_track(track, f, unsorted_tracks) if track is not None else 0
+                    track = _StreamedTrack(len(tracks) - 1, line, f, offset)
                     track_feature_length = None
                 else:
                     if not tracks:
                         tracks.append('track')
-                        track_file = open(self._get_track_path(len(tracks) - 1), 'w')
+                        track = _StreamedTrack(len(tracks) - 1, 'track', f, 0)
                         track_feature_length = None
                     feature = line.split('\t')
                     feature_length = len(feature)
@@ -125,6 +213,8 @@ class BEDIndexer(object):
                             raise GenestackException('Not enough fields in feature: %s' % feature)
                     else:
                         if feature_length != track_feature_length:
+                            # features read before must be validated first, to report the first error in file
+                            self._flush_features(track, f)
                             # TODO: better message
                             raise GenestackException('Different number of fields: %s != %s' % (feature_length,
                                                                                                track_feature_length))
@@ -137,66 +227,245 @@ class BEDIndexer(object):
                         feature[10] = feature[10].strip(', ')
                         feature[11] = feature[11].strip(', ')
 
-                    validate_feature(feature)
-                    track_file.write('\t'.join(feature))
-                    track_file.write('\n')
+                    track.pending.append(feature)
+                    if len(track.pending) >= self.VALIDATION_BATCH_SIZE:
+                        self._flush_features(track, f)
 
-        if track_file is not None:
-            track_file.close()
-        # at this stage all the data is stored in files (one for each track: `track_%s`, without headers)
+            if track is not None:
+                self._finish_track(track, f, unsorted_tracks)
+            # at this stage all sorted tracks are written to output and indexed,
+            # unsorted ones are stored in files (one for each track: `track_%s`, without headers)
 
-        for i in xrange(len(tracks)):
-            subprocess.check_call(['sort', '-k1,1', '-k2,2n', '-o', self._get_track_path(i), self._get_track_path(i)])
+            self._sort_tracks([x.index for x in unsorted_tracks])
 
-        offset = 0
-
-        with open(self.output, 'w') as f:
-
-            for track_index, track in enumerate(tracks):
-                f.write(track)
-                f.write('\n')
-                offset += len(track) + 1
-
-                last_contig = None
-                block = None
-
-                with open(self._get_track_path(track_index)) as track_features:
-                    for line in track_features:
-                        f.write(line)
-                        feature = line.split('\t')
-                        contig = feature[0]
-                        if contig != last_contig:
-                            self._dump_block_to_file(block, track_index)
-                            block = Block(contig)
-                            last_contig = contig
-                        size = len(line)
-                        block.add(feature[1], feature[2], offset, size)
-                        offset += size
-
-                    self._dump_block_to_file(block, track_index)
+            for track in unsorted_tracks:
+                f.seek(track.features_offset)
+                self._write_sorted_track(track.index, f, track.features_offset)
 
         with open(self.tracks, "w") as f:
             for track in tracks:
                 f.write(track)
                 f.write('\n')
 
-        self.bed.add_metainfo_value(self.INDEXING_VERSION_METAINFO_KEY, StringValue(self.VERSION))
+        self.bed.add_metainfo_value(self.INDEXING_VERSION_METAINFO_KEY, StringValue(self.version))
         self.bed.PUT(self.bed.DATA_LOCATION, StorageUnit(self.output))
         self.bed.PUT(self.CONTIG_CACHE_LOCATION, StorageUnit(self.index_cache_folder))
         self.bed.PUT(self.TRACKS_INDEX_LOCATION, StorageUnit(self.tracks))
+        if self.tabix_folder:
+            self.bed.PUT(self.TABIX_LOCATION, StorageUnit(self.tabix_folder))
+
+    def _flush_features(self, track, f):
+        """
+        Validate features read for the track and add them.
+        """
+        validate_features(track.pending)
+        for feature in track.pending:
+            self._add_feature(track, feature, f)
+        track.pending = []
+
+    def _add_feature(self, track, feature, f):
+        """
+        Write feature to the output and index it if track is still sorted, otherwise write it to the track file.
+        """
+        line = '\t'.join(feature) + '\n'
+        if track.track_file is None and not track.is_sorted_after(feature):
+            self._move_to_track_file(track, f)
+
+        size = len(line)
+        if track.track_file is None:
+            f.write(line)
+            if self.tabix_folder:
+                if track.tabix_writer is None:
+                    track.tabix_writer = _TabixWriter(self._get_tabix_path(track.index))
+                track.tabix_writer.write(line)
+            contig = feature[0]
+            if track.block is None or contig != track.block.name:
+                self._dump_block_to_file(track.block, track.index)
+                track.block = self.block_class(contig)
+            track.block.add(feature[1], feature[2], track.offset, size)
+        else:
+            track.track_file.write(line)
+        track.offset += size
+
+    def _move_to_track_file(self, track, f):
+        """
+        Copy features of the track that are already written to the output into the track file,
+        remove index files created for this track.
+        """
+        log_info('Track %s is not sorted' % (track.index + 1))
+        track.track_file = open(self._get_track_path(track.index), 'w')
+        f.flush()
+        f.seek(track.features_offset)
+        remaining = track.offset - track.features_offset
+        while remaining > 0:
+            chunk = f.read(min(remaining, COPY_BUFFER_SIZE))
+            track.track_file.write(chunk)
+            remaining -= len(chunk)
+        f.seek(track.features_offset)
+
+        if track.tabix_writer is not None:
+            track.tabix_writer.discard()
+            track.tabix_writer = None
+
+        track.block = None
+        for contig in track.contigs:
+            index_path = self._get_index_path(track.index, contig)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+    def _finish_track(self, track, f, unsorted_tracks):
+        """
+        Finish writing of the track and return offset of the next track.
+        For the unsorted tracks space in the output is reserved, it is filled after tracks are sorted.
+        """
+        self._flush_features(track, f)
+        if track.track_file is None:
+            self._dump_block_to_file(track.block, track.index)
+            if track.tabix_writer is not None:
+                track.tabix_writer.close()
+        else:
+            track.track_file.close()
+            unsorted_tracks.append(track)
+            f.seek(track.offset)
+        return track.offset
+
+    def _write_sorted_track(self, track_index, f, offset):
+        last_contig = None
+        block = None
+        tabix_writer = _TabixWriter(self._get_tabix_path(track_index)) if self.tabix_folder else None
+
+        with open(self._get_track_path(track_index)) as track_features:
+            for line in track_features:
+                f.write(line)
+                if tabix_writer is not None:
+                    tabix_writer.write(line)
+                feature = line.split('\t')
+                contig = feature[0]
+                if contig != last_contig:
+                    self._dump_block_to_file(block, track_index)
+                    block = self.block_class(contig)
+                    last_contig = contig
+                size = len(line)
+                block.add(feature[1], feature[2], offset, size)
+                offset += size
+
+            self._dump_block_to_file(block, track_index)
+        if tabix_writer is not None:
+            tabix_writer.close()
+        os.remove(self._get_track_path(track_index))
+
+    def _sort_tracks(self, track_indexes):
+        """
+        Sort track files in place by contig and start, tracks are sorted concurrently.
+        CPUs and sort buffer are shared equally between running sort processes.
+
+        :param track_indexes: indexes of tracks to sort
+        :type track_indexes: list[int]
+        :return: None
+        """
+        tracks_count = len(track_indexes)
+        if not tracks_count:
+            return
+        cpu_count = get_cpu_count()
+        workers = min(tracks_count, cpu_count)
+        sort_arguments = [
+            '--parallel=%s' % max(1, cpu_count // workers),
+            '-S', '%sM' % max(1, self.SORT_BUFFER_SIZE_MB // workers),
+            '-T', self.temp_dir,
+        ]
+
+        def sort_track(track_index):
+            path = self._get_track_path(track_index)
+            start = time.time()
+            subprocess.check_call(['sort', '-k1,1', '-k2,2n'] + sort_arguments + ['-o', path, path])
+            log_info('Track %s sorted in %s' % (track_index + 1, format_tdelta(time.time() - start)))
+
+        pool = Pool(workers)
+        try:
+            pool.map(sort_track, track_indexes)
+        finally:
+            pool.close()
 
     def _dump_block_to_file(self, block, index):
         if block is None:
             return
-        index_output = os.path.join(self.index_cache_folder, '%s.%s.index' % (index, block.name))
-        with open(index_output, "wb") as index_file:
+        with open(self._get_index_path(index, block.name), "wb") as index_file:
             block.write(index_file)
 
+    def _get_index_path(self, track_index, contig):
+        return os.path.join(self.index_cache_folder, '%s.%s.index' % (track_index, contig))
+
+    def _get_tabix_path(self, track_index):
+        return os.path.join(self.tabix_folder, '%s.bed.bgz' % track_index)
+
     @staticmethod
     def _get_track_path(track_index):
         return "track_%s" % track_index
 
 
+class _StreamedTrack(object):
+    """
+    State of the track while it is read from the source file.
+    """
+    def __init__(self, index, track_line, f, offset):
+        f.write(track_line)
+        f.write('\n')
+        self.index = index
+        self.features_offset = offset + len(track_line) + 1
+        self.offset = self.features_offset  # offset of the next feature
+        self.track_file = None  # is set when track turns out to be unsorted
+        self.pending = []  # features that are not validated yet
+        self.tabix_writer = None
+        self.block = None
+        self.contigs = set()
+        self.last_start = None
+
+    def is_sorted_after(self, feature):
+        """
+        Check that feature does not break sort order of the track and remember its position.
+        """
+        contig = feature[0]
+        start = int(feature[1])
+        if self.block is None or contig != self.block.name:
+            if contig in self.contigs:
+                return False
+            self.contigs.add(contig)
+        elif start < self.last_start:
+            return False
+        self.last_start = start
+        return True
+
+
+class _TabixWriter(object):
+    """
+    Writes lines of sorted track through BGZIP and creates TABIX index when closed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__output = open(path, 'wb')
+        bgzip = get_tool('bcftools', 'bgzip')
+        self.__process = bgzip['-c'].popen(stdin=subprocess.PIPE, stdout=self.__output, stderr=None)
+
+    def write(self, line):
+        self.__process.stdin.write(line)
+
+    def __finish(self):
+        self.__process.stdin.close()
+        return_code = self.__process.wait()
+        self.__output.close()
+        return return_code
+
+    def close(self):
+        if self.__finish() != 0:
+            raise GenestackException('bgzip returned non-zero exit status for "%s"' % self.path)
+        tabix = get_tool('bcftools', 'tabix')
+        tabix['-p', 'bed', self.path] & RUN
+
+    def discard(self):
+        self.__finish()
+        os.remove(self.path)
+
+
 class Block(object):
     MAX_ITEMS = 100
 
@@ -245,3 +514,43 @@ class Block(object):
             if interval:
                 data = "%s %s %s %s\n" % interval
                 f.write(data)
+
+
+class BinnedBlock(object):
+    """
+    Index of contig features in hierarchical binning format, see :py:mod:`~genestack.bio.bed.binning`.
+
+    Consecutive features of the same bin are merged into chunks of up to ``MAX_ITEMS`` features.
+    Index file consists of ``>Iqqqi`` records (bin, start, max end, offset, size) sorted by bin and offset,
+    so a region query reads only chunks of the bins that may overlap the region.
+    """
+    MAX_ITEMS = 100
+    RECORD_FORMAT = '>Iqqqi'
+
+    def __init__(self, contig_name):
+        self.name = contig_name
+        self.bins = {}  # bin -> list of chunks [start, end, offset, size, count]
+
+    def add(self, start, end, offset, size):
+        start = long(start)
+        end = long(end)
+        if start > end:
+            start, end = end, start
+
+        chunks = self.bins.setdefault(reg2bin(start, end), [])
+        if chunks:
+            chunk = chunks[-1]
+            if chunk[4] < self.MAX_ITEMS and chunk[2] + chunk[3] == offset:
+                chunk[1] = max(chunk[1], end)
+                chunk[3] += size
+                chunk[4] += 1
+                return
+        chunks.append([start, end, offset, size, 1])
+
+    def __repr__(self):
+        return "<BinnedBlock: %s %s bins>" % (self.name, len(self.bins))
+
+    def write(self, f):
+        for bin_number in sorted(self.bins):
+            for start, end, offset, size, _ in self.bins[bin_number]:
+                f.write(struct.pack(self.RECORD_FORMAT, bin_number, start, end, offset, size))
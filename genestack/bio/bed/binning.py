@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hierarchical binning scheme, same as used by UCSC genome browser and BAM index.
+
+Genome is split into bins of six levels: the first level is a single bin covering 512 Mb,
+every next level splits each bin of the previous one into 8 bins, so the last level consists of 16 Kb bins.
+Feature is assigned to the smallest bin that fully contains it.
+Features which end after :py:data:`MAX_POSITION` are assigned to the first level bin.
+
+All positions are 0-based, end is exclusive.
+"""
+
+MAX_POSITION = 1 << 29
+
+# (shift, offset) for levels from the smallest bins to the largest one
+_LEVELS = ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1))
+
+
+def reg2bin(start, end):
+    """
+    Return bin of the feature.
+
+    :param start: feature start
+    :type start: int
+    :param end: feature end
+    :type end: int
+    :return: bin number
+    :rtype: int
+    """
+    end = max(end, start + 1) - 1
+    if end >= MAX_POSITION:
+        return 0
+    for shift, offset in _LEVELS:
+        if start >> shift == end >> shift:
+            return offset + (start >> shift)
+    return 0
+
+
+def reg2bins(start, end):
+    """
+    Return list of bins which may contain features overlapping the region.
+
+    :param start: region start
+    :type start: int
+    :param end: region end
+    :type end: int
+    :return: sorted list of bins
+    :rtype: list[int]
+    """
+    bins = [0]
+    if start >= MAX_POSITION:
+        return bins
+    end = min(max(end, start + 1), MAX_POSITION) - 1
+    for shift, offset in reversed(_LEVELS):
+        bins.extend(xrange(offset + (start >> shift), offset + (end >> shift) + 1))
+    return bins
@@ -11,6 +11,12 @@ Single validator structure:
         Always None
     Raises:
         Exception if fail.
+
+Batch patterns:
+    Compiled multiline regular expressions that match a whole line of a column joined with line breaks.
+    They are used to check many values at once: column is valid if number of matches is equal to number of values.
+    Patterns may be stricter than validators (e.g. do not allow leading zeros in colors),
+    values rejected by pattern are checked by validator.
 """
 
 import re
@@ -19,6 +25,15 @@ from genestack.genestack_exceptions import GenestackException
 
 text_regexp = re.compile('[-\w]*')
 
+_INT = '[-+]?[0-9]+'
+_FLOAT = '[-+]?(?:[0-9]+\\.?[0-9]*|\\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+_COLOR = '(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+
+number_pattern = re.compile('^ *%s *$' % _INT, re.M)
+float_pattern = re.compile('^ *%s *$' % _FLOAT, re.M)
+rgb_pattern = re.compile('^(?:0|{0},{0},{0})$'.format(_COLOR), re.M)
+block_pattern = re.compile('^ *{0} *(?:, *{0} *)*$'.format(_INT), re.M)
+
 
 def no_validate(text, name):
     """
@@ -4,15 +4,71 @@
     Java ``ExternalDataBase`` object shadow
 """
 import os
-import pipes
 import subprocess
+from collections import OrderedDict
+from multiprocessing.dummy import Pool
 
 from genestack import utils
+from genestack.bio.tabix_lookup import TabixAnnotationLookup
 from genestack.cla import get_tool, RUN
 from genestack.core_files.genestack_file import File
 from genestack.frontend_object import StorageUnit
 from genestack.genestack_exceptions import GenestackException
 from genestack.java import java_object, JAVA_HASH_MAP, JAVA_LIST
+from genestack.metainfo import IntegerValue, StringValue
+from genestack.utils import LRUCache
+
+# marker for the values that are absent in annotations cache
+_MISSING = object()
+
+
+class DataStatistics(object):
+    """
+    Statistics of the data lines (lines that do not start with ``#``) of a tab-separated database file.
+
+    Contig is taken from the first column and position from the second one,
+    as they are used for TABIX indexing.
+    """
+    def __init__(self):
+        self.lines_count = 0
+        self.contigs = []  # in order of the first appearance
+        self.ranges = {}  # contig -> [min position, max position]
+
+    def update(self, line):
+        """
+        Account a single line of the file.
+
+        :param line: line of the database file
+        :type line: str
+        :rtype: None
+        """
+        if line.startswith('#'):
+            return
+        self.lines_count += 1
+        fields = line.split('\t', 2)
+        if len(fields) < 2:
+            return
+        contig = fields[0]
+        try:
+            position = int(fields[1])
+        except ValueError:
+            return
+        contig_range = self.ranges.get(contig)
+        if contig_range is None:
+            self.contigs.append(contig)
+            self.ranges[contig] = [position, position]
+        elif position < contig_range[0]:
+            contig_range[0] = position
+        elif position > contig_range[1]:
+            contig_range[1] = position
+
+    def get_ranges_list(self):
+        """
+        Return list of strings ``contig:from-to`` in order of contigs appearance.
+
+        :rtype: list[str]
+        """
+        return ['%s:%s-%s' % (contig, self.ranges[contig][0], self.ranges[contig][1]) for contig in self.contigs]
 
 
 class ExternalDatabase(File):
@@ -28,19 +84,95 @@ class ExternalDatabase(File):
     SCHEMA_LOCATION = 'genestack.location:schema'
 
     SCHEMA_KEY = 'genestack:database.schema'
+    VARIANTS_COUNT_KEY = 'genestack.initialization:variantsCount'
+    CONTIG_RANGES_KEY = 'genestack.initialization:contigRanges'
+
+    LOOKUP_CHUNK_SIZE = 1000  # max number of intervals sent in a single request
+    LOOKUP_THREADS = 4  # max number of concurrent requests
+
+    # Annotations are shared by all instances, key is (file_id, contig, position_from, position_to)
+    annotations_cache = LRUCache(100000)
 
     def __init__(self, file_id=None):
         super(ExternalDatabase, self).__init__(file_id=file_id)
         self.annotations_map = None
         self.metainfo = self.get_metainfo()
+        self.local_lookup = None
+
+    def enable_local_lookup(self, working_dir=None):
+        """
+        GETs compressed data and TABIX index of the database,
+        so that :py:meth:`lookup_local_annotations` can answer queries without requests to the server.
+
+        :param working_dir: directory to copy files into, default is current directory
+        :type working_dir: str
+        :rtype: None
+        """
+        data_path = self.GET(self.DATA_LOCATION, working_dir=working_dir)[0].get_first_file()
+        self.GET(self.TABIX_LOCATION, working_dir=working_dir)
+        self.local_lookup = TabixAnnotationLookup(data_path, typed_key_getter=self.get_typed_key)
 
     def lookup_annotations(self, queries_list):
         """
         Extracts annotations from variation database by specified contigs and positions.
 
+        Queries are sent to the server in chunks of :py:attr:`LOOKUP_CHUNK_SIZE` intervals,
+        up to :py:attr:`LOOKUP_THREADS` chunks at a time.
+        Server returns a list with one item per interval of the chunk, so annotations of every interval
+        are cached in :py:attr:`annotations_cache` and only intervals that are not cached are requested.
+
         :param queries_list: list of tuples (contig, position_from, position_to)
-        :return:
+        :return: list of annotations, one item per query in the same order as queries
+        :rtype: list
+        """
+        queries = [tuple(query) for query in queries_list]
+        results = [self.annotations_cache.get((self.object_id,) + query, _MISSING) for query in queries]
+
+        # the same interval is requested only once
+        missing_queries = OrderedDict()
+        for index, (query, result) in enumerate(zip(queries, results)):
+            if result is _MISSING:
+                missing_queries.setdefault(query, []).append(index)
+        missing_list = missing_queries.keys()
+        chunks = [missing_list[i:i + self.LOOKUP_CHUNK_SIZE]
+                  for i in xrange(0, len(missing_list), self.LOOKUP_CHUNK_SIZE)]
+        if not chunks:
+            return results
+
+        pool = Pool(min(self.LOOKUP_THREADS, len(chunks)))
+        try:
+            responses = pool.map(self.__get_annotations, chunks)
+        finally:
+            pool.close()
+
+        for chunk, response in zip(chunks, responses):
+            if not isinstance(response, list) or len(response) != len(chunk):
+                raise GenestackException('Expected list of annotations for %s intervals, got: %s' % (
+                    len(chunk), '%s items' % len(response) if isinstance(response, list) else type(response)))
+            for query, annotation in zip(chunk, response):
+                self.annotations_cache.put((self.object_id,) + query, annotation)
+                for index in missing_queries[query]:
+                    results[index] = annotation
+        return results
+
+    def lookup_local_annotations(self, queries_list):
         """
+        Extracts annotations by specified contigs and positions from the local data file,
+        :py:meth:`enable_local_lookup` should be called before.
+
+        Result has format of :py:meth:`~genestack.bio.tabix_lookup.TabixAnnotationLookup.lookup`,
+        that is different from the server response returned by :py:meth:`lookup_annotations`.
+
+        :param queries_list: list of tuples (contig, position_from, position_to), positions are 1-based inclusive
+        :return: list of annotations, one item per query in the same order as queries,
+                 each item is a list of dicts that map typed key to value
+        :rtype: list[list[dict[str, str]]]
+        """
+        if self.local_lookup is None:
+            raise GenestackException('Local lookup is not enabled, call enable_local_lookup first')
+        return self.local_lookup.lookup(queries_list)
+
+    def __get_annotations(self, queries_list):
         def __create_genome_interval(contig, position_from, position_to):
             return java_object('com.genestack.bio.files.GenomeInterval', {
                 'contigName': contig,
@@ -95,10 +227,10 @@ class ExternalDatabase(File):
         :type schema: str
         :rtype: None
         """
-        compressed_data_file = self.__create_compressed_data_file(path)
+        compressed_data_file, statistics = self.__create_compressed_data_file(path)
         tabix = self.__create_tabix(compressed_data_file)
-        num_of_variants = self.__get_number_of_variants(path)
-        index = self.__create_index(path, num_of_variants, schema)
+        index = self.__create_index(path, statistics.lines_count, schema)
+        self.__put_statistics(statistics)
 
         self.__put(self.DATA_LOCATION, compressed_data_file)
         self.__put(self.TABIX_LOCATION, tabix)
@@ -108,19 +240,41 @@ class ExternalDatabase(File):
     def __put(self, key, path):
         self.PUT(key, StorageUnit(path))
 
-    def __create_compressed_data_file(self, data_file_path):
+    def __put_statistics(self, statistics):
+        self.replace_metainfo_value(self.VARIANTS_COUNT_KEY, IntegerValue(statistics.lines_count))
+        ranges = statistics.get_ranges_list()
+        # ranges are replaced, not appended to the ranges of the previous initialization
+        self.remove_metainfo_value(self.CONTIG_RANGES_KEY)
+        if ranges:
+            self.add_metainfo_value(self.CONTIG_RANGES_KEY, [StringValue(x) for x in ranges])
+
+    @staticmethod
+    def __create_compressed_data_file(data_file_path):
         """
         Creates an archive that contains the given variation database file using BGZIP compression.
+        Data is streamed to BGZIP line by line, so statistics are collected in the same pass.
 
         :param data_file_path: path to the variation database file
         :type data_file_path: str
-        :return: path to the compressed archive
-        :rtype: str
+        :return: path to the compressed archive and statistics of the data lines
+        :rtype: (str, DataStatistics)
         """
         compressed_file = data_file_path + '.bgz'
+        statistics = DataStatistics()
         bgzip = get_tool('bcftools', 'bgzip')
-        bgzip['-c', data_file_path] & RUN(stdout=compressed_file)
-        return compressed_file
+        utils.log_info('Start: bgzip -c %s' % data_file_path)
+        with open(data_file_path) as source, open(compressed_file, 'wb') as output:
+            process = bgzip['-c'].popen(stdin=subprocess.PIPE, stdout=output, stderr=None)
+            try:
+                for line in source:
+                    statistics.update(line)
+                    process.stdin.write(line)
+            finally:
+                process.stdin.close()
+            if process.wait() != 0:
+                raise GenestackException('bgzip returned non-zero exit status %d' % process.returncode)
+        utils.log_info('Compressed %s data lines' % statistics.lines_count)
+        return compressed_file, statistics
 
     def __create_tabix(self, data_file_path):
         """
@@ -136,12 +290,6 @@ class ExternalDatabase(File):
         tabix['-s', '1', '-b', '2', '-e', '2', data_file_path] & RUN
         return data_file_path + '.tbi'
 
-    @staticmethod
-    def __get_number_of_variants(data_file_path):
-        cmd_line = "grep -v '^#' %s | wc -l" % pipes.quote(data_file_path)
-        line_count = subprocess.check_output([cmd_line], shell=True)
-        return int(line_count)
-
     @staticmethod
     def __create_index(data_file_path, num_of_variants, schema):
         """
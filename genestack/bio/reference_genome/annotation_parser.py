@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming parser of GTF and GFF3 annotations for genome indexing.
+
+Features are built with the same rules as ``BCBio.GFF`` uses, but without Biopython objects:
+  - attributes are split into lists of values, unquoted values are split by commas, values are URL-unquoted
+  - in GTF (GFF2) lines ``transcript_id`` is the parent of the feature
+  - features with ``Parent`` are nested into features with the same ``ID``,
+    several children of a parent that is absent in the file are nested into an inferred parent feature,
+    a single such child stays a top level feature
+
+Lines are grouped by contig and features are built for one contig at a time,
+so contigs can be parsed in parallel.
+
+``BCBio.GFF`` stays the reference implementation: :py:func:`parse_annotation_with_bcbio` yields the same features
+built by it, and :py:func:`compare_with_bcbio` checks that both parsers give the same features for a file.
+"""
+
+import gc
+import re
+from collections import OrderedDict
+from itertools import groupby, izip_longest
+from operator import itemgetter
+from urllib import unquote
+
+from genestack.genestack_exceptions import GenestackException
+from genestack.utils import opener
+
+_GFF3_KEY_PATTERN = re.compile(r'\w+=')
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+# well-formed GTF attributes: 'key "value"' pairs separated by '; ', without escapes and empty values
+_GTF_ATTRIBUTES_PATTERN = re.compile(r'(?:[^ ";%=]+ "[^";%]+"(?:; |$))+$')
+_GTF_ATTRIBUTE_PATTERN = re.compile(r'([^ ";%=]+) "([^";%]+)"')
+
+_STRANDS = {'+': 1, '-': -1}
+
+# GTF (GFF2) keys that refer to the parent transcript, the first present key is used
+_GFF2_PARENT_KEYS = ('transcript_id', 'transcriptId', 'proteinId')
+# WormBase GFF2 flat features
+_GFF2_FLAT_NAMES = ('Transcript', 'CDS')
+_GFF2_FLAT_CHILD_TYPES = ('intron', 'exon', 'three_prime_UTR', 'coding_exon', 'five_prime_UTR',
+                          'CDS', 'stop_codon', 'start_codon')
+
+INFERRED_PARENT_TYPE = 'inferred_parent'
+
+
+class AnnotationFeature(object):
+    """
+    Feature of annotation file.
+
+    :ivar type: feature type from the third column
+    :ivar start: 0-based start
+    :ivar end: end, exclusive
+    :ivar strand: ``1``, ``-1`` or ``None``
+    :ivar id: value of ``ID`` attribute or empty string
+    :ivar qualifiers: attributes, dict of lists of values
+    :ivar sub_features: nested features
+    """
+    __slots__ = ('type', 'start', 'end', 'strand', 'id', 'qualifiers', 'sub_features')
+
+    def __init__(self, feature_type, start, end, strand, feature_id, qualifiers):
+        self.type = feature_type
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.id = feature_id
+        self.qualifiers = qualifiers
+        self.sub_features = []
+
+
+def _add_value(qualifiers, key, value):
+    if value and value[0] == '"' and value[-1] == '"':
+        values = [value[1:-1] or 'true']
+    elif value:
+        values = [x for x in value.split(',') if x]
+    else:
+        values = ['true']
+    if '%' in value:
+        values = [unquote(x) for x in values]
+    qualifiers.setdefault(key, []).extend(values)
+
+
+def _parse_gtf_attributes(parts):
+    """
+    Parse GTF (GFF2) ``key "value"`` pairs.
+    """
+    qualifiers = {}
+    for part in parts:
+        if part and part[0] == ';':
+            part = part[1:]
+        key, _, value = part.strip().partition(' ')
+        # quoted values are the most common case
+        if len(value) > 2 and value[0] == '"' and value[-1] == '"' and '%' not in value:
+            qualifiers.setdefault(key, []).append(value[1:-1])
+        else:
+            _add_value(qualifiers, key, value)
+    return qualifiers
+
+
+def _parse_gff3_attributes(parts):
+    """
+    Parse GFF3 ``key=value`` pairs.
+    """
+    qualifiers = {}
+    for part in parts:
+        key, _, value = part.partition('=')
+        # unquoted value without lists and escapes is the most common case
+        if value and ',' not in value and '%' not in value and value[0] != '"':
+            qualifiers.setdefault(key, []).append(value)
+        else:
+            _add_value(qualifiers, key, value)
+    return qualifiers
+
+
+def parse_attributes(text):
+    """
+    Parse the ninth column of annotation file.
+    GFF3 or GTF syntax is detected by the first attribute.
+
+    :param text: attributes column
+    :type text: str
+    :return: tuple of dict that maps keys to lists of values, and flag that attributes have GTF (GFF2) syntax
+    :rtype: (dict[str, list[str]], bool)
+    """
+    if text.endswith(';'):
+        text = text[:-1]
+    if _GTF_ATTRIBUTES_PATTERN.match(text):
+        qualifiers = {}
+        for key, value in _GTF_ATTRIBUTE_PATTERN.findall(text):
+            qualifiers.setdefault(key, []).append(value)
+        return qualifiers, True
+    parts = text.split(' ; ')
+    if len(parts) == 1:
+        parts = text.split('; ')
+        if len(parts) == 1:
+            parts = text.split(';')
+    if _GFF3_KEY_PATTERN.match(parts[0]):
+        return _parse_gff3_attributes(parts), False
+    return _parse_gtf_attributes(parts), True
+
+
+def _nest_gff2_feature(feature):
+    """
+    Add ``Parent`` qualifier to GTF (GFF2) feature, same as ``ID``/``Parent`` in GFF3.
+    """
+    qualifiers = feature.qualifiers
+    for key in _GFF2_PARENT_KEYS:
+        if key in qualifiers:
+            qualifiers['Parent'] = qualifiers[key]
+            break
+    for flat_name in _GFF2_FLAT_NAMES:
+        if flat_name in qualifiers:
+            if feature.type == flat_name:
+                if not feature.id:
+                    feature.id = qualifiers[flat_name][0]
+                    qualifiers['ID'] = [feature.id]
+            elif feature.type in _GFF2_FLAT_CHILD_TYPES:
+                qualifiers['Parent'] = qualifiers[flat_name]
+            break
+
+
+def parse_line(line):
+    """
+    Parse a feature line of annotation file.
+
+    :param line: line without line break and surrounding whitespaces, not a comment
+    :type line: str
+    :return: tuple of contig name and feature, feature is ``None`` if line does not have location
+    :rtype: (str, AnnotationFeature | None)
+    """
+    parts = line.split('\t')
+    if len(parts) == 1:
+        parts = [x for x in _WHITESPACE_PATTERN.split(line) if x]
+    if len(parts) < 8:
+        raise GenestackException('Annotation line should have at least 8 columns: %s' % line)
+    contig, _, feature_type, start, end, _, strand = parts[:7]
+    if start == '.' or end == '.' or not start or not end:
+        return contig, None
+    if len(parts) > 8 and parts[8] and parts[8] != '.':
+        qualifiers, is_gff2 = parse_attributes(parts[8])
+    else:
+        qualifiers, is_gff2 = {}, False
+    try:
+        start = int(start) - 1
+        end = int(end)
+    except ValueError:
+        raise GenestackException('Invalid location in annotation line: %s' % line)
+    feature_id = qualifiers['ID'][0] if 'ID' in qualifiers else ''
+    # feature types are few and are kept by every sub feature of the gene model
+    feature = AnnotationFeature(intern(feature_type), start, end, _STRANDS.get(strand), feature_id, qualifiers)
+    if is_gff2:
+        _nest_gff2_feature(feature)
+    if feature.id and feature.id in feature.qualifiers.get('Parent', ()):
+        raise GenestackException('Self-referential parent/child relationship: %s' % feature.id)
+    return contig, feature
+
+
+class _ContigFeatures(object):
+    """
+    Features of single contig, that are nested when all lines of contig are read.
+    """
+    def __init__(self):
+        self.flat_features = []
+        self.parents = []
+        self.children = OrderedDict()  # parent id -> list of children in order of file
+
+    def add(self, feature):
+        parent_ids = feature.qualifiers.get('Parent')
+        if parent_ids:
+            for parent_id in parent_ids:
+                self.children.setdefault(parent_id, []).append(feature)
+        elif feature.id:
+            self.parents.append(feature)
+        else:
+            self.flat_features.append(feature)
+
+    def __add_children(self, parent):
+        children = self.children.pop(parent.id, None)
+        if children is not None:
+            for child in children:
+                self.__add_children(child)
+            parent.sub_features.extend(children)
+
+    def get_features(self):
+        """
+        Return top level features: features without parent, then features with children,
+        then children without parent in the file.
+
+        :rtype: list[AnnotationFeature]
+        """
+        features = list(self.flat_features)
+        for parent in self.parents:
+            self.__add_children(parent)
+            features.append(parent)
+        while self.children:
+            parent_id, children = next(self.children.iteritems())
+            if len(children) == 1:
+                features.append(children[0])
+                del self.children[parent_id]
+                continue
+            strands = set(x.strand for x in children)
+            parent = AnnotationFeature(INFERRED_PARENT_TYPE,
+                                       min(x.start for x in children), max(x.end for x in children),
+                                       strands.pop() if len(strands) == 1 else None,
+                                       parent_id, {'ID': [parent_id]})
+            self.__add_children(parent)
+            features.append(parent)
+        return features
+
+
+def read_contig_lines(path, allowed_contigs=None):
+    """
+    Read feature lines of GTF or GFF3 file grouped by contig, lines are not parsed.
+    Lines of the same contig are expected to go one after another,
+    otherwise the contig is yielded several times.
+    Reading stops at ``##FASTA`` directive.
+
+    :param path: path to annotation file, can be compressed
+    :type path: str
+    :param allowed_contigs: if specified, lines of other contigs are not collected,
+                            such contigs are yielded with ``None`` instead of lines
+    :type allowed_contigs: set[str]
+    :return: generator of tuples (contig name, list of lines without surrounding whitespaces)
+    :rtype: collections.Iterable[(str, list[str] | None)]
+    """
+    contig = None
+    lines = None
+    with opener(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '#':
+                if line.startswith('##FASTA'):
+                    break
+                continue
+            if line[0] == '>':
+                break
+            line_contig = line[:line.find('\t')] if '\t' in line else line.split(None, 1)[0]
+            if line_contig != contig:
+                if contig is not None:
+                    yield contig, lines
+                contig = line_contig
+                lines = [] if allowed_contigs is None or contig in allowed_contigs else None
+            if lines is not None:
+                lines.append(line)
+    if contig is not None:
+        yield contig, lines
+
+
+def parse_features(lines):
+    """
+    Parse feature lines of single contig and nest features.
+
+    :param lines: lines of annotation file without surrounding whitespaces, not comments
+    :type lines: list[str]
+    :return: top level features
+    :rtype: list[AnnotationFeature]
+    """
+    # features do not have reference cycles and stay in memory until all lines are parsed,
+    # so garbage collector is paused, otherwise it repeatedly traverses all of them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        contig_features = _ContigFeatures()
+        for line in lines:
+            _, feature = parse_line(line)
+            if feature is not None:
+                contig_features.add(feature)
+        return contig_features.get_features()
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def parse_annotation(path, allowed_contigs=None):
+    """
+    Parse GTF or GFF3 file and yield features of each contig.
+    Lines of the same contig are expected to go one after another,
+    otherwise the contig is yielded several times.
+    Parsing stops at ``##FASTA`` directive.
+
+    :param path: path to annotation file, can be compressed
+    :type path: str
+    :param allowed_contigs: if specified, features of other contigs are not built,
+                            such contigs are yielded with empty list of features
+    :type allowed_contigs: set[str]
+    :return: generator of tuples (contig name, list of top level features)
+    :rtype: collections.Iterable[(str, list[AnnotationFeature])]
+    """
+    for contig, lines in read_contig_lines(path, allowed_contigs):
+        yield contig, parse_features(lines) if lines is not None else []
+
+
+# qualifiers that BCBio.GFF adds from columns other than attributes
+_BCBIO_COLUMN_QUALIFIERS = ('source', 'score', 'phase')
+
+
+def _from_seq_feature(seq_feature):
+    """
+    Convert ``SeqFeature`` created by ``BCBio.GFF`` to :py:class:`AnnotationFeature`.
+    """
+    qualifiers = dict((key, list(value)) for key, value in seq_feature.qualifiers.iteritems()
+                      if key not in _BCBIO_COLUMN_QUALIFIERS)
+    feature = AnnotationFeature(seq_feature.type,
+                                int(seq_feature.location.start),
+                                int(seq_feature.location.end),
+                                seq_feature.strand,
+                                qualifiers['ID'][0] if 'ID' in qualifiers else '',
+                                qualifiers)
+    feature.sub_features = [_from_seq_feature(x) for x in seq_feature.sub_features]
+    return feature
+
+
+def parse_annotation_with_bcbio(path, allowed_contigs=None):
+    """
+    Parse GTF or GFF3 file by ``BCBio.GFF`` and yield features of each contig,
+    in the same way as :py:func:`parse_annotation` does.
+    This is the reference implementation, contigs are yielded for each portion of file read by ``BCBio.GFF``,
+    so the same contig can be yielded several times.
+
+    :param path: path to annotation file, can be compressed
+    :type path: str
+    :param allowed_contigs: if specified, features of other contigs are not converted,
+                            such contigs are yielded with empty list of features
+    :type allowed_contigs: set[str]
+    :return: generator of tuples (contig name, list of top level features)
+    :rtype: collections.Iterable[(str, list[AnnotationFeature])]
+    """
+    # avoid crash then using pypy
+    import BCBio.GFF
+    with opener(path) as f:
+        # The parser will attempt to smartly break up the file at requested number of lines
+        # and would continue until the entire feature region is read.
+        for record in BCBio.GFF.parse(f, target_lines=2000):
+            if allowed_contigs is not None and record.id not in allowed_contigs:
+                yield record.id, []
+            else:
+                yield record.id, [_from_seq_feature(x) for x in record.features]
+
+
+def _join_contigs(contigs_features):
+    """
+    Join features of the same contig that are yielded one after another.
+    """
+    for contig, items in groupby(contigs_features, key=itemgetter(0)):
+        yield contig, [feature for _, features in items for feature in features]
+
+
+def _feature_key(feature):
+    """
+    Return comparable representation of feature and its sub features, that does not depend on their order.
+    """
+    qualifiers = tuple(sorted((key, tuple(value)) for key, value in feature.qualifiers.iteritems()))
+    sub_features = tuple(sorted(_feature_key(x) for x in feature.sub_features))
+    return feature.type, feature.start, feature.end, feature.strand, feature.id, qualifiers, sub_features
+
+
+def compare_with_bcbio(path, allowed_contigs=None):
+    """
+    Compare features built by :py:func:`parse_annotation` with features built by ``BCBio.GFF``
+    (see :py:func:`parse_annotation_with_bcbio`). Order of features is not compared.
+    Qualifiers that ``BCBio.GFF`` creates from ``source``, ``score`` and ``phase`` columns are ignored.
+
+    :param path: path to annotation file, can be compressed
+    :type path: str
+    :param allowed_contigs: if specified, only features of these contigs are compared
+    :type allowed_contigs: set[str]
+    :return: names of contigs which features differ, in order of file
+    :rtype: list[str]
+    """
+    mismatches = []
+    for parsed, reference in izip_longest(_join_contigs(parse_annotation(path, allowed_contigs)),
+                                          _join_contigs(parse_annotation_with_bcbio(path, allowed_contigs)),
+                                          fillvalue=(None, [])):
+        contig, features = parsed
+        reference_contig, reference_features = reference
+        if contig != reference_contig:
+            mismatches.append(contig if contig is not None else reference_contig)
+        elif sorted(_feature_key(x) for x in features) != sorted(_feature_key(x) for x in reference_features):
+            mismatches.append(contig)
+    return mismatches
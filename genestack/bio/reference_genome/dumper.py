@@ -1,44 +1,48 @@
 # -*- coding: utf-8 -*-
-import os
+import struct
+import zipfile
 
 
 class FastaDumper(object):
     """
-    Class for dumping fasta data to file.
+    Class for dumping fasta data to zip archive.
 
-    Create a files name composed from contig name followed by
-     the index of this file among all files for the contig.
+    Data is written by chunks of ``BUFFER_SIZE`` nucleotides, each chunk is a member of archive
+    named from contig name followed by the index of this chunk among all chunks of the contig.
 
-    Example: 5th nucleotide of Chromosome will be placed in a file called "Chromosome_0",
-     10005th  will be placed in a file called "Chromosome_1" file etc.
+    Example: 5th nucleotide of Chromosome will be placed in a member called "Chromosome_0",
+     10005th  will be placed in a member called "Chromosome_1" etc.
     """
     BUFFER_SIZE = 10000
 
-    def __init__(self, current_folder):
-        self.current_folder = current_folder
+    def __init__(self, archive):
+        """
+        :param archive: zip archive opened for writing, its compression is used for members
+        :type archive: zipfile.ZipFile
+        """
+        self.archive = archive
         self.prefix = None
-        self.buffer = ''
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.length = 0  # number of filled bytes in buffer
         self.index = 0
 
     def _dump(self):
         """
-        Dump buffer to the file in current folder named with ``index`` value and
-        increment ``index`` value by 1.
+        Write filled part of the buffer to the archive as a member named with ``index`` value,
+        increment ``index`` value by 1 and clear the buffer.
 
-        If buffer is empty does nothing,
-        If buffer is bigger then self.BUFFER_SIZE, dump only self.BUFFER_SIZE.
+        If buffer is empty does nothing.
         """
-        if not self.buffer or not self.prefix:
+        if not self.length or not self.prefix:
             return
-        file_name = '%s_%s' % (self.prefix, self.index)
-        with open(os.path.join(self.current_folder, file_name), 'w') as f:
-            f.write(self.buffer[:self.BUFFER_SIZE])
+        member_name = '%s_%s' % (self.prefix, self.index)
+        self.archive.writestr(member_name, memoryview(self.buffer)[:self.length].tobytes())
         self.index += 1
-        self.buffer = self.buffer[self.BUFFER_SIZE:]
+        self.length = 0
 
     def flush(self):
         """
-        Save all data from buffer to file.
+        Save all data from buffer to archive.
 
         :return: None
         """
@@ -60,13 +64,51 @@ class FastaDumper(object):
 
     def add(self, text):
         """
-        Add chunk of data to the current folder.
-        If total length of all chunks in buffer is greater than self.BUFFER_SIZE
-        then they will be dumped into a file.
+        Add chunk of data. Text is copied to the buffer,
+        every time the buffer is full it is written to the archive.
 
         :param text: text to dump
         :type text: str
         """
-        self.buffer += text
-        if len(self.buffer) > self.BUFFER_SIZE:
-            self._dump()
+        position = 0
+        text_length = len(text)
+        while position < text_length:
+            size = min(self.BUFFER_SIZE - self.length, text_length - position)
+            self.buffer[self.length:self.length + size] = text[position:position + size]
+            self.length += size
+            position += size
+            if self.length == self.BUFFER_SIZE:
+                self._dump()
+
+
+def copy_zip_members(source, target):
+    """
+    Append all members of one zip archive to another without decompression and recompression:
+    compressed data of each member is copied as is after a new local header.
+
+    :param source: zip archive opened for reading
+    :type source: zipfile.ZipFile
+    :param target: zip archive opened for writing with ``'w'`` mode,
+                   central directory is written when it is closed
+    :type target: zipfile.ZipFile
+    :return: None
+    """
+    for info in source.infolist():
+        source.fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+        # skip file name and extra field, their lengths are the last two fields of the local header
+        source.fp.seek(header[-2] + header[-1], 1)
+        data = source.fp.read(info.compress_size)
+
+        member = zipfile.ZipInfo(info.filename, info.date_time)
+        member.compress_type = info.compress_type
+        member.external_attr = info.external_attr
+        member.CRC = info.CRC
+        member.file_size = info.file_size
+        member.compress_size = info.compress_size
+        member.header_offset = target.fp.tell()
+        zip64 = member.file_size > zipfile.ZIP64_LIMIT or member.compress_size > zipfile.ZIP64_LIMIT
+        target.fp.write(member.FileHeader(zip64))
+        target.fp.write(data)
+        target.filelist.append(member)
+        target.NameToInfo[member.filename] = member
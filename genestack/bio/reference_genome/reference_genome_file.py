@@ -5,6 +5,7 @@ from pprint import pformat
 from genestack.bio import bio_meta_keys
 from genestack.bio.genome_query import GenomeQuery
 from genestack.bio.annotation_utils import GTF, AVAILABLE_ANNOTATION_FORMATS
+from genestack.bio.reference_genome.two_bit import TwoBitReader
 from genestack.compression import UNCOMPRESSED, AVAILABLE_COMPRESSIONS, decompress_file
 from genestack.core_files.genestack_file import File
 from genestack.genestack_exceptions import GenestackException
@@ -26,6 +27,8 @@ class ReferenceGenome(File):
 
     SEQUENCE_LOCATION = 'genestack.location:sequence'
     ANNOTATIONS_LOCATION = 'genestack.location:annotations'
+    # packed sequences created by ReferenceGenomeIndexer
+    TWO_BIT_LOCATION = 'genestack.location:index_2bit'
 
     # @Deprecated, use Metainfo.SOURCE_DATA
     # Deprecated in 0.44.0, will be removed in 0.47.0
@@ -35,6 +38,8 @@ class ReferenceGenome(File):
         ANNOTATION_FORMAT = 'annotation_format'
         COMPRESSION = 'compression'
 
+    _two_bit_reader = None
+
     def get_sequence_files(self, working_dir=None, decompressed=False):
         """
         GET sequence files from storage, returns list of their paths.
@@ -122,6 +127,29 @@ class ReferenceGenome(File):
         """
         return self.invoke('getContigs')
 
+    def fetch(self, contig, start, end, working_dir=None):
+        """
+        Return bases of the region, soft-masked bases are in lower case.
+
+        On the first call packed ``.2bit`` sequences are copied from storage,
+        then the file is memory-mapped and only the bytes of requested regions are read.
+        ``.2bit`` file is not created for genomes with sequence names longer than 255 characters.
+
+        :param contig: contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :param working_dir: directory to copy ``.2bit`` file into, default is current directory
+        :type working_dir: str
+        :rtype: str
+        """
+        if self._two_bit_reader is None:
+            path = self.GET(self.TWO_BIT_LOCATION, working_dir=working_dir)[0].get_first_file()
+            self._two_bit_reader = TwoBitReader(path)
+        return self._two_bit_reader.fetch(contig, start, end)
+
     def find_features(self, query):
         """
         Return features matching query.
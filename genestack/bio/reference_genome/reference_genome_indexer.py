@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import gc
 import json
 import os
 import shutil
-import subprocess
 import sys
+import tempfile
+import zipfile
+from array import array
+from collections import deque
+from itertools import izip
+from multiprocessing import Pool
 
 from genestack.genestack_exceptions import GenestackException
 from genestack.frontend_object import StorageUnit
@@ -12,9 +18,13 @@ from genestack.genestack_indexer import Indexer
 
 from genestack.bio.annotation_utils import determine_annotation_file_format, GTF, GFF3
 
-from genestack.bio.reference_genome.dumper import FastaDumper
+from genestack.bio.reference_genome.annotation_parser import (parse_features, read_contig_lines,
+                                                              parse_annotation_with_bcbio)
+from genestack.bio.reference_genome.dumper import FastaDumper, copy_zip_members
+from genestack.bio.reference_genome.two_bit import TwoBitRecordsWriter, write_two_bit, MAX_NAME_LENGTH
 from genestack.metainfo import StringValue
-from genestack.utils import DumpData, normalize_contig_name, opener, truncate_sequence_str
+from genestack.utils import (DumpData, normalize_contig_name, opener, truncate_sequence_str, get_cpu_count,
+                             log_warning)
 
 
 def get_qualifier(feature, attribute_key):
@@ -23,15 +33,109 @@ def get_qualifier(feature, attribute_key):
 INDEXING_VERSION = 'genestack.indexing:version'
 
 
+def _dump_fasta_file(file_name, archive, temp_dir):
+    """
+    Write sequences of fasta file to the zip archive by chunks, see :py:class:`FastaDumper`,
+    and to ``.2bit`` records file in temporary folder, see :py:class:`TwoBitRecordsWriter`.
+
+    :param file_name: path to fasta file, can be compressed
+    :type file_name: str
+    :param archive: zip archive opened for writing
+    :type archive: zipfile.ZipFile
+    :param temp_dir: folder for ``.2bit`` records file
+    :type temp_dir: str
+    :return: tuple of:
+               - list of [contig name, contig length] in order of the file
+               - lines of ``.fai`` index of the decompressed file,
+                 ``None`` if lines of some sequence have different lengths
+               - tuple of ``.2bit`` records file path and list of its records,
+                 ``None`` if some sequence name is too long for ``.2bit`` format
+    :rtype: (list[list], list[str] | None, (str, list) | None)
+    """
+    items = []
+    fai_items = []  # [offset of the first base, bases per line, bytes per line]
+    fai_valid = True
+    two_bit_valid = True
+    last_line_short = False
+    offset = 0
+
+    fd, records_path = tempfile.mkstemp(suffix='.2bit.records', dir=temp_dir)
+    os.close(fd)
+    two_bit_writer = TwoBitRecordsWriter(records_path)
+    fasta_dumper = FastaDumper(archive)
+    try:
+        with opener(file_name) as sequenceFile:
+            first = sequenceFile.read(1)
+            if first != '>':
+                raise GenestackException('File "%s" is not a sequence file' % file_name)
+            else:
+                sequenceFile.seek(0)
+
+            for line in sequenceFile:
+                offset += len(line)
+                if line.startswith('>'):
+                    header = line[1:].split()
+                    name = header[0]
+                    items.append([name, 0])
+                    fai_items.append([offset, 0, 0])
+                    last_line_short = False
+                    fasta_dumper.set(normalize_contig_name(name))
+                    if len(name) > MAX_NAME_LENGTH:
+                        two_bit_valid = False
+                    if two_bit_valid:
+                        two_bit_writer.set(name)
+                else:
+                    res = line.strip()
+                    items[-1][1] += len(res)
+                    fasta_dumper.add(res)
+                    if two_bit_valid:
+                        two_bit_writer.add(res)
+
+                    # all lines of sequence except the last one must have the same length
+                    fai_item = fai_items[-1]
+                    if not fai_item[1]:
+                        fai_item[1:] = [len(res), len(line)]
+                    elif last_line_short or len(res) > fai_item[1] or (
+                            len(res) == fai_item[1] and len(line) != fai_item[2]):
+                        fai_valid = False
+                    last_line_short = len(res) < fai_item[1]
+        fasta_dumper.flush()
+    finally:
+        two_bit_writer.close()
+
+    fai_lines = None
+    if fai_valid:
+        fai_lines = ['%s\t%s\t%s\t%s\t%s\n' % (name, length, fai_offset, line_bases, line_width)
+                     for (name, length), (fai_offset, line_bases, line_width) in zip(items, fai_items)]
+    two_bit_part = (records_path, two_bit_writer.contigs) if two_bit_valid else None
+    return items, fai_lines, two_bit_part
+
+
+def _dump_fasta_file_to_part(args):
+    """
+    Process fasta file by :py:func:`_dump_fasta_file` writing chunks to a new zip archive
+    in temporary folder, used by process pool.
+
+    :param args: tuple of path to fasta file and path to temporary folder
+    :type args: (str, str)
+    :return: result of :py:func:`_dump_fasta_file` and path to archive
+    :rtype: (list[list], list[str] | None, (str, list) | None, str)
+    """
+    file_name, temp_dir = args
+    fd, part_path = tempfile.mkstemp(suffix='.zip', dir=temp_dir)
+    os.close(fd)
+    # members are compressed in worker and copied to the result archive as is, see copy_zip_members
+    with zipfile.ZipFile(part_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as part:
+        result = _dump_fasta_file(file_name, part, temp_dir)
+    return result + (part_path,)
+
+
 def _handle_gtf_feature(contig, feature, genes):
     attribute_holder = feature.sub_features[0] if feature.sub_features else feature
     # all sub features belong to the same transcription => to the same gene
     features_list = feature.sub_features if feature.sub_features else [feature]
 
-    subfeatures = [SubFeature(int(subfeature.location.start),
-                              int(subfeature.location.end),
-                              subfeature.strand,
-                              subfeature.type) for subfeature in features_list]
+    subfeatures = SubFeatures.from_features(features_list)
 
     gene_name = get_qualifier(attribute_holder, 'gene_name')
     transcript_name = get_qualifier(attribute_holder, 'transcript_name')
@@ -43,8 +147,8 @@ def _handle_gtf_feature(contig, feature, genes):
               gene_id,
               transcript_name,
               transcript_id,
-              int(feature.location.start),
-              int(feature.location.end),
+              feature.start,
+              feature.end,
               subfeatures)
 
 
@@ -58,27 +162,53 @@ def _handle_gff3_feature(contig, feature, genes):
               gene_id,
               None,
               None,
-              int(feature.location.start),
-              int(feature.location.end),
+              feature.start,
+              feature.end,
               None)
     for sub_feature in feature.sub_features:
         transcript_id = get_qualifier(sub_feature, 'transcript_id') or get_qualifier(sub_feature, 'ID')
         transcript_name = get_qualifier(sub_feature, 'Name')
-        sub_sub_features = [SubFeature(int(subfeature.location.start),
-                                       int(subfeature.location.end),
-                                       subfeature.strand,
-                                       subfeature.type) for subfeature in sub_feature.sub_features]
+        sub_sub_features = SubFeatures.from_features(sub_feature.sub_features)
         genes.add(contig,
                   gene_name,
                   gene_id,
                   transcript_name,
                   transcript_id,
-                  int(sub_feature.location.start),
-                  int(sub_feature.location.end),
+                  sub_feature.start,
+                  sub_feature.end,
                   sub_sub_features)
 
 
+def _create_index_records(args):
+    """
+    Parse annotation lines of several contigs and create index records of their genes and transcripts.
+    Function is called in worker processes, so it is defined at module level.
+
+    :param args: tuple of list of (contig name, lines of this contig) and function that handles top level feature
+    :return: index records
+    :rtype: list[dict]
+    """
+    contigs_lines, handle_feature = args
+    # annotation features and gene model do not have reference cycles,
+    # garbage collector is paused to not traverse millions of their objects again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        records = []
+        for contig, lines in contigs_lines:
+            genes = GenesCollection()
+            for feature in parse_features(lines):
+                handle_feature(contig, feature, genes)
+            records.extend(ReferenceGenomeIndexer.create_index_records(genes))
+        return records
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
 class Gene(object):
+    __slots__ = ('name', 'contig', 'id', 'start', 'end', 'transcripts')
+
     def __init__(self):
         self.name = None
         self.transcripts = TranscriptsCollection()
@@ -100,8 +230,13 @@ class Gene(object):
 
 
 class GenesCollection(dict):
+    __slots__ = ()
+
     def add(self, contig, name, gene_id, transcript_name, transcript_id, start, end, subfeatures):
-        return self.setdefault(gene_id, Gene()).update(
+        gene = self.get(gene_id)
+        if gene is None:
+            gene = self[gene_id] = Gene()
+        return gene.update(
             contig, name, gene_id, transcript_name, transcript_id,
             start, end, subfeatures
         )
@@ -111,6 +246,8 @@ class GenesCollection(dict):
 
 
 class Transcript(object):
+    __slots__ = ('name', 'id', 'start', 'end', 'subfeatures')
+
     def __init__(self):
         self.name = None
 
@@ -130,13 +267,20 @@ class Transcript(object):
 
 
 class TranscriptsCollection(dict):
+    __slots__ = ()
+
     def add(self, name, transcript_id, start, end, subfeatures):
-        return self.setdefault(transcript_id, Transcript()).update(
+        transcript = self.get(transcript_id)
+        if transcript is None:
+            transcript = self[transcript_id] = Transcript()
+        return transcript.update(
             name, transcript_id, start, end, subfeatures
         )
 
 
 class SubFeature(object):
+    __slots__ = ('start', 'end', 'strand', 'kind')
+
     def __init__(self, start, end, strand, kind):
         self.start = start
         self.end = end
@@ -144,9 +288,79 @@ class SubFeature(object):
         self.kind = kind
 
 
+class SubFeatures(object):
+    """
+    Sub features of transcript (exons, CDS, etc.), stored in arrays instead of separate objects.
+    Iteration yields :py:class:`SubFeature` objects.
+    """
+    __slots__ = ('starts', 'ends', 'strands', 'kinds')
+
+    # key order is the same as json.dumps gives for subfeature dict
+    JSON_TEMPLATE = '{"start": %d, "kind": %s, "end": %d, "strand": %d}'
+
+    def __init__(self, starts=(), ends=(), strands=(), kinds=()):
+        self.starts = array('l', starts)
+        self.ends = array('l', ends)
+        self.strands = array('b', strands)
+        self.kinds = list(kinds)
+
+    @classmethod
+    def from_features(cls, features):
+        """
+        Create sub features from annotation features.
+
+        :param features: list of features
+        :type features: list[genestack.bio.reference_genome.annotation_parser.AnnotationFeature]
+        :rtype: SubFeatures
+        """
+        return cls([x.start for x in features],
+                   [x.end for x in features],
+                   [x.strand if x.strand is not None else 2 for x in features],
+                   [x.type for x in features])
+
+    def extend(self, other):
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.strands.extend(other.strands)
+        self.kinds.extend(other.kinds)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        for start, end, strand, kind in izip(self.starts, self.ends, self.strands, self.kinds):
+            yield SubFeature(start, end, strand, kind)
+
+    def to_json_list(self, encoded_kinds):
+        """
+        Encode each sub feature to JSON string.
+
+        :param encoded_kinds: cache of JSON-encoded kinds, is filled by this method
+        :type encoded_kinds: dict[str, str]
+        :rtype: list[str]
+        """
+        kinds = []
+        for kind in self.kinds:
+            encoded = encoded_kinds.get(kind)
+            if encoded is None:
+                encoded = encoded_kinds[kind] = json.dumps(kind)
+            kinds.append(encoded)
+        template = self.JSON_TEMPLATE
+        return [template % x for x in izip(self.starts, kinds, self.ends, self.strands)]
+
+
 class ReferenceGenomeIndexer:
     INDEX_FASTA_LOCATION = 'genestack.location:index_fasta'
     INDEX_FASTA_CACHE_LOCATION = 'genestack.location:index_fasta_cache'
+    INDEX_TWO_BIT_LOCATION = 'genestack.location:index_2bit'
+    INDEX_FAI_LOCATION = 'genestack.location:index_fai'
+
+    ANNOTATION_TASK_LINES = 100000  # minimal number of annotation lines parsed by one worker task
+    INDEXING_REQUESTS_IN_FLIGHT = 4
+    # Annotations are parsed by BCBio.GFF in this process until the streaming parser is checked
+    # to give the same features on Ensembl and GENCODE files,
+    # see genestack.bio.reference_genome.annotation_parser.compare_with_bcbio
+    USE_BCBIO_GFF = True
 
     TYPE_SUFFIXES = {
         'gene': '/G',
@@ -168,19 +382,14 @@ class ReferenceGenomeIndexer:
             os.makedirs(os.path.abspath(self.result_dir))
 
         self.result_fasta_contigs_index_path = os.path.join(self.result_dir, 'fasta.data')
-        self.result_fasta_cache_folder = os.path.join(self.result_dir, 'fasta.cache')
+        self.result_fasta_cache_archive = os.path.join(self.result_dir, 'fasta.cache.zip')
+        self.result_two_bit_path = os.path.join(self.result_dir, 'sequence.2bit')
+        self.result_fai_folder = os.path.join(self.result_dir, 'fasta.fai')
 
         # we ignore all contigs from annotation, that has no fasta file
         self.allowed_contigs = set()
 
-        if os.path.exists(self.result_fasta_cache_folder):
-            shutil.rmtree(self.result_fasta_cache_folder)
-        os.mkdir(self.result_fasta_cache_folder)
-
     def index_features(self, source_annotations_file_path):
-        # avoid crash then using pypy
-        import BCBio.GFF
-        source_annotations_file = open(source_annotations_file_path)
         annotation_format = determine_annotation_file_format(source_annotations_file_path)
 
         if annotation_format == GFF3:
@@ -190,16 +399,56 @@ class ReferenceGenomeIndexer:
         else:
             raise GenestackException('Annotation format is not supported: %s' % annotation_format)
 
-        # The parser will attempt to smartly break up the file at requested number of lines
-        # and would continue until the entire feature region is read.
-        # A nested coding feature: gene -> transcript -> CDS/exon/intron
-        current_contig = None
+        if self.USE_BCBIO_GFF:
+            self.__index_features_with_bcbio(source_annotations_file_path, handle_feature)
+            return
 
         annotation_contigs = set()  # all contigs from annotation
 
+        # Lines are grouped by contig in this process, contigs are parsed and converted to index records
+        # in worker processes, records are sent to the index by several concurrent requests,
+        # so reading, conversion and indexing of different contigs overlap.
+        # A nested coding feature: gene -> transcript -> CDS/exon/intron for GFF3,
+        # transcript -> CDS/exon/intron for GTF
+        processes = get_cpu_count()
+        pool = Pool(processes)
+        try:
+            with Indexer(self.genome, requests_in_flight=self.INDEXING_REQUESTS_IN_FLIGHT) as indexer:
+                pending = deque()
+                task = []
+                task_lines_count = 0
+                for contig, lines in read_contig_lines(source_annotations_file_path, self.allowed_contigs):
+                    annotation_contigs.add(contig)
+                    # lines are None if contig is not in self.allowed_contigs
+                    if lines is None:
+                        continue
+                    # small contigs are joined into one task
+                    task.append((contig, lines))
+                    task_lines_count += len(lines)
+                    if task_lines_count < self.ANNOTATION_TASK_LINES:
+                        continue
+                    if len(pending) >= 2 * processes:
+                        indexer.index_records(pending.popleft().get())
+                    pending.append(pool.apply_async(_create_index_records, [(task, handle_feature)]))
+                    task = []
+                    task_lines_count = 0
+                if task:
+                    pending.append(pool.apply_async(_create_index_records, [(task, handle_feature)]))
+                while pending:
+                    indexer.index_records(pending.popleft().get())
+                pool.close()
+                self.__check_annotation_contigs(annotation_contigs)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __index_features_with_bcbio(self, source_annotations_file_path, handle_feature):
+        current_contig = None
+        annotation_contigs = set()  # all contigs from annotation
+
         with Indexer(self.genome) as indexer:
-            for record in BCBio.GFF.parse(source_annotations_file, target_lines=2000):
-                contig = record.id
+            for contig, features in parse_annotation_with_bcbio(source_annotations_file_path,
+                                                                self.allowed_contigs):
                 annotation_contigs.add(contig)
                 if contig not in self.allowed_contigs:
                     continue
@@ -211,22 +460,24 @@ class ReferenceGenomeIndexer:
                     current_contig = contig
                     genes = GenesCollection()
 
-                # collect all genes and transcripts from the portion of GTF. First item always gene
-                for feature in record.features:
+                # collect all genes and transcripts from the portion of file. First item always gene
+                for feature in features:
                     handle_feature(contig, feature, genes)
             if current_contig:
                 indexer.index_records(self.create_index_records(genes))
-            if not annotation_contigs.intersection(self.allowed_contigs):
-                msg = ('Error: '
-                       'contig names from the genome sequence and annotation '
-                       'totally differ (have no common items)\n'
-                       'Contigs present in sequence: %s\n'
-                       'Contigs present in annotation: %s\n' % (
-                           truncate_sequence_str(self.allowed_contigs),
-                           truncate_sequence_str(annotation_contigs))
-                       )
-                sys.stderr.write(msg)
-
+            self.__check_annotation_contigs(annotation_contigs)
+
+    def __check_annotation_contigs(self, annotation_contigs):
+        if not annotation_contigs.intersection(self.allowed_contigs):
+            msg = ('Error: '
+                   'contig names from the genome sequence and annotation '
+                   'totally differ (have no common items)\n'
+                   'Contigs present in sequence: %s\n'
+                   'Contigs present in annotation: %s\n' % (
+                       truncate_sequence_str(self.allowed_contigs),
+                       truncate_sequence_str(annotation_contigs))
+                   )
+            sys.stderr.write(msg)
 
     @staticmethod
     def create_index_records(genes):
@@ -249,14 +500,10 @@ class ReferenceGenomeIndexer:
             return data
 
         feature_list = []
+        encoded_kinds = {}
         for g in genes.itervalues():
             for t in g.transcripts.itervalues():
-                subfeatures = [json.dumps({
-                    'kind': s.kind,
-                    'start': s.start,
-                    'end': s.end,
-                    'strand': s.strand
-                }) for s in t.subfeatures]
+                subfeatures = t.subfeatures.to_json_list(encoded_kinds)
 
                 feature_list.append(make_index_record(
                     t.id, t.name, g.contig, t.start, t.end, "transcript",
@@ -272,7 +519,12 @@ class ReferenceGenomeIndexer:
 
         A zip archive with files,
         which names are composed using a normalized contig name and a number starting from "0".
-        Each file contains 10000 nucleotides or less.
+        Each file contains 10000 nucleotides or less, files are written directly to the archive.
+        If there are several source files, they are processed in parallel by a process pool.
+
+        Also writes all sequences to a ``.2bit`` file (see :py:mod:`~genestack.bio.reference_genome.two_bit`)
+        and ``.fai`` index of every source file.
+        ``.2bit`` file is not created if some sequence name is longer than 255 characters.
 
         Fill list of contigs that will be use for annotation indexing.
 
@@ -281,34 +533,47 @@ class ReferenceGenomeIndexer:
         :return: None
         """
         items = []
-        fasta_dumper = FastaDumper(self.result_fasta_cache_folder)
-
-        for file_name in source_fasta_file_list:
-            offset = 0
-            with opener(file_name) as sequenceFile:
-                first = sequenceFile.read(1)
-                if first != '>':
-                    raise GenestackException('File "%s" is not a sequence file' % file_name)
+        archive_name = self.result_fasta_cache_archive
+        processes = min(len(source_fasta_file_list), get_cpu_count())
+        results = []
+
+        temp_dir = tempfile.mkdtemp(dir=self.result_dir)
+        try:
+            with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                if processes > 1:
+                    # files are processed in parallel, each into its own archive,
+                    # parts are merged in order of files, so result is the same as for sequential processing
+                    pool = Pool(processes)
+                    try:
+                        tasks = [(file_name, temp_dir) for file_name in source_fasta_file_list]
+                        for result in pool.imap(_dump_fasta_file_to_part, tasks):
+                            part_path = result[-1]
+                            with zipfile.ZipFile(part_path) as part:
+                                copy_zip_members(part, archive)
+                            os.remove(part_path)
+                            results.append(result[:-1])
+                        pool.close()
+                    finally:
+                        pool.terminate()
+                        pool.join()
                 else:
-                    sequenceFile.seek(0)
-
-                for line in sequenceFile:
-                    if line.startswith('>'):
-                        header = line[1:].split()
-                        name = header[0]
-                        offset += len(line)
-                        items.append([name, 0])
-                        self.allowed_contigs.add(name)
-                        fasta_dumper.set(normalize_contig_name(name))
-                    else:
-                        res = line.strip()
-                        items[-1][1] += len(res)
-                        fasta_dumper.add(res)
-        fasta_dumper.flush()
-
-        archive_name = self.result_fasta_cache_folder + '.zip'
-        cmd = ['zip', '-rjq', archive_name, self.result_fasta_cache_folder]
-        subprocess.check_call(cmd)
+                    for file_name in source_fasta_file_list:
+                        results.append(_dump_fasta_file(file_name, archive, temp_dir))
+            two_bit_parts = [two_bit_part for _, _, two_bit_part in results]
+            for file_name, two_bit_part in zip(source_fasta_file_list, two_bit_parts):
+                if two_bit_part is None:
+                    log_warning('Some sequence name in "%s" is longer than %s characters, '
+                                '.2bit file is not created' % (file_name, MAX_NAME_LENGTH))
+            two_bit_created = None not in two_bit_parts
+            if two_bit_created:
+                write_two_bit(self.result_two_bit_path, two_bit_parts)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.__write_fai_files(source_fasta_file_list, [fai_lines for _, fai_lines, _ in results])
+        for file_items, _, _ in results:
+            items.extend(file_items)
+        self.allowed_contigs.update(name for name, _ in items)
 
         items.sort(key=lambda x: x[0])
         dd = DumpData()
@@ -319,6 +584,38 @@ class ReferenceGenomeIndexer:
             dd.dump_to_file(fasta_dump_file)
         self.genome.PUT(self.INDEX_FASTA_CACHE_LOCATION, StorageUnit(archive_name))
         self.genome.PUT(self.INDEX_FASTA_LOCATION, StorageUnit(self.result_fasta_contigs_index_path))
+        if two_bit_created:
+            self.genome.PUT(self.INDEX_TWO_BIT_LOCATION, StorageUnit(self.result_two_bit_path))
+        self.genome.PUT(self.INDEX_FAI_LOCATION, StorageUnit(self.result_fai_folder))
+
+    def __write_fai_files(self, source_fasta_file_list, fai_lines_list):
+        """
+        Write ``.fai`` index of every source file to fai folder.
+        Index is named as decompressed source file with ``.fai`` extension.
+
+        :param source_fasta_file_list: list of source fasta file paths
+        :type source_fasta_file_list: list[str]
+        :param fai_lines_list: lines of ``.fai`` index of every file, ``None`` if index cannot be created
+        :type fai_lines_list: list[list[str] | None]
+        :return: None
+        """
+        if os.path.exists(self.result_fai_folder):
+            shutil.rmtree(self.result_fai_folder)
+        os.mkdir(self.result_fai_folder)
+        for index, (file_name, fai_lines) in enumerate(zip(source_fasta_file_list, fai_lines_list)):
+            if fai_lines is None:
+                log_warning('Lines of some sequence in "%s" have different lengths, '
+                            '.fai index is not created for this file' % file_name)
+                continue
+            base_name = os.path.basename(file_name)
+            for extension in ('.gz', '.bz2'):
+                if base_name.endswith(extension):
+                    base_name = base_name[:-len(extension)]
+            path = os.path.join(self.result_fai_folder, base_name + '.fai')
+            if os.path.exists(path):
+                path = os.path.join(self.result_fai_folder, '%s_%s.fai' % (index, base_name))
+            with open(path, 'w') as f:
+                f.writelines(fai_lines)
 
     def create_index(self, fasta_paths, annotation_path):
         annotation_format = determine_annotation_file_format(annotation_path)
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+"""
+Packed sequence store in the UCSC ``.2bit`` format.
+
+File layout (all numbers are little-endian):
+  - header: signature, version, number of sequences, reserved
+  - index: for each sequence its name length (1 byte), name and offset of its record
+    (4 bytes for version 0, 8 bytes for version 1 that is used for files larger than 4 Gb)
+  - records: sequence length, blocks of ``N`` bases, blocks of soft-masked (lower case) bases,
+    reserved field and bases packed by four in a byte (``T``, ``C``, ``A``, ``G`` as 0, 1, 2, 3,
+    the first base in the most significant bits)
+
+Any base other than ``ACGT`` is stored as ``N``.
+Packing and unpacking are done by string translation and integer conversion, without per-base Python code.
+"""
+
+import binascii
+import mmap
+import re
+import shutil
+import string
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from genestack.genestack_exceptions import GenestackException
+from genestack.utils import normalize_contig_name
+
+TWO_BIT_SIGNATURE = 0x1A412743
+
+HEADER_STRUCT = struct.Struct('<IIII')  # signature, version, sequence count, reserved
+RECORD_SIZE_STRUCT = struct.Struct('<II')  # sequence length, number of N blocks
+COUNT_STRUCT = struct.Struct('<I')
+
+_MAX_OFFSET_V0 = 0xFFFFFFFF
+
+MAX_NAME_LENGTH = 255  # name length is stored in a single byte
+
+# base -> base-4 digit, bases other than ACGT are packed as T
+_PACK_TABLE = string.maketrans('TCAGtcag' + ''.join(chr(x) for x in xrange(256) if chr(x) not in 'TCAGtcag'),
+                               '01230123' + '0' * 248)
+# hex digit of packed byte -> the first and the second base it encodes
+_HEX_DIGITS = '0123456789abcdef'
+_UNPACK_HIGH_TABLE = string.maketrans(_HEX_DIGITS, ''.join('TCAG'[int(x, 16) >> 2] for x in _HEX_DIGITS))
+_UNPACK_LOW_TABLE = string.maketrans(_HEX_DIGITS, ''.join('TCAG'[int(x, 16) & 3] for x in _HEX_DIGITS))
+
+_N_PATTERN = re.compile('[^ACGTacgt]+')
+_MASK_PATTERN = re.compile('[a-z]+')
+
+
+def _pack(digits):
+    """
+    Pack string of base-4 digits, its length must be divisible by 4.
+    """
+    if not digits:
+        return ''
+    return binascii.unhexlify('%0*x' % (len(digits) // 2, int(digits, 4)))
+
+
+def _unpack(packed):
+    """
+    Unpack bytes to bases, return bytearray with four bases per byte.
+    """
+    hex_digits = binascii.hexlify(packed)
+    bases = bytearray(len(hex_digits) * 2)
+    bases[0::2] = hex_digits.translate(_UNPACK_HIGH_TABLE)
+    bases[1::2] = hex_digits.translate(_UNPACK_LOW_TABLE)
+    return bases
+
+
+def _to_little_endian(values):
+    data = array('I', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tostring()
+
+
+def _from_little_endian(data):
+    values = array('I')
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class _Blocks(object):
+    """
+    Sorted non-overlapping blocks of sequence, adjacent blocks are merged.
+    """
+    def __init__(self):
+        self.starts = []
+        self.sizes = []
+
+    def add(self, start, end):
+        if self.starts and self.starts[-1] + self.sizes[-1] == start:
+            self.sizes[-1] += end - start
+        else:
+            self.starts.append(start)
+            self.sizes.append(end - start)
+
+    def to_binary(self):
+        return COUNT_STRUCT.pack(len(self.starts)) + _to_little_endian(self.starts) + _to_little_endian(self.sizes)
+
+
+class TwoBitRecordsWriter(object):
+    """
+    Writes ``.2bit`` sequence records to a file, one sequence at a time.
+    Records have to be combined into a ``.2bit`` file by :py:func:`write_two_bit`,
+    so that records written by several writers, e.g. in parallel, can be merged.
+
+    Bases of the current sequence are packed by chunks, packed bases are kept in memory
+    until the sequence is finished, because they follow the blocks in the record.
+    """
+    CHUNK_SIZE = 1 << 20  # number of bases packed at once
+
+    def __init__(self, path):
+        """
+        :param path: path to records file
+        :type path: str
+        """
+        self.path = path
+        self.contigs = []  # list of (name, offset, size) of written records
+        self.__file = open(path, 'wb')
+        self.__offset = 0
+        self.name = None
+
+    def set(self, name):
+        """
+        Finish current sequence and start a new one.
+
+        :param name: sequence name
+        :type name: str
+        :return: None
+        """
+        self.flush()
+        if len(name) > MAX_NAME_LENGTH:
+            raise GenestackException('Sequence name is too long for 2bit format: %s' % name)
+        self.name = name
+        self.__length = 0
+        self.__pending = []
+        self.__pending_size = 0
+        self.__carry = ''  # base-4 digits that do not fill a byte yet
+        self.__packed = []
+        self.__n_blocks = _Blocks()
+        self.__mask_blocks = _Blocks()
+
+    def add(self, text):
+        """
+        Add bases to the current sequence.
+
+        :param text: bases
+        :type text: str
+        :return: None
+        """
+        self.__pending.append(text)
+        self.__pending_size += len(text)
+        if self.__pending_size >= self.CHUNK_SIZE:
+            self.__pack_pending()
+
+    def __pack_pending(self):
+        chunk = ''.join(self.__pending)
+        self.__pending = []
+        self.__pending_size = 0
+        offset = self.__length
+        self.__length += len(chunk)
+        for match in _N_PATTERN.finditer(chunk):
+            self.__n_blocks.add(offset + match.start(), offset + match.end())
+        for match in _MASK_PATTERN.finditer(chunk):
+            self.__mask_blocks.add(offset + match.start(), offset + match.end())
+        digits = self.__carry + chunk.translate(_PACK_TABLE)
+        full_size = len(digits) - len(digits) % 4
+        self.__packed.append(_pack(digits[:full_size]))
+        self.__carry = digits[full_size:]
+
+    def flush(self):
+        """
+        Write record of the current sequence.
+
+        :return: None
+        """
+        if self.name is None:
+            return
+        self.__pack_pending()
+        if self.__carry:
+            self.__packed.append(_pack(self.__carry.ljust(4, '0')))
+        data = ''.join([
+            COUNT_STRUCT.pack(self.__length),
+            self.__n_blocks.to_binary(),
+            self.__mask_blocks.to_binary(),
+            COUNT_STRUCT.pack(0),
+        ] + self.__packed)
+        self.__file.write(data)
+        self.contigs.append((self.name, self.__offset, len(data)))
+        self.__offset += len(data)
+        self.name = None
+        self.__packed = None
+
+    def close(self):
+        self.flush()
+        self.__file.close()
+
+
+def write_two_bit(path, parts):
+    """
+    Write ``.2bit`` file from records written by :py:class:`TwoBitRecordsWriter`.
+
+    :param path: path to result file
+    :type path: str
+    :param parts: list of tuples (records file path, list of its records (name, offset, size)),
+                  records are written in the same order
+    :type parts: list[(str, list[(str, int, int)])]
+    :return: None
+    """
+    contigs = [contig for _, part_contigs in parts for contig in part_contigs]
+    data_size = sum(size for _, _, size in contigs)
+    version = 0
+    index_size = sum(1 + len(name) + 4 for name, _, _ in contigs)
+    if HEADER_STRUCT.size + index_size + data_size > _MAX_OFFSET_V0:
+        version = 1
+        index_size = sum(1 + len(name) + 8 for name, _, _ in contigs)
+    offset_format = '<I' if version == 0 else '<Q'
+
+    with open(path, 'wb') as f:
+        f.write(HEADER_STRUCT.pack(TWO_BIT_SIGNATURE, version, len(contigs), 0))
+        offset = HEADER_STRUCT.size + index_size
+        for name, _, size in contigs:
+            f.write(chr(len(name)) + name + struct.pack(offset_format, offset))
+            offset += size
+        for records_path, _ in parts:
+            with open(records_path, 'rb') as records:
+                shutil.copyfileobj(records, f)
+
+
+class TwoBitReader(object):
+    """
+    Reader of ``.2bit`` files. File is memory-mapped, fetch of a region reads only bytes of this region
+    and blocks of its sequence.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to ``.2bit`` file
+        :type path: str
+        """
+        self.path = path
+        self.__file = open(path, 'rb')
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count, _ = HEADER_STRUCT.unpack_from(self.__mmap)
+        if signature != TWO_BIT_SIGNATURE or version not in (0, 1):
+            self.close()
+            raise GenestackException('"%s" is not a 2bit file' % path)
+        offset_struct = struct.Struct('<I' if version == 0 else '<Q')
+        self.__offsets = {}
+        position = HEADER_STRUCT.size
+        for _ in xrange(count):
+            name_size = ord(self.__mmap[position])
+            name = self.__mmap[position + 1:position + 1 + name_size]
+            position += 1 + name_size
+            self.__offsets[name] = offset_struct.unpack_from(self.__mmap, position)[0]
+            position += offset_struct.size
+        self.__normalized_names = {normalize_contig_name(name): name for name in self.__offsets}
+        self.__records = {}
+
+    def __get_record(self, contig):
+        name = contig if contig in self.__offsets else self.__normalized_names.get(normalize_contig_name(contig))
+        if name is None:
+            raise GenestackException('Contig "%s" is not found in "%s"' % (contig, self.path))
+        record = self.__records.get(name)
+        if record is None:
+            position = self.__offsets[name]
+            length, n_count = RECORD_SIZE_STRUCT.unpack_from(self.__mmap, position)
+            position += RECORD_SIZE_STRUCT.size
+            n_blocks = self.__read_blocks(position, n_count)
+            position += 8 * n_count
+            mask_count = COUNT_STRUCT.unpack_from(self.__mmap, position)[0]
+            position += COUNT_STRUCT.size
+            mask_blocks = self.__read_blocks(position, mask_count)
+            position += 8 * mask_count + COUNT_STRUCT.size
+            record = self.__records[name] = length, n_blocks, mask_blocks, position
+        return record
+
+    def __read_blocks(self, position, count):
+        starts = _from_little_endian(self.__mmap[position:position + 4 * count])
+        sizes = _from_little_endian(self.__mmap[position + 4 * count:position + 8 * count])
+        return starts, array('L', [start + size for start, size in zip(starts, sizes)])
+
+    def get_contigs(self):
+        """
+        Return map from contig names into their lengths.
+
+        :rtype: dict[str, int]
+        """
+        return {name: self.__get_record(name)[0] for name in self.__offsets}
+
+    def fetch(self, contig, start, end):
+        """
+        Return bases of the region, soft-masked bases are in lower case.
+        Region is clipped to the contig bounds.
+
+        :param contig: contig name, as in source FASTA file or normalized
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :rtype: str
+        """
+        length, n_blocks, mask_blocks, dna_position = self.__get_record(contig)
+        start = max(0, start)
+        end = min(end, length)
+        if start >= end:
+            return ''
+        first_byte = start // 4
+        last_byte = (end + 3) // 4
+        bases = _unpack(self.__mmap[dna_position + first_byte:dna_position + last_byte])
+        shift = first_byte * 4
+        bases = bases[start - shift:end - shift]
+
+        for (block_starts, block_ends), replace in ((n_blocks, lambda x: 'N' * len(x)),
+                                                    (mask_blocks, lambda x: x.lower())):
+            for i in xrange(bisect_right(block_ends, start), bisect_left(block_starts, end)):
+                block_start = max(block_starts[i], start) - start
+                block_end = min(block_ends[i], end) - start
+                bases[block_start:block_end] = replace(bases[block_start:block_end])
+        return str(bases)
+
+    def close(self):
+        self.__mmap.close()
+        self.__file.close()
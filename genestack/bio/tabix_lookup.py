@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Local annotations lookup over BGZIP compressed and TABIX indexed database file.
+"""
+import os
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+
+from genestack.genestack_exceptions import GenestackException
+from genestack.utils import opener, normalize_contig_name
+
+
+class TabixAnnotationLookup(object):
+    """
+    Answers annotation queries from local copy of the database file.
+
+    Data file must be compressed with BGZIP and have TABIX index (``<data_path>.tbi``) built with
+    contig in the first column and position in the second one.
+    Column names are taken from the last header line (starting with ``#``)
+    and converted to typed keys with ``typed_key_getter``.
+    """
+    # queries closer to each other than this distance are fetched by a single request to the index
+    MERGE_DISTANCE = 10000
+
+    def __init__(self, data_path, typed_key_getter=None):
+        """
+        :param data_path: path to BGZIP compressed database file
+        :type data_path: str
+        :param typed_key_getter: function that converts column name to typed key,
+                                 if it returns ``None`` column name is used as is
+        :type typed_key_getter: (str) -> str | None
+        """
+        # avoid crash then using pypy
+        import pysam
+
+        if not os.path.exists(data_path + '.tbi'):
+            raise GenestackException('TABIX index is not found for "%s"' % data_path)
+        self.data_path = data_path
+        self.__tabix = pysam.Tabixfile(data_path)
+        self.__contigs = {normalize_contig_name(contig): contig for contig in self.__tabix.contigs}
+        self.keys = self.__read_keys(typed_key_getter)
+
+    def __read_keys(self, typed_key_getter):
+        header = None
+        with opener(self.data_path) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                header = line
+        if header is None:
+            return None
+        names = header.lstrip('#').rstrip('\r\n').split('\t')
+        if typed_key_getter is None:
+            return names
+        return [typed_key_getter(name) or name for name in names]
+
+    def __to_record(self, line):
+        fields = line.rstrip('\r\n').split('\t')
+        if self.keys is None:
+            return {str(index): value for index, value in enumerate(fields)}
+        return dict(zip(self.keys, fields))
+
+    def lookup(self, queries_list):
+        """
+        Return annotations for the specified intervals.
+
+        Queries are sorted and queries of the same contig that are close to each other
+        are fetched from the index by a single request and then distributed between queries.
+
+        :param queries_list: list of tuples (contig, position_from, position_to), positions are 1-based inclusive
+        :return: list of annotations, one item per query in the same order as queries,
+                 each item is a list of dicts that map typed key to value
+        :rtype: list[list[dict[str, str]]]
+        """
+        results = [[] for _ in queries_list]
+        order = sorted(xrange(len(queries_list)), key=lambda i: (queries_list[i][0], queries_list[i][1]))
+        for query_contig, indexes in groupby(order, key=lambda i: queries_list[i][0]):
+            contig = self.__contigs.get(normalize_contig_name(query_contig))
+            if contig is None:
+                continue
+            for batch in self.__split_to_batches([(i, queries_list[i]) for i in indexes]):
+                self.__sweep(contig, batch, results)
+        return results
+
+    def __split_to_batches(self, sorted_queries):
+        batch = []
+        batch_end = None
+        for index, query in sorted_queries:
+            if batch and query[1] - batch_end > self.MERGE_DISTANCE:
+                yield batch
+                batch = []
+            batch_end = query[2] if not batch else max(batch_end, query[2])
+            batch.append((index, query))
+        if batch:
+            yield batch
+
+    def __sweep(self, contig, batch, results):
+        batch_from = batch[0][1][1]
+        batch_to = max(query[2] for _, query in batch)
+
+        positions = []
+        lines = []
+        # tabix uses 0-based half-open intervals
+        for line in self.__tabix.fetch(contig, batch_from - 1, batch_to):
+            positions.append(int(line.split('\t', 2)[1]))
+            lines.append(line)
+
+        records = {}
+        for index, (_, position_from, position_to) in batch:
+            for line_index in xrange(bisect_left(positions, position_from), bisect_right(positions, position_to)):
+                record = records.get(line_index)
+                if record is None:
+                    record = records[line_index] = self.__to_record(lines[line_index])
+                results[index].append(record)
+
+    def close(self):
+        self.__tabix.close()
@@ -5,12 +5,13 @@ import sys
 
 import vcf
 
+from genestack.bgzf import BgzfReader
 from genestack.bio import bio_meta_keys
 from genestack.genestack_indexer import Indexer
 from genestack.genestack_exceptions import GenestackException
 from genestack.bio.reference_genome.reference_genome_file import ReferenceGenome
 from genestack.metainfo import StringValue, Metainfo
-from genestack.utils import normalize_contig_name
+from genestack.utils import normalize_contig_name, opener
 
 # FIXME find usages and remove this constants from here
 DATA_LINK = Metainfo.DATA_URL
@@ -265,6 +266,8 @@ class VariationIndexer(object):
     QUERY_CHUNK_SIZE = 100
 
     MAX_LINE_KEY = 'genestack.initialization:maxLine'
+    # "<line>:<virtual offset>" of the last indexed line of BGZF file, used to resume indexing without reading
+    MAX_LINE_OFFSET_KEY = 'genestack.initialization:maxLineOffset'
 
     def __init__(self, target_file, reference_genome=None):
         self.target_file = target_file
@@ -288,8 +291,29 @@ class VariationIndexer(object):
         except ValueError:
             return 0
 
-    def set_max_line(self, line_id):
+    def get_indexing_offset_from(self, line_from):
+        """
+        Return virtual offset of line ``line_from`` in BGZF file, if it was stored during previous indexing.
+
+        :param line_from: line returned by :py:meth:`get_indexing_line_from`
+        :type line_from: int
+        :return: virtual offset or ``None``
+        :rtype: int
+        """
+        value = self.target_file.get_metainfo().get_first_string(VariationIndexer.MAX_LINE_OFFSET_KEY)
+        if value is None:
+            return None
+        line_id, _, offset = value.partition(':')
+        try:
+            return int(offset) if int(line_id) == line_from else None
+        except ValueError:
+            return None
+
+    def set_max_line(self, line_id, offset=None):
         self.target_file.replace_metainfo_value(VariationIndexer.MAX_LINE_KEY, StringValue(str(line_id)))
+        if offset is not None:
+            self.target_file.replace_metainfo_value(VariationIndexer.MAX_LINE_OFFSET_KEY,
+                                                    StringValue('%d:%d' % (line_id, offset)))
 
     def iterate_features(self, vcf_reader, record_converter=None, line_from=0):
         """
@@ -337,6 +361,7 @@ class VariationIndexer(object):
                 self.raw_features = []
                 self.record_converter = record_converter
                 self.__last_feature_line_id = None
+                self.__last_feature_offset = None
 
             def __enter__(self):
                 set_initialization_version()
@@ -350,17 +375,23 @@ class VariationIndexer(object):
                 self.indexer.__exit__(exc_type, exc_val, exc_tb)
                 self.__inside_context = False
 
-            def index_record(self, line, record):
+            def index_record(self, line, record, offset=None):
                 if not self.record_converter:
                     raise GenestackException('Indexing record only possible if record converter is specified')
                 feature = self.record_converter.convert_record_to_feature(line, record)
-                self.index_feature(feature)
-
-            def index_feature(self, feature):
+                self.index_feature(feature, offset=offset)
+
+            def index_feature(self, feature, offset=None):
+                """
+                :param feature: feature
+                :param offset: virtual offset of the feature line in BGZF file, it is stored with indexing progress
+                :type offset: int
+                """
                 if not self.__inside_context:
                     raise GenestackException('RecordIndexer object must be used only inside a "with" statement')
                 self.raw_features.append(feature)
                 self.__last_feature_line_id = feature['line_l']
+                self.__last_feature_offset = offset
                 self.__flush()
 
             def __flush(self, force=False):
@@ -373,7 +404,7 @@ class VariationIndexer(object):
                 if len(self.features) > limit:
                     self.indexer.index_records(self.features)
                     self.features = []
-                    set_max_line(self.__last_feature_line_id)
+                    set_max_line(self.__last_feature_line_id, self.__last_feature_offset)
 
         return RecordIndexer(file_to_index, record_converter)
 
@@ -385,16 +416,40 @@ class VariationIndexer(object):
         and whole file will be indexing.  Then record is send to server it metainfo will be updated.
         Rerunning file in case of fail will proceed indexing from last point.
 
+        File can be compressed. For BGZF files (``.bgz`` extension) virtual offset of the last indexed line
+        is stored too, so indexing is resumed by seeking to this line instead of reading the file from start.
+
         :param file_name: existing name of vcf file
         :type file_name: str
         :return: None
         """
-        with open(file_name) as f, self.get_indexer(self.target_file, record_converter=None) as indexer:
-            vcf_reader = vcf.Reader(f)
+        line_from = self.get_indexing_line_from()
+        with opener(file_name) as f, self.get_indexer(self.target_file, record_converter=None) as indexer:
+            # file is decompressed by opener
+            vcf_reader = vcf.Reader(f, compressed=False)
             record_converter = RecordConverter(vcf_reader)
-            for line_id, feature in self.iterate_features(vcf_reader, record_converter=record_converter,
-                                                          line_from=self.get_indexing_line_from()):
-                indexer.index_feature(feature)
+            if not isinstance(f, BgzfReader):
+                for line_id, feature in self.iterate_features(vcf_reader, record_converter=record_converter,
+                                                              line_from=line_from):
+                    indexer.index_feature(feature)
+                return
+            self.__schema = record_converter.schema
+            offset = self.get_indexing_offset_from(line_from) if line_from else None
+            if offset is None:
+                line_id = 1
+            else:
+                f.seek(offset)
+                line_id = line_from
+            # header is parsed by vcf reader, then records are read line by line,
+            # so position before reading a record is the offset of its line
+            while True:
+                offset = f.tell()
+                record = next(vcf_reader, None)
+                if record is None:
+                    break
+                if line_id >= line_from:
+                    indexer.index_feature(record_converter.convert_record_to_feature(line_id, record), offset=offset)
+                line_id += 1
 
     def __set_initialization_version(self):
         """
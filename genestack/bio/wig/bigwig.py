@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+
+"""
+Conversion of WIG and bedGraph files to the bigWig format and reading of bigWig files.
+
+Files are written in the layout described in the bigWig specification
+(Kent et al., "BigWig and BigBed: enabling browsing of large distributed datasets"), version 4:
+  - header and total summary
+  - B+ tree that maps contig names to contig ids and sizes
+  - zlib compressed data sections of up to :py:attr:`BigWigConverter.ITEMS_PER_SLOT` items
+  - R-tree index of data sections
+
+Zoom levels are not written, so external tools fall back to the full data for summaries.
+All numbers are little-endian, positions are 0-based, ends are exclusive.
+"""
+
+import struct
+import tempfile
+import zlib
+
+from genestack.genestack_exceptions import GenestackException
+from genestack.utils import opener, normalize_contig_name
+from genestack.bio.wig.wig_indexer import FixedStep, read_steps, parse_int, parse_float
+
+BIGWIG_MAGIC = 0x888FFC26
+CHROM_TREE_MAGIC = 0x78CA8C91
+R_TREE_MAGIC = 0x2468ACE0
+BIGWIG_VERSION = 4
+
+HEADER_STRUCT = struct.Struct('<IHHQQQHHQQIQ')
+TOTAL_SUMMARY_STRUCT = struct.Struct('<Qdddd')  # bases covered, min, max, sum, sum of squares
+CHROM_TREE_HEADER_STRUCT = struct.Struct('<IIIIQQ')  # magic, block size, key size, value size, items, reserved
+NODE_HEADER_STRUCT = struct.Struct('<BBH')  # is leaf, reserved, number of items
+R_TREE_HEADER_STRUCT = struct.Struct('<IIQIIIIQII')
+R_TREE_LEAF_ITEM_STRUCT = struct.Struct('<IIIIQQ')  # start contig, start, end contig, end, offset, size
+R_TREE_NODE_ITEM_STRUCT = struct.Struct('<IIIIQ')  # start contig, start, end contig, end, child offset
+SECTION_HEADER_STRUCT = struct.Struct('<IIIIIBBH')  # contig, start, end, step, span, type, reserved, items
+SECTION_COUNT_STRUCT = struct.Struct('<Q')
+
+# section types
+BED_GRAPH_SECTION = 1
+VARIABLE_STEP_SECTION = 2
+FIXED_STEP_SECTION = 3
+
+# descriptions of numpy dtypes, numpy is imported by the methods that use it
+# to avoid crash then using pypy
+BED_GRAPH_ITEM_DTYPE = [('start', '<u4'), ('end', '<u4'), ('value', '<f4')]
+VARIABLE_STEP_ITEM_DTYPE = [('start', '<u4'), ('value', '<f4')]
+FIXED_STEP_ITEM_DTYPE = '<f4'
+
+_MAX_POSITION = 0xFFFFFFFF
+
+
+def _tree_levels(items_count, block_size):
+    """
+    Return number of items at every level of the tree, from leaves to root.
+    """
+    counts = [items_count]
+    while counts[-1] > block_size:
+        counts.append((counts[-1] + block_size - 1) // block_size)
+    return counts
+
+
+class _Section(object):
+    """
+    Description of the data section stored in the temporary file before the final layout is written.
+    """
+    __slots__ = ('contig', 'start', 'end', 'item_step', 'item_span', 'section_type', 'count', 'offset', 'size')
+
+    def __init__(self, contig, start, end, item_step, item_span, section_type, count, offset, size):
+        self.contig = contig
+        self.start = start
+        self.end = end
+        self.item_step = item_step
+        self.item_span = item_span
+        self.section_type = section_type
+        self.count = count
+        self.offset = offset
+        self.size = size
+
+
+class BigWigConverter(object):
+    """
+    Converts WIG and bedGraph files to bigWig.
+
+    Input is read in a single pass, items of data sections are kept in a temporary file
+    until all contigs are known, so memory usage does not depend on the file size.
+    Sections are sorted by contig and start in the result file, but items inside a section
+    must be in ascending order, as in the source file.
+    """
+    ITEMS_PER_SLOT = 1024  # maximum number of items in a data section
+    BLOCK_SIZE = 256  # maximum number of items in a node of B+ tree and R-tree
+
+    def __init__(self, output_path, chrom_sizes=None, temp_dir=None):
+        """
+        :param output_path: path to the result bigWig file
+        :type output_path: str
+        :param chrom_sizes: sizes of contigs by their names in the source file (normalized names are also accepted),
+                            by default the end of the last item of the contig is used
+        :type chrom_sizes: dict[str, int]
+        :param temp_dir: folder for the temporary file
+        :type temp_dir: str
+        """
+        self.output_path = output_path
+        self.chrom_sizes = dict(chrom_sizes or {})
+        self.__normalized_chrom_sizes = {normalize_contig_name(k): v for k, v in self.chrom_sizes.iteritems()}
+        self.temp_dir = temp_dir
+        self.__sections = []
+        self.__contig_ends = {}
+        self.__max_section_size = 0
+        self.__summary = [0, float('inf'), float('-inf'), 0.0, 0.0]
+        self.__temp_file = None
+        self.__temp_offset = 0
+
+    def convert_wig(self, source_wig_file, track_number=0):
+        """
+        Convert single track of the WIG file.
+
+        :param source_wig_file: path to WIG file, can be compressed
+        :type source_wig_file: str
+        :param track_number: number of the track to convert, starting from 0
+        :type track_number: int
+        :return: None
+        """
+        import numpy as np
+        self.__open()
+        try:
+            for step in read_steps(source_wig_file, [], self.ITEMS_PER_SLOT):
+                if step.track_number != track_number:
+                    continue
+                positions, values = step.get_positions_and_values()
+                values = np.array(values, dtype=FIXED_STEP_ITEM_DTYPE)
+                if isinstance(step, FixedStep):
+                    start, end = step.get_start(), step.get_end()
+                    self.__check_range(start, end)
+                    self.__add_section(step.params['chrom'], FIXED_STEP_SECTION, start, end,
+                                       step.step, step.span, values)
+                else:
+                    items = np.zeros(len(positions), dtype=VARIABLE_STEP_ITEM_DTYPE)
+                    starts = np.array(positions, dtype=np.int64)
+                    self.__check_positions(starts, starts + step.span)
+                    items['start'] = starts
+                    items['value'] = values
+                    self.__add_section(step.params['chrom'], VARIABLE_STEP_SECTION, step.get_start(), step.get_end(),
+                                       0, step.span, items)
+            self.__write()
+        finally:
+            self.__close()
+
+    def convert_bed_graph(self, source_bed_graph_file):
+        """
+        Convert bedGraph file, lines of the same contig must be sorted by start.
+
+        :param source_bed_graph_file: path to bedGraph file, can be compressed
+        :type source_bed_graph_file: str
+        :return: None
+        """
+        self.__open()
+        try:
+            contig = None
+            lines = []
+            with opener(source_bed_graph_file) as f:
+                for line in f:
+                    if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                        continue
+                    fields = line.split()
+                    if len(fields) != 4:
+                        raise GenestackException('bedGraph line should have four fields: %s' % line.strip())
+                    line_contig = fields[0]
+                    if lines and (line_contig != contig or len(lines) >= self.ITEMS_PER_SLOT):
+                        self.__add_bed_graph_section(contig, lines)
+                        lines = []
+                    contig = line_contig
+                    lines.append(fields)
+            if lines:
+                self.__add_bed_graph_section(contig, lines)
+            self.__write()
+        finally:
+            self.__close()
+
+    def __add_bed_graph_section(self, contig, lines):
+        import numpy as np
+        items = np.zeros(len(lines), dtype=BED_GRAPH_ITEM_DTYPE)
+        starts = np.array([parse_int(x[1]) for x in lines], dtype=np.int64)
+        ends = np.array([parse_int(x[2]) for x in lines], dtype=np.int64)
+        self.__check_positions(starts, ends)
+        items['start'] = starts
+        items['end'] = ends
+        items['value'] = [parse_float(x[3]) for x in lines]
+        self.__add_section(contig, BED_GRAPH_SECTION, int(starts[0]), int(ends.max()), 0, 0, items)
+
+    @staticmethod
+    def __check_range(start, end):
+        """
+        Check that section bounds fit unsigned 32-bit integers of bigWig format.
+        """
+        if start < 0 or end > _MAX_POSITION:
+            raise GenestackException('Positions should be in range from 1 to %s' % _MAX_POSITION)
+
+    @staticmethod
+    def __check_positions(starts, ends):
+        import numpy as np
+        BigWigConverter.__check_range(int(starts[0]), int(ends.max()))
+        if np.any(ends <= starts):
+            raise GenestackException('End of interval should be greater than start')
+        if np.any(starts[1:] < starts[:-1]):
+            raise GenestackException('All positions specified in the input data must be in ascending order')
+
+    def __open(self):
+        self.__sections = []
+        self.__contig_ends = {}
+        self.__max_section_size = 0
+        self.__summary = [0, float('inf'), float('-inf'), 0.0, 0.0]
+        self.__temp_file = tempfile.TemporaryFile(dir=self.temp_dir)
+        self.__temp_offset = 0
+
+    def __close(self):
+        if self.__temp_file is not None:
+            self.__temp_file.close()
+            self.__temp_file = None
+
+    def __add_section(self, contig, section_type, start, end, item_step, item_span, items):
+        """
+        Store items of the section to temporary file and update the total summary.
+        """
+        import numpy as np
+        if section_type == FIXED_STEP_SECTION:
+            values = items.astype(np.float64)
+            # if span is greater than step, items are overlapped by the next ones
+            bases = np.full(len(items), min(item_step, item_span), dtype=np.int64)
+            bases[-1] = item_span
+        elif section_type == VARIABLE_STEP_SECTION:
+            values = items['value'].astype(np.float64)
+            starts = items['start'].astype(np.int64)
+            bases = np.minimum(np.append(starts[1:], starts[-1] + item_span), starts + item_span) - starts
+        else:
+            values = items['value'].astype(np.float64)
+            bases = items['end'].astype(np.int64) - items['start']
+        summary = self.__summary
+        summary[0] += int(bases.sum())
+        summary[1] = min(summary[1], float(values.min()))
+        summary[2] = max(summary[2], float(values.max()))
+        summary[3] += float(np.sum(values * bases))
+        summary[4] += float(np.sum(values * values * bases))
+
+        data = items.tostring()
+        self.__temp_file.write(data)
+        self.__sections.append(_Section(contig, start, end, item_step, item_span, section_type,
+                                        len(items), self.__temp_offset, len(data)))
+        self.__temp_offset += len(data)
+        self.__contig_ends[contig] = max(self.__contig_ends.get(contig, 0), end)
+        self.__max_section_size = max(self.__max_section_size, SECTION_HEADER_STRUCT.size + len(data))
+
+    def __write(self):
+        contigs = sorted(self.__contig_ends)
+        contig_ids = {contig: i for i, contig in enumerate(contigs)}
+        sections = sorted(self.__sections, key=lambda x: (contig_ids[x.contig], x.start))
+        self.__temp_file.flush()
+
+        with open(self.output_path, 'wb') as f:
+            f.write('\0' * HEADER_STRUCT.size)
+
+            total_summary_offset = f.tell()
+            bases_covered, min_value, max_value, sum_data, sum_squares = self.__summary
+            if not bases_covered:
+                min_value = max_value = 0.0
+            f.write(TOTAL_SUMMARY_STRUCT.pack(bases_covered, min_value, max_value, sum_data, sum_squares))
+
+            chrom_tree_offset = f.tell()
+            self.__write_chrom_tree(f, contigs)
+
+            full_data_offset = f.tell()
+            f.write(SECTION_COUNT_STRUCT.pack(len(sections)))
+            blocks = []
+            for section in sections:
+                self.__temp_file.seek(section.offset)
+                data = SECTION_HEADER_STRUCT.pack(
+                    contig_ids[section.contig], section.start, section.end, section.item_step,
+                    section.item_span, section.section_type, 0, section.count
+                ) + self.__temp_file.read(section.size)
+                offset = f.tell()
+                f.write(zlib.compress(data))
+                blocks.append((contig_ids[section.contig], section.start, section.end, offset, f.tell() - offset))
+
+            full_index_offset = f.tell()
+            self.__write_r_tree(f, blocks, full_index_offset)
+
+            f.seek(0)
+            f.write(HEADER_STRUCT.pack(
+                BIGWIG_MAGIC, BIGWIG_VERSION, 0, chrom_tree_offset, full_data_offset, full_index_offset,
+                0, 0, 0, total_summary_offset, self.__max_section_size, 0
+            ))
+
+    def __get_chrom_size(self, contig):
+        size = self.chrom_sizes.get(contig)
+        if size is None:
+            size = self.__normalized_chrom_sizes.get(normalize_contig_name(contig), self.__contig_ends[contig])
+        return size
+
+    def __write_chrom_tree(self, f, contigs):
+        block_size = max(1, min(self.BLOCK_SIZE, len(contigs)))
+        key_size = max([1] + [len(x) for x in contigs])
+        f.write(CHROM_TREE_HEADER_STRUCT.pack(CHROM_TREE_MAGIC, block_size, key_size, 8, len(contigs), 0))
+        item_size = key_size + 8
+        node_size = NODE_HEADER_STRUCT.size + block_size * item_size
+
+        levels = _tree_levels(len(contigs), block_size)
+        # offsets of the first node of each level, the root is written first
+        level_offsets = [0] * len(levels)
+        offset = f.tell()
+        for level in reversed(xrange(len(levels))):
+            level_offsets[level] = offset
+            offset += (levels[level] + block_size - 1) // block_size * node_size or node_size
+
+        for level in reversed(xrange(len(levels))):
+            items_count = levels[level]
+            for node_start in xrange(0, max(items_count, 1), block_size):
+                count = min(block_size, items_count - node_start)
+                data = [NODE_HEADER_STRUCT.pack(1 if level == 0 else 0, 0, count)]
+                for i in xrange(node_start, node_start + count):
+                    if level == 0:
+                        contig = contigs[i]
+                        size = min(self.__get_chrom_size(contig), _MAX_POSITION)
+                        data.append(contig.ljust(key_size, '\0') + struct.pack('<II', i, size))
+                    else:
+                        key = contigs[i * block_size ** level]
+                        child_offset = level_offsets[level - 1] + i * node_size
+                        data.append(key.ljust(key_size, '\0') + struct.pack('<Q', child_offset))
+                data.append('\0' * (block_size - count) * item_size)
+                f.write(''.join(data))
+
+    def __write_r_tree(self, f, blocks, index_offset):
+        block_size = self.BLOCK_SIZE
+        levels = _tree_levels(len(blocks), block_size)
+        leaf_node_size = NODE_HEADER_STRUCT.size + block_size * R_TREE_LEAF_ITEM_STRUCT.size
+        node_size = NODE_HEADER_STRUCT.size + block_size * R_TREE_NODE_ITEM_STRUCT.size
+
+        # bounds[level][i] are bounds of the i-th item of the level: (start contig, start, end contig, end)
+        bounds = [[(contig, start, contig, end) for contig, start, end, _, _ in blocks]]
+        for _ in xrange(1, len(levels)):
+            children = bounds[-1]
+            bounds.append([
+                children[i][:2] + max(x[2:] for x in children[i:i + block_size])
+                for i in xrange(0, len(children), block_size)
+            ])
+
+        level_offsets = [0] * len(levels)
+        offset = index_offset + R_TREE_HEADER_STRUCT.size
+        for level in reversed(xrange(len(levels))):
+            level_offsets[level] = offset
+            nodes_count = max(1, (levels[level] + block_size - 1) // block_size)
+            offset += nodes_count * (leaf_node_size if level == 0 else node_size)
+
+        if blocks:
+            start_bounds = blocks[0][:2]
+            end_bounds = max((contig, end) for contig, _, end, _, _ in blocks)
+        else:
+            start_bounds = end_bounds = (0, 0)
+        f.write(R_TREE_HEADER_STRUCT.pack(R_TREE_MAGIC, block_size, len(blocks), start_bounds[0], start_bounds[1],
+                                          end_bounds[0], end_bounds[1], index_offset, self.ITEMS_PER_SLOT, 0))
+
+        for level in reversed(xrange(len(levels))):
+            items_count = levels[level]
+            for node_start in xrange(0, max(items_count, 1), block_size):
+                count = min(block_size, items_count - node_start)
+                data = [NODE_HEADER_STRUCT.pack(1 if level == 0 else 0, 0, count)]
+                for i in xrange(node_start, node_start + count):
+                    if level == 0:
+                        contig, start, end, block_offset, block_length = blocks[i]
+                        data.append(R_TREE_LEAF_ITEM_STRUCT.pack(contig, start, contig, end,
+                                                                 block_offset, block_length))
+                    else:
+                        child_offset = level_offsets[level - 1] + i * (leaf_node_size if level == 1 else node_size)
+                        data.append(R_TREE_NODE_ITEM_STRUCT.pack(*(bounds[level][i] + (child_offset,))))
+                item_size = R_TREE_LEAF_ITEM_STRUCT.size if level == 0 else R_TREE_NODE_ITEM_STRUCT.size
+                data.append('\0' * (block_size - count) * item_size)
+                f.write(''.join(data))
+
+
+class BigWigReader(object):
+    """
+    Reader of bigWig files.
+
+    Only data sections that overlap the requested region are read and decompressed,
+    items are returned as numpy arrays.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to bigWig file
+        :type path: str
+        """
+        self.path = path
+        self.__file = open(path, 'rb')
+        (magic, version, _, self.__chrom_tree_offset, _, self.__full_index_offset,
+         _, _, _, self.__total_summary_offset, self.__uncompress_buf_size, _) = HEADER_STRUCT.unpack(
+            self.__file.read(HEADER_STRUCT.size))
+        if magic != BIGWIG_MAGIC:
+            self.close()
+            raise GenestackException('"%s" is not a little-endian bigWig file' % path)
+        self.contigs = self.__read_chrom_tree()  # name -> (id, size)
+        # names are stored as in the source file, normalized names are used only for lookup
+        self.__normalized_contigs = {normalize_contig_name(name): name for name in self.contigs}
+
+    def __read(self, offset, size):
+        self.__file.seek(offset)
+        return self.__file.read(size)
+
+    def __read_chrom_tree(self):
+        magic, block_size, key_size, value_size, _, _ = CHROM_TREE_HEADER_STRUCT.unpack(
+            self.__read(self.__chrom_tree_offset, CHROM_TREE_HEADER_STRUCT.size))
+        if magic != CHROM_TREE_MAGIC:
+            raise GenestackException('Invalid contigs tree in "%s"' % self.path)
+        contigs = {}
+        nodes = [self.__chrom_tree_offset + CHROM_TREE_HEADER_STRUCT.size]
+        while nodes:
+            offset = nodes.pop()
+            is_leaf, _, count = NODE_HEADER_STRUCT.unpack(self.__read(offset, NODE_HEADER_STRUCT.size))
+            data = self.__file.read(count * (key_size + value_size))
+            for i in xrange(count):
+                item = data[i * (key_size + value_size):(i + 1) * (key_size + value_size)]
+                if is_leaf:
+                    contig_id, size = struct.unpack('<II', item[key_size:key_size + 8])
+                    contigs[item[:key_size].rstrip('\0')] = (contig_id, size)
+                else:
+                    nodes.append(struct.unpack('<Q', item[key_size:key_size + 8])[0])
+        return contigs
+
+    def get_summary(self):
+        """
+        Return summary of the whole file.
+
+        :return: tuple (bases covered, min, max, sum, sum of squares)
+        :rtype: (int, float, float, float, float)
+        """
+        return TOTAL_SUMMARY_STRUCT.unpack(self.__read(self.__total_summary_offset, TOTAL_SUMMARY_STRUCT.size))
+
+    def __find_blocks(self, contig_id, start, end):
+        blocks = []
+        nodes = [self.__full_index_offset + R_TREE_HEADER_STRUCT.size]
+        while nodes:
+            offset = nodes.pop()
+            is_leaf, _, count = NODE_HEADER_STRUCT.unpack(self.__read(offset, NODE_HEADER_STRUCT.size))
+            item_struct = R_TREE_LEAF_ITEM_STRUCT if is_leaf else R_TREE_NODE_ITEM_STRUCT
+            data = self.__file.read(count * item_struct.size)
+            for i in xrange(count):
+                item = item_struct.unpack_from(data, i * item_struct.size)
+                if (item[0], item[1]) < (contig_id, end) and (item[2], item[3]) > (contig_id, start):
+                    if is_leaf:
+                        blocks.append((item[4], item[5]))
+                    else:
+                        nodes.append(item[4])
+        blocks.sort()
+        return blocks
+
+    def __iter_sections(self, contig_id, start, end):
+        import numpy as np
+        for offset, size in self.__find_blocks(contig_id, start, end):
+            data = self.__read(offset, size)
+            if self.__uncompress_buf_size:
+                data = zlib.decompress(data)
+            (section_contig, section_start, _, item_step, item_span,
+             section_type, _, count) = SECTION_HEADER_STRUCT.unpack_from(data)
+            if section_contig != contig_id:
+                continue
+            buf = data[SECTION_HEADER_STRUCT.size:]
+            if section_type == BED_GRAPH_SECTION:
+                items = np.frombuffer(buf, dtype=BED_GRAPH_ITEM_DTYPE, count=count)
+                starts, ends, values = items['start'], items['end'], items['value']
+            elif section_type == VARIABLE_STEP_SECTION:
+                items = np.frombuffer(buf, dtype=VARIABLE_STEP_ITEM_DTYPE, count=count)
+                starts, values = items['start'], items['value']
+                ends = starts + item_span
+            elif section_type == FIXED_STEP_SECTION:
+                values = np.frombuffer(buf, dtype=FIXED_STEP_ITEM_DTYPE, count=count)
+                starts = section_start + np.arange(count, dtype=np.int64) * item_step
+                ends = starts + item_span
+            else:
+                raise GenestackException('Unknown section type %s in "%s"' % (section_type, self.path))
+            yield starts.astype(np.int64), ends.astype(np.int64), values.astype(np.float64)
+
+    def fetch(self, contig, start, end):
+        """
+        Return items that overlap the region.
+
+        :param contig: contig name as in the source file or normalized contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :return: tuple of numpy arrays (starts, ends, values) sorted by start
+        :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        """
+        import numpy as np
+        result = ([], [], [])
+        contig_info = self.contigs.get(contig)
+        if contig_info is None:
+            contig_info = self.contigs.get(self.__normalized_contigs.get(normalize_contig_name(contig)))
+        if contig_info is not None:
+            for starts, ends, values in self.__iter_sections(contig_info[0], start, end):
+                mask = (starts < end) & (ends > start)
+                for parts, array in zip(result, (starts, ends, values)):
+                    parts.append(array[mask])
+        if not result[0]:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        starts, ends, values = [np.concatenate(x) for x in result]
+        order = np.argsort(starts, kind='mergesort')
+        return starts[order], ends[order], values[order]
+
+    def values(self, contig, start, end):
+        """
+        Return value of every base of the region, bases without data have ``nan`` value.
+
+        :param contig: contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :rtype: numpy.ndarray
+        """
+        import numpy as np
+        result = np.full(end - start, np.nan)
+        starts, ends, values = self.fetch(contig, start, end)
+        for item_start, item_end, value in zip(np.maximum(starts, start) - start,
+                                               np.minimum(ends, end) - start, values):
+            result[item_start:item_end] = value
+        return result
+
+    def close(self):
+        self.__file.close()
@@ -1,20 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import os
+import re
 import shlex
+import struct
 
 from genestack.frontend_object import StorageUnit
 from genestack.genestack_exceptions import GenestackException
-from genestack.utils import opener, DumpData, normalize_contig_name
+from genestack.utils import opener, normalize_contig_name
 
 # this constants should be same as in java code
 VARIABLE_STEP = 1
 FIXED_STEP = 2
 
+# binary layout of steps, all numbers are big-endian
+STEP_HEADER_STRUCT = struct.Struct('>BIII')  # step type, span, track number, number of items
+FIXED_STEP_START_STRUCT = struct.Struct('>QI')  # start, step
+INDEX_ITEM_STRUCT = struct.Struct('>QQQI')  # start, end, offset, size
+
+# descriptions of numpy dtypes, numpy is imported by the functions that use it
+# to avoid crash then using pypy
+VARIABLE_STEP_ITEM_DTYPE = [('position', '>u8'), ('value', '>f4')]
+FIXED_STEP_ITEM_DTYPE = '>f4'
+
+# decimal number that is parsed in the same way by numpy and by parse_float
+_FLOAT = r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+_FLOAT_PATTERN = re.compile(_FLOAT + r'\Z')
+# data line of variable step with position that can be parsed by parse_int
+_VARIABLE_STEP_LINE_PATTERN = re.compile(r'[+-]?\d+ ' + _FLOAT + r'\Z')
+
+_INT_MASK = 0xFFFFFFFF
+_LONG_MASK = 0xFFFFFFFFFFFFFFFF
+
 
 def parse_line_params(text):
     res = {}
-    items = shlex.split(text)
+    # shlex is slow, it is used only if values can be quoted or escaped
+    if '"' in text or "'" in text or '\\' in text:
+        items = shlex.split(text)
+    else:
+        items = text.split()
     for item in items:
         item_split = item.split('=', 1)
         if len(item_split) == 2:
@@ -36,6 +62,53 @@ def parse_int(text):
         raise GenestackException('Cannot parse value "%s" to int' % text)
 
 
+def parse_floats(items):
+    """
+    Parse list of strings to array of floats at once.
+    If some item is not a single decimal number, items are parsed one by one,
+    so that values like ``nan`` are accepted and the invalid item is reported.
+
+    :param items: list of strings
+    :type items: list[str]
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+    if all(_FLOAT_PATTERN.match(item) for item in items):
+        values = np.fromstring(' '.join(items), dtype=np.float64, sep=' ')
+        if len(values) == len(items):
+            return values
+    return np.array([parse_float(item) for item in items], dtype=np.float64)
+
+
+def parse_variable_step_items(lines):
+    """
+    Parse data lines of variable step at once.
+    If some line is invalid, lines are parsed one by one to report the invalid one.
+
+    :param lines: data lines, each line is position and value separated by space
+    :type lines: list[str]
+    :return: tuple of arrays: 0-based positions and values
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    import numpy as np
+    numbers = np.fromstring(' '.join(lines), dtype=np.float64, sep=' ')
+    # positions like "1e3" or "10.0" are parsed by numpy but rejected by parse_int
+    # and values like "nan" are accepted by parse_float only
+    if len(numbers) == 2 * len(lines) and all(_VARIABLE_STEP_LINE_PATTERN.match(line) for line in lines):
+        return numbers[0::2].astype(np.int64) - 1, numbers[1::2]
+
+    positions = []
+    values = []
+    for line in lines:
+        try:
+            pos, score = line.split(' ')
+        except ValueError:
+            raise GenestackException('Line should have two fields: %s' % line)
+        positions.append(parse_int(pos) - 1)
+        values.append(parse_float(score))
+    return np.array(positions, dtype=np.int64), np.array(values, dtype=np.float64)
+
+
 class Step(object):
     step_type = None
 
@@ -68,33 +141,92 @@ class Step(object):
         dd.put_int(self.track_number)
         dd.put_int(len(self.items))
 
+    def _header_to_binary(self):
+        return STEP_HEADER_STRUCT.pack(self.step_type, self.span & _INT_MASK,
+                                       self.track_number & _INT_MASK, len(self.items))
+
+    def to_binary(self):
+        """
+        Return binary representation of the step, same as written by :py:meth:`add_dump_data`.
+
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+    def get_positions_and_values(self):
+        """
+        Return lists of 0-based positions and corresponding values.
+
+        :rtype: (list[int], list[float])
+        """
+        raise NotImplementedError()
+
+    def next_chunk(self):
+        """
+        Return empty step that continues this one, it is used to split long steps into chunks.
+
+        :rtype: Step
+        """
+        step = copy.copy(self)
+        step.items = []
+        return step
+
 
 class VariableStep(Step):
+    """
+    Step with positions in data lines.
+    Data lines are stored as is and parsed at once by :py:func:`parse_variable_step_items` when they are needed.
+    """
     step_type = VARIABLE_STEP
 
-    def update(self, line):
-        try:
-            pos, score = line.split(' ')
-        except ValueError:
-            raise GenestackException('Line should have two fields: %s' % line)
-
-        self.items.append((parse_int(pos) - 1, parse_float(score)))
+    def __init__(self, line, track_number):
+        super(VariableStep, self).__init__(line, track_number)
+        self.min_start = 0  # positions must be ascending across all chunks of the step
+        self.positions = None  # parsed items
+        self.values = None
+
+    def __parse(self):
+        if self.positions is None or len(self.positions) != len(self.items):
+            self.positions, self.values = parse_variable_step_items(self.items)
+        return self.positions, self.values
+
+    def __check_order(self):
+        import numpy as np
+        positions, _ = self.__parse()
+        if positions[0] < self.min_start or np.any(positions[1:] < positions[:-1]):
+            raise GenestackException('All positions specified in the input data must be in ascending order')
+        self.min_start = positions[-1]
 
     def add_dump_data(self, dd):
         super(VariableStep, self).add_dump_data(dd)
-        min_start = 0
-        for pos, val in self.items:
-            if pos < min_start:
-                raise GenestackException('All positions specified in the input data must be in ascending order')
-            min_start = pos
-            dd.put_long(pos)
-            dd.put_float(val)
+        self.__check_order()
+        for pos, val in zip(*self.__parse()):
+            dd.put_long(int(pos))
+            dd.put_float(float(val))
+
+    def to_binary(self):
+        import numpy as np
+        self.__check_order()
+        positions, values = self.__parse()
+        items = np.zeros(len(positions), dtype=VARIABLE_STEP_ITEM_DTYPE)
+        items['position'] = positions.view(np.uint64)
+        items['value'] = values
+        return self._header_to_binary() + items.tostring()
+
+    def get_positions_and_values(self):
+        return self.__parse()
+
+    def next_chunk(self):
+        step = super(VariableStep, self).next_chunk()
+        step.positions = None
+        step.values = None
+        return step
 
     def get_start(self):
-        return self.items[0][0]
+        return int(self.__parse()[0][0])
 
     def get_end(self):
-        return self.items[-1][0] + self.span
+        return int(self.__parse()[0][-1]) + self.span
 
 
 class FixedStep(Step):
@@ -104,6 +236,7 @@ class FixedStep(Step):
         super(FixedStep, self).__init__(line, track_number)
         self.set_step()
         self.set_start()
+        self.values = None  # parsed items
 
     def set_step(self):
         step = self.params.get('step')
@@ -127,8 +260,32 @@ class FixedStep(Step):
         super(FixedStep, self).add_dump_data(dd)
         dd.put_long(self.get_start())
         dd.put_int(self.step)
-        for item in self.items:
-            dd.put_float(parse_float(item))
+        for value in self.__get_values():
+            dd.put_float(float(value))
+
+    def __get_values(self):
+        if self.values is None or len(self.values) != len(self.items):
+            self.values = parse_floats(self.items)
+        return self.values
+
+    def to_binary(self):
+        import numpy as np
+        return ''.join([
+            self._header_to_binary(),
+            FIXED_STEP_START_STRUCT.pack(self.get_start() & _LONG_MASK, self.step & _INT_MASK),
+            self.__get_values().astype(np.dtype(FIXED_STEP_ITEM_DTYPE)).tostring()
+        ])
+
+    def get_positions_and_values(self):
+        import numpy as np
+        positions = np.arange(self.start, self.start + self.step * len(self.items), self.step, dtype=np.int64)
+        return positions, self.__get_values()
+
+    def next_chunk(self):
+        step = super(FixedStep, self).next_chunk()
+        step.start = self.start + self.step * len(self.items)
+        step.values = None
+        return step
 
     def get_start(self):
         return self.start
@@ -146,12 +303,138 @@ class WigTrack(object):
         fs.write('\n')
 
 
+def read_steps(source_wig_file, tracks, chunk_size):
+    """
+    Parse WIG file and yield its steps one by one.
+    Steps longer than ``chunk_size`` items are yielded by chunks (see :py:meth:`Step.next_chunk`),
+    steps without items are skipped.
+
+    :param source_wig_file: path to WIG file, can be compressed
+    :type source_wig_file: str
+    :param tracks: list to which tracks of the file are appended while parsing
+    :type tracks: list[WigTrack]
+    :param chunk_size: maximum number of items in yielded step
+    :type chunk_size: int
+    :rtype: collections.Iterable[Step]
+    """
+    step = None
+    with opener(source_wig_file) as fs:
+        for line in fs:
+            line = line.strip()
+
+            if line and not line.startswith('#') and not line.startswith("browser"):
+                if line.startswith('track'):
+                    tracks.append(WigTrack(line))
+                elif line.startswith("variableStep"):
+                    if not tracks:
+                        tracks.append(WigTrack())
+                    if step is not None and step.items:
+                        yield step
+                    step = VariableStep(line, len(tracks) - 1)
+                elif line.startswith("fixedStep"):
+                    if not tracks:
+                        tracks.append(WigTrack())
+                    if step is not None and step.items:
+                        yield step
+                    step = FixedStep(line, len(tracks) - 1)
+                else:
+                    if step is None:
+                        raise GenestackException('Data line before step declaration: %s' % line)
+                    step.update(line)
+                    if len(step.items) >= chunk_size:
+                        yield step
+                        step = step.next_chunk()
+    if step is not None and step.items:
+        yield step
+
+
+def array_steps(contig, data, span=1, step=1, chunk_size=100000, track_number=0):
+    """
+    Yield steps of contig data given as numpy arrays, steps have at most ``chunk_size`` items.
+
+    :param contig: contig name
+    :type contig: str
+    :param data: array of values, that is converted to fixed step starting from the first base of contig,
+                 or tuple of arrays (positions, values) with 1-based positions in ascending order,
+                 that is converted to variable step
+    :type data: numpy.ndarray | (numpy.ndarray, numpy.ndarray)
+    :param span: number of bases covered by each value
+    :type span: int
+    :param step: distance between values of fixed step
+    :type step: int
+    :param chunk_size: maximum number of items in yielded step
+    :type chunk_size: int
+    :param track_number: track number, starting from 0
+    :type track_number: int
+    :rtype: collections.Iterable[Step]
+    """
+    import numpy as np
+    if isinstance(data, tuple):
+        positions, values = data
+        positions = np.asarray(positions, dtype=np.int64).ravel() - 1
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(positions) != len(values):
+            raise GenestackException('Positions and values of contig "%s" have different lengths: %s and %s' % (
+                contig, len(positions), len(values)))
+        current = VariableStep('variableStep chrom=%s span=%s' % (contig, span), track_number)
+    else:
+        positions = None
+        values = np.asarray(data, dtype=np.float64).ravel()
+        current = FixedStep('fixedStep chrom=%s start=1 step=%s span=%s' % (contig, step, span), track_number)
+
+    for chunk_start in xrange(0, len(values), chunk_size):
+        if chunk_start:
+            current = current.next_chunk()
+        current.values = values[chunk_start:chunk_start + chunk_size]
+        if positions is None:
+            current.items = current.values
+        else:
+            current.positions = current.items = positions[chunk_start:chunk_start + chunk_size]
+        yield current
+
+
+class WigDataWriter(object):
+    """
+    Append-only writer of steps to the binary data file.
+    Keeps offset of the next step and index of written steps, memory usage does not depend on file size.
+    If ``zoom_builder`` is specified, written steps are also added to zoom summaries.
+    """
+    def __init__(self, path, zoom_builder=None):
+        self.path = path
+        self.offset = 0
+        self.index = {}  # contig -> list of [start, end, offset, size]
+        self.zoom_builder = zoom_builder
+        self.__file = open(path, 'wb')
+
+    def write_step(self, step):
+        """
+        Write step to file and add it to index. Steps without items are skipped.
+
+        :param step: step to write
+        :type step: Step
+        :return: None
+        """
+        if not len(step.items):
+            return
+        data = step.to_binary()
+        self.__file.write(data)
+        size = len(data)
+        self.index.setdefault(step.contig, []).append([step.get_start(), step.get_end(), self.offset, size])
+        self.offset += size
+        if self.zoom_builder is not None:
+            self.zoom_builder.add_step(step)
+
+    def close(self):
+        self.__file.close()
+
+
 class WIGIndexer:
     INDEX_LOCATION = 'genestack.location:index_tracks'
     WIG_INDEX_LOCATION = 'genestack.location:index_wig'
     CONTIG_CACHE_LOCATION = 'genestack.location:index_cache'
+    ZOOM_CACHE_LOCATION = 'genestack.location:index_zoom'
 
-    READ_LIMIT = 10 * (2 ** 20)  # 10 mb
+    STEP_CHUNK_SIZE = 100000  # long steps are written by chunks of this number of items
 
     def __init__(self, wig, result_folder='result'):
         self.wig = wig
@@ -163,20 +446,20 @@ class WIGIndexer:
             os.makedirs(os.path.abspath(self.result_contig_cache_folder))
         self.result_wig_file = os.path.join(self.result_folder, 'wig.data')
         self.result_tracks_file = os.path.join(self.result_folder, 'tracks.txt')
+        self.result_zoom_folder = os.path.join(self.result_folder, 'zoom.cache')
+        self.writer = None
+        self.index = {}
 
     def dump_steps(self, steps):
-        if not steps:
-            return
-        steps.sort(key=lambda x: x.contig)
-        dd = DumpData()
-        for step in steps:
-            offset = dd.size
-            step.add_dump_data(dd)
-            size = dd.size - offset
-            self.index.setdefault(step.contig, []).append([step.get_start(), step.get_end(), offset, size])
+        """
+        Write steps to the data file.
 
-        with open(self.result_wig_file, 'wb+') as fs:
-            dd.dump_to_file(fs)
+        :param steps: list of steps
+        :type steps: list[Step]
+        :return: None
+        """
+        for step in steps:
+            self.writer.write_step(step)
 
     def final_dump(self, tracks):
         with open(self.result_tracks_file, 'w') as fs:
@@ -184,51 +467,75 @@ class WIGIndexer:
                 track.add_dump_data(fs)
 
         for contig, indices in self.index.iteritems():
-            dd = DumpData()
             indices.sort(key=lambda x: x[0])
-            for start, end, offset, size in indices:
-                dd.put_long(start)
-                dd.put_long(end)
-                dd.put_long(offset)
-                dd.put_int(size)
             path = os.path.join(self.result_contig_cache_folder, contig)
             with open(path, 'wb') as fs:
-                dd.dump_to_file(fs)
+                for start, end, offset, size in indices:
+                    fs.write(INDEX_ITEM_STRUCT.pack(start & _LONG_MASK, end & _LONG_MASK, offset, size))
 
     def create_index(self, source_wig_file):
-        self.index = {}
+        """
+        Parse WIG file and write binary data file, contig index files and tracks file.
+        Each step is written as soon as it is read, steps longer than :py:attr:`STEP_CHUNK_SIZE`
+        items are written by chunks, so memory usage does not depend on the file size.
+        Zoom summaries (see :py:mod:`~genestack.bio.wig.wig_zoom`) are computed in the same pass.
+
+        :param source_wig_file: path to WIG file, can be compressed
+        :type source_wig_file: str
+        :return: None
+        """
         tracks = []
-        steps = []
-
-        limit = self.READ_LIMIT
-
-        with opener(source_wig_file) as fs:
-            for line in fs:
-                line = line.strip()
-
-                if line and not line.startswith('#') and not line.startswith("browser"):
-                    limit -= len(line)
-                    if limit <= 0:
-                        self.dump_steps(steps[:-1])  # don`t dump last step
-                        steps = steps[-1:]
-                        limit = self.READ_LIMIT
-
-                    if line.startswith('track'):
-                        tracks.append(WigTrack(line))
-                    elif line.startswith("variableStep"):
-                        if not tracks:
-                            tracks.append(WigTrack())
-                        steps.append(VariableStep(line, len(tracks) - 1))
-                    elif line.startswith("fixedStep"):
-                        if not tracks:
-                            tracks.append(WigTrack())
-                        steps.append(FixedStep(line, len(tracks) - 1))
-                    else:
-                        steps[-1].update(line)
-
-        self.dump_steps(steps)
+        self.__write_index(read_steps(source_wig_file, tracks, self.STEP_CHUNK_SIZE), tracks)
+
+    def create_index_from_arrays(self, contigs_data, span=1, step=1, track_line=''):
+        """
+        Write the same outputs as :py:meth:`create_index` directly from numpy arrays of a single track,
+        without writing and parsing WIG text.
+
+        :param contigs_data: dict that maps contig name to array of values, written as fixed step
+                             starting from the first base of contig, or to tuple of arrays (positions, values)
+                             with 1-based positions in ascending order, written as variable step
+        :type contigs_data: dict[str, numpy.ndarray | (numpy.ndarray, numpy.ndarray)]
+        :param span: number of bases covered by each value
+        :type span: int
+        :param step: distance between values of arrays without positions
+        :type step: int
+        :param track_line: track definition line, written to tracks file
+        :type track_line: str
+        :return: None
+        """
+        def iter_steps():
+            for contig, data in sorted(contigs_data.iteritems()):
+                for contig_step in array_steps(contig, data, span=span, step=step, chunk_size=self.STEP_CHUNK_SIZE):
+                    yield contig_step
+
+        self.__write_index(iter_steps(), [WigTrack(track_line)])
+
+    def __write_index(self, steps, tracks):
+        """
+        Write steps to data file, then write index files and put them to the WIG file.
+
+        :param steps: steps to write, iterated once
+        :type steps: collections.Iterable[Step]
+        :param tracks: tracks of the file, can be filled while steps are iterated
+        :type tracks: list[WigTrack]
+        :return: None
+        """
+        # avoid crash then using pypy
+        from genestack.bio.wig.wig_zoom import WigZoomBuilder
+        zoom_builder = WigZoomBuilder(self.result_zoom_folder)
+        self.writer = WigDataWriter(self.result_wig_file, zoom_builder=zoom_builder)
+        self.index = self.writer.index
+
+        try:
+            for step in steps:
+                self.writer.write_step(step)
+        finally:
+            self.writer.close()
         self.final_dump(tracks)
+        zoom_builder.write()
 
         self.wig.PUT(self.INDEX_LOCATION, StorageUnit(self.result_tracks_file))
         self.wig.PUT(self.WIG_INDEX_LOCATION, StorageUnit(self.result_wig_file))
         self.wig.PUT(self.CONTIG_CACHE_LOCATION, StorageUnit(self.result_contig_cache_folder))
+        self.wig.PUT(self.ZOOM_CACHE_LOCATION, StorageUnit(self.result_zoom_folder))
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-resolution summaries (zoom levels) of WIG tracks, similar to bigWig zoom levels.
+
+For every bin of each zoom level following values are stored:
+  - ``count``: number of bases covered by data
+  - ``min``, ``max``: minimal and maximal value
+  - ``sum``, ``sum_squares``: sum of values and sum of squared values, each value is taken once per covered base
+
+Zoom files are stored as ``<bin size>/<track number>.<contig>`` in the zoom folder,
+each file is a sequence of big-endian records (see :py:data:`ZOOM_RECORD_DTYPE`) for non-empty bins sorted by start.
+"""
+
+import os
+
+import numpy as np
+
+from genestack.genestack_exceptions import GenestackException
+
+ZOOM_LEVELS = (1000, 10000, 100000)
+
+ZOOM_RECORD_DTYPE = np.dtype([
+    ('start', '>u8'),
+    ('end', '>u8'),
+    ('count', '>u8'),
+    ('min', '>f4'),
+    ('max', '>f4'),
+    ('sum', '>f8'),
+    ('sum_squares', '>f8'),
+])
+
+
+class _LevelSummary(object):
+    """
+    Summary of single contig of single track for single zoom level, bins are stored in growing arrays.
+    """
+    def __init__(self, bin_size):
+        self.bin_size = bin_size
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0, dtype=np.float64)
+        self.sum_squares = np.zeros(0, dtype=np.float64)
+        self.min = np.zeros(0, dtype=np.float64)
+        self.max = np.zeros(0, dtype=np.float64)
+
+    def __ensure_size(self, size):
+        current = len(self.count)
+        if size <= current:
+            return
+        size = max(size, current * 2)
+        extra = size - current
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.sum = np.concatenate([self.sum, np.zeros(extra)])
+        self.sum_squares = np.concatenate([self.sum_squares, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+
+    def add(self, starts, ends, values):
+        """
+        Add values that cover intervals [start, end).
+
+        :param starts: interval starts
+        :type starts: numpy.ndarray
+        :param ends: interval ends
+        :type ends: numpy.ndarray
+        :param values: values
+        :type values: numpy.ndarray
+        """
+        first_bins = starts // self.bin_size
+        last_bins = (ends - 1) // self.bin_size
+
+        # intervals crossing bin boundaries are split between bins
+        crossing = np.nonzero(first_bins != last_bins)[0]
+        if len(crossing):
+            split_starts = []
+            split_ends = []
+            split_values = []
+            for i in crossing:
+                for bin_index in xrange(first_bins[i], last_bins[i] + 1):
+                    split_starts.append(max(starts[i], bin_index * self.bin_size))
+                    split_ends.append(min(ends[i], (bin_index + 1) * self.bin_size))
+                    split_values.append(values[i])
+            inside = first_bins == last_bins
+            starts = np.concatenate([starts[inside], np.array(split_starts, dtype=np.int64)])
+            ends = np.concatenate([ends[inside], np.array(split_ends, dtype=np.int64)])
+            values = np.concatenate([values[inside], np.array(split_values, dtype=np.float64)])
+            first_bins = starts // self.bin_size
+
+        if not len(first_bins):
+            return
+        self.__ensure_size(int(first_bins.max()) + 1)
+        bases = ends - starts
+        np.add.at(self.count, first_bins, bases)
+        np.add.at(self.sum, first_bins, values * bases)
+        np.add.at(self.sum_squares, first_bins, values * values * bases)
+        np.minimum.at(self.min, first_bins, values)
+        np.maximum.at(self.max, first_bins, values)
+
+    def to_records(self):
+        bins = np.nonzero(self.count)[0]
+        records = np.zeros(len(bins), dtype=ZOOM_RECORD_DTYPE)
+        records['start'] = bins * self.bin_size
+        records['end'] = (bins + 1) * self.bin_size
+        records['count'] = self.count[bins]
+        records['min'] = self.min[bins]
+        records['max'] = self.max[bins]
+        records['sum'] = self.sum[bins]
+        records['sum_squares'] = self.sum_squares[bins]
+        return records
+
+    def load(self, path):
+        """
+        Add bins written to the zoom file before.
+        """
+        records = np.fromfile(path, dtype=ZOOM_RECORD_DTYPE)
+        if not len(records):
+            return
+        bins = (records['start'] // self.bin_size).astype(np.int64)
+        self.__ensure_size(int(bins.max()) + 1)
+        self.count[bins] = records['count']
+        self.min[bins] = records['min']
+        self.max[bins] = records['max']
+        self.sum[bins] = records['sum']
+        self.sum_squares[bins] = records['sum_squares']
+
+
+class WigZoomBuilder(object):
+    """
+    Collects zoom summaries of steps and writes them to the zoom folder.
+
+    Only summaries of the current track and contig are kept in memory, they are written
+    when steps of another contig start. If steps of the contig appear again later in the file,
+    its written summaries are read back and continued.
+    """
+    def __init__(self, zoom_folder, levels=ZOOM_LEVELS):
+        self.zoom_folder = zoom_folder
+        self.levels = levels
+        self.__current_key = None  # (track number, contig)
+        self.__summaries = None  # list of _LevelSummary of the current key
+        self.__written_keys = set()
+
+    def __get_path(self, bin_size, key):
+        return os.path.join(self.zoom_folder, str(bin_size), '%s.%s' % key)
+
+    def __create_folders(self):
+        for bin_size in self.levels:
+            folder = os.path.join(self.zoom_folder, str(bin_size))
+            if not os.path.exists(folder):
+                os.makedirs(os.path.abspath(folder))
+
+    def __write_current(self):
+        if self.__summaries is None:
+            return
+        self.__create_folders()
+        for summary in self.__summaries:
+            summary.to_records().tofile(self.__get_path(summary.bin_size, self.__current_key))
+        self.__written_keys.add(self.__current_key)
+        self.__current_key = None
+        self.__summaries = None
+
+    def __select(self, key):
+        if key == self.__current_key:
+            return
+        self.__write_current()
+        self.__current_key = key
+        self.__summaries = [_LevelSummary(x) for x in self.levels]
+        if key in self.__written_keys:
+            for summary in self.__summaries:
+                summary.load(self.__get_path(summary.bin_size, key))
+
+    def add_step(self, step):
+        """
+        Add values of the step.
+
+        :param step: WIG step
+        :type step: genestack.bio.wig.wig_indexer.Step
+        """
+        positions, values = step.get_positions_and_values()
+        if not len(positions):
+            return
+        starts = np.array(positions, dtype=np.int64)
+        ends = starts + step.span
+        values = np.array(values, dtype=np.float64)
+        # position 0 in the source file gives negative start
+        starts = np.maximum(starts, 0)
+        valid = ends > starts
+        starts, ends, values = starts[valid], ends[valid], values[valid]
+        self.__select((step.track_number, step.contig))
+        for summary in self.__summaries:
+            summary.add(starts, ends, values)
+
+    def write(self):
+        """
+        Write summaries of the last contig and create folders of zoom levels if there were no steps.
+        """
+        self.__write_current()
+        self.__create_folders()
+
+
+class WigZoomReader(object):
+    """
+    Reader of zoom folder created by :py:class:`~genestack.bio.WIGIndexer`.
+    """
+    def __init__(self, zoom_folder):
+        self.zoom_folder = zoom_folder
+        self.levels = sorted(int(x) for x in os.listdir(zoom_folder) if x.isdigit())
+        if not self.levels:
+            raise GenestackException('No zoom levels found in "%s"' % zoom_folder)
+
+    def select_level(self, resolution):
+        """
+        Return the largest bin size that is not greater than resolution,
+        or the smallest bin size if all of them are greater.
+
+        :param resolution: number of bases per requested data point
+        :type resolution: int
+        :rtype: int
+        """
+        suitable = [x for x in self.levels if x <= resolution]
+        return suitable[-1] if suitable else self.levels[0]
+
+    def query(self, track_number, contig, start, end, resolution):
+        """
+        Return summary records of the zoom level selected for resolution, that overlap the region.
+
+        :param track_number: track number, starting from 0
+        :type track_number: int
+        :param contig: normalized contig name
+        :type contig: str
+        :param start: region start, 0-based
+        :type start: int
+        :param end: region end, exclusive
+        :type end: int
+        :param resolution: number of bases per requested data point
+        :type resolution: int
+        :return: structured array with :py:data:`ZOOM_RECORD_DTYPE`
+        :rtype: numpy.ndarray
+        """
+        bin_size = self.select_level(resolution)
+        path = os.path.join(self.zoom_folder, str(bin_size), '%s.%s' % (track_number, contig))
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return np.zeros(0, dtype=ZOOM_RECORD_DTYPE)
+        records = np.memmap(path, dtype=ZOOM_RECORD_DTYPE, mode='r')
+        low = np.searchsorted(records['end'], start, side='right')
+        high = np.searchsorted(records['start'], end, side='left')
+        return np.array(records[low:high])
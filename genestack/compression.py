@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import bz2
+import gzip
 import os
-from subprocess import Popen, PIPE, check_call
+import zipfile
+import zlib
+from collections import deque
+from distutils.spawn import find_executable
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
 
 from genestack.genestack_exceptions import GenestackException
-from genestack.utils import get_unique_name, makedirs_p
+from genestack.utils import get_unique_name, makedirs_p, get_cpu_count
 
 
 UNCOMPRESSED = 'uncompressed'
@@ -15,6 +23,10 @@ ZIP = 'zip'
 AVAILABLE_COMPRESSIONS = (UNCOMPRESSED, BZIP2, GZIP, ZIP)
 ARCHIVE_EXTENSIONS = ['.gz', '.bgz', '.zip', '.bz2']
 
+DEFAULT_COMPRESSION_LEVELS = {GZIP: 6, BZIP2: 9}
+COMPRESSION_BLOCK_SIZE = 1024 * 1024  # size of uncompressed block that is compressed by one thread
+READ_SIZE = 256 * 1024
+
 
 def get_last_non_archive_extension(path):
     """
@@ -35,7 +47,7 @@ def get_last_non_archive_extension(path):
     return ext
 
 
-def _get_file_compression_unchecked(file_name):
+def _get_compression_by_extension(file_name):
     if file_name.endswith(('.gz', '.bgz')):
         # .bgz is our extension to gzip files created by TABIX,
         # This is valid gzip but we use a different extension to avoid clashes on backend.
@@ -48,9 +60,20 @@ def _get_file_compression_unchecked(file_name):
         return UNCOMPRESSED
 
 
+def _get_file_compression_unchecked(file_name):
+    """
+    Return compression detected by magic bytes of the file, see :py:func:`~genestack.sniffing.sniff_compression`.
+    If file does not exist or is empty, compression is chosen by extension.
+    """
+    # avoid circular imports
+    from genestack.sniffing import sniff_compression
+    return sniff_compression(file_name) or _get_compression_by_extension(file_name)
+
+
 def get_file_compression(file_name):
     """
     Return constant that represents compression of a file. The file must be present on disc.
+    Compression is detected by the first bytes of the file, file extension is used only for empty files.
 
     :py:attr:`ZIP` zip compression
     :py:attr:`BZIP2` bgzip2 compression
@@ -86,35 +109,299 @@ def get_compression(files):
     return compressions.pop()
 
 
-def _pipe(source_path, list_of_commands, output_path):
+def _check_level(compression, level):
+    if level is None:
+        return DEFAULT_COMPRESSION_LEVELS.get(compression)
+    if not 1 <= level <= 9:
+        raise GenestackException('Compression level should be from 1 to 9, got: %s' % level)
+    return level
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        for data in iter(partial(f.read, READ_SIZE), ''):
+            yield data
+
+
+def _read_process_output(args):
+    process = Popen(args, stdout=PIPE)
+    try:
+        for data in iter(partial(process.stdout.read, READ_SIZE), ''):
+            yield data
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code:
+        raise GenestackException('Command %s failed with exit code %s' % (' '.join(args), return_code))
+
+
+def _read_gzip(path):
+    # GzipFile reads all members of the file and checks their sizes and checksums
+    with gzip.GzipFile(path, 'rb') as f:
+        for data in iter(partial(f.read, READ_SIZE), ''):
+            yield data
+
+
+def _read_bzip2(path):
+    # BZ2File reads only the first stream, so all streams are decompressed here (pbzip2 writes many of them)
+    decompressor = bz2.BZ2Decompressor()
+    is_empty = True
+    for data in _read_file(path):
+        is_empty = False
+        while data:
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # previous stream has ended exactly at the end of the read block
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+    if is_empty:
+        return
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        # the last stream has ended
+        return
+    raise GenestackException('Compressed file ended before the end-of-stream marker was reached: %s' % path)
+
+
+class ZipReader(object):
     """
-    Pipes commandlines together. Works like:
-       `cat source_path > arg[0] [| args[1] | ...] > output_path`
-    :param source_path: path of source file, file must exist
-    :type source_path: str
-    :param list_of_commands: list of command arguments that should be piped
-    :type list_of_commands: list[str]
-    :param output_path: path for the output file
-    :type output_path: str
-    :return: None
+    Read-only file object that streams data of all members of ZIP archive one after another,
+    same as ``unzip -p`` does. Members are decompressed while reading, nothing is extracted to disk.
     """
-    with open(source_path) as source, open(output_path, 'wb') as output:
-        if len(list_of_commands) == 1:
-            process = Popen(list_of_commands[0], stdin=source, stdout=output)
-        else:
-            process = Popen(list_of_commands[0], stdout=PIPE, stdin=source)
-            for args in list_of_commands[1:-1]:
-                process = Popen(args, stdin=process.stdout, stdout=PIPE)
-            process = Popen(list_of_commands[-1], stdin=process.stdout, stdout=output)
-        process.communicate()
+
+    def __init__(self, path, mode='rb'):
+        """
+        :param path: path to ZIP archive
+        :type path: str
+        :param mode: ``'r'`` or ``'rb'``, archive is always read in binary mode
+        :type mode: str
+        """
+        if mode not in ('r', 'rb'):
+            raise GenestackException('Invalid mode for ZIP reader: %s' % repr(mode))
+        self.name = path
+        self.__archive = zipfile.ZipFile(path)
+        # directories do not have data
+        self.__members = deque(x for x in self.__archive.infolist() if not x.filename.endswith('/'))
+        self.__member = None
+        self.__next_member()
+
+    def __next_member(self):
+        if self.__member is not None:
+            self.__member.close()
+        self.__member = self.__archive.open(self.__members.popleft()) if self.__members else None
+
+    def read(self, size=-1):
+        """
+        Read at most ``size`` bytes, read until the end of the last member if ``size`` is negative.
+        """
+        chunks = []
+        while self.__member is not None and size:
+            data = self.__member.read(size)
+            if not data:
+                self.__next_member()
+                continue
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+    def readline(self):
+        """
+        Read line including line break, a line can continue in the next member.
+        """
+        chunks = []
+        while self.__member is not None:
+            line = self.__member.readline()
+            if line:
+                chunks.append(line)
+                if line[-1] == '\n':
+                    break
+            self.__next_member()
+        return ''.join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.__member is not None:
+            self.__member.close()
+            self.__member = None
+        self.__archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _read_zip(path):
+    with ZipReader(path) as f:
+        for data in iter(partial(f.read, READ_SIZE), ''):
+            yield data
+
+
+def _read_decompressed(path, compression):
+    """
+    Return generator of decompressed blocks of the file.
+    """
+    if compression == GZIP:
+        pigz = find_executable('pigz')
+        if pigz:
+            return _read_process_output([pigz, '-d', '-c', path])
+        return _read_gzip(path)
+    elif compression == BZIP2:
+        pbzip2 = find_executable('pbzip2')
+        if pbzip2:
+            return _read_process_output([pbzip2, '-d', '-c', path])
+        return _read_bzip2(path)
+    elif compression == ZIP:
+        return _read_zip(path)
+    return _read_file(path)
+
+
+def _join_blocks(blocks, size):
+    """
+    Join small blocks into blocks of at least ``size`` bytes, the last block can be shorter.
+    """
+    buf = []
+    buf_size = 0
+    for block in blocks:
+        buf.append(block)
+        buf_size += len(block)
+        if buf_size >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _write_to_process(args, blocks, output_file):
+    process = Popen(args, stdin=PIPE, stdout=output_file)
+    try:
+        for block in blocks:
+            process.stdin.write(block)
+        process.stdin.close()
+    except BaseException:
+        process.kill()
         process.wait()
+        raise
+    return_code = process.wait()
+    if return_code:
+        raise GenestackException('Command %s failed with exit code %s' % (' '.join(args), return_code))
+
+
+def _write_compressed(blocks, output_file, compressor):
+    for block in blocks:
+        output_file.write(compressor.compress(block))
+    output_file.write(compressor.flush())
+
+
+def _compress_gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
-def compress_file(source, from_compression, to_compression, working_dir, remove_source=True):
+def _write_gzip_members(blocks, output_file, level, threads):
+    """
+    Compress blocks of ``COMPRESSION_BLOCK_SIZE`` bytes by thread pool and write them as members of gzip file.
+    ``zlib`` releases GIL while compressing, so threads are run in parallel.
+    """
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        for block in _join_blocks(blocks, COMPRESSION_BLOCK_SIZE):
+            if len(pending) >= 2 * threads:
+                output_file.write(pending.popleft().get())
+            pending.append(pool.apply_async(_compress_gzip_member, (block, level)))
+        if not pending:
+            # empty input is written as a single empty member
+            pending.append(pool.apply_async(_compress_gzip_member, ('', level)))
+        while pending:
+            output_file.write(pending.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _write_gzip(blocks, output_file, level, threads):
+    pigz = find_executable('pigz')
+    if pigz:
+        _write_to_process([pigz, '-c', '-%d' % level, '-p', str(threads)], blocks, output_file)
+    elif threads > 1:
+        _write_gzip_members(blocks, output_file, level, threads)
+    else:
+        _write_compressed(blocks, output_file, zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+
+
+def recompress(source_path, output_path, from_compression, to_compression, level=None, threads=None):
+    """
+    Stream data of the file from one compression to another without intermediate files.
+    Unsupported compressions are treated as ``UNCOMPRESSED``.
+
+    ``GZIP`` output is compressed by ``pigz`` if it is available,
+    otherwise blocks are compressed in parallel by a thread pool and written as members of gzip file.
+    ``BZIP2`` output is a single bzip2 stream, because ``bz2.BZ2File`` reads only the first stream
+    of a file that is written by ``pbzip2``. ``pigz`` and ``pbzip2`` are used for decompression if available.
+    All members of ``ZIP`` archive are concatenated.
+
+    :param source_path: path to existing file
+    :type source_path: str
+    :param output_path: path to result file
+    :type output_path: str
+    :param from_compression: compression of existing file
+    :type from_compression: str
+    :param to_compression: compression of result file, ``ZIP`` is not supported
+    :type to_compression: str
+    :param level: compression level from 1 to 9,
+                  default is 6 for ``GZIP`` and 9 for ``BZIP2`` (same as for command line tools)
+    :type level: int
+    :param threads: number of compression threads, number of CPUs by default
+    :type threads: int
+    :return: None
+    """
+    if to_compression == ZIP:
+        raise GenestackException('Compression to ZIP is not supported')
+    level = _check_level(to_compression, level)
+    threads = threads or get_cpu_count()
+    blocks = _read_decompressed(source_path, from_compression)
+    try:
+        with open(output_path, 'wb') as output_file:
+            if to_compression == GZIP:
+                _write_gzip(blocks, output_file, level, threads)
+            elif to_compression == BZIP2:
+                _write_compressed(blocks, output_file, bz2.BZ2Compressor(level))
+            else:
+                for block in blocks:
+                    output_file.write(block)
+    except BaseException:
+        blocks.close()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+
+def compress_file(source, from_compression, to_compression, working_dir, remove_source=True, level=None):
     """
     Recompress file from one compression to another and remove existing file.
     Name for result file is chosen by changing file extension.
     If file with such name already exists, add unique prefix to file.
+    Data is streamed in process, see :py:func:`recompress`.
 
     If ``from_compression`` and ``to_compression`` are the same, then this function does nothing
     and simply returns ``source`` file.
@@ -131,55 +418,34 @@ def compress_file(source, from_compression, to_compression, working_dir, remove_
     :type working_dir: str
     :param remove_source: flag if source file should be removed. Default ``True``
     :type remove_source: bool
+    :param level: compression level from 1 to 9, default level of compression is used if not specified
+    :type level: int
     :return: compressed file path
     :rtype: str
     """
     if from_compression == to_compression:
         return source
-    args = []
-    current_source = source
-    intermediate_files = []
+    if to_compression == ZIP:
+        raise GenestackException('Compression to ZIP is not supported')
     output = os.path.join(working_dir, os.path.basename(source))
 
-    if from_compression == BZIP2:
-        args.append(['bzip2', '-d', '-c'])
-        output = os.path.splitext(output)[0]
-    elif from_compression == GZIP:
-        args.append(['gzip', '-d', '-c'])
+    # compression is detected by content, so extension is removed only if it matches compression
+    if from_compression != UNCOMPRESSED and _get_compression_by_extension(output) == from_compression:
         output = os.path.splitext(output)[0]
-    elif from_compression == ZIP:
-        output = get_unique_name(os.path.splitext(output)[0])
-        with open(output, 'wb') as output_file:
-            check_call(['unzip', '-p', current_source], stdout=output_file)
-        current_source = output
-        intermediate_files.append(current_source)
 
     if to_compression == BZIP2:
-        args.append(['bzip2'])
         output += '.bz2'
     elif to_compression == GZIP:
-        args.append(['gzip'])
         output += '.gz'
-    elif to_compression == ZIP:
-        raise GenestackException('Compression to ZIP is not supported')
-
-    if args:
-        # `args` is empty in case of ZIP -> UNCOMPRESSED (already uncompressed)
-        output = get_unique_name(output)
-        _pipe(current_source, args, output)
 
+    output = get_unique_name(output)
+    recompress(source, output, from_compression, to_compression, level=level)
     if remove_source:
-        intermediate_files.append(source)
-    # Never remove output file, even if it is a source or one of the intermediate files created
-    if output in intermediate_files:
-        intermediate_files.remove(output)
-
-    for name in intermediate_files:
-        os.remove(name)
+        os.remove(source)
     return output
 
 
-def gzip_file(path, dest_folder=None, remove_source=True):
+def gzip_file(path, dest_folder=None, remove_source=True, level=None):
     """
     Return path to gzipped file.
 
@@ -197,6 +463,8 @@ def gzip_file(path, dest_folder=None, remove_source=True):
     :type dest_folder: str
     :param remove_source: flag if source files should be removed
     :type remove_source: bool
+    :param level: gzip compression level from 1 to 9, default is 6
+    :type level: int
     :return: path to gzipped file
     """
     compression = get_file_compression(path)
@@ -208,7 +476,8 @@ def gzip_file(path, dest_folder=None, remove_source=True):
     else:
         dest_folder = os.path.dirname(path)
 
-    return os.path.relpath(compress_file(path, compression, GZIP, dest_folder, remove_source=remove_source))
+    return os.path.relpath(compress_file(path, compression, GZIP, dest_folder, remove_source=remove_source,
+                                         level=level))
 
 
 def decompress_file(path, dest_folder=None, remove_source=True):
@@ -8,7 +8,6 @@ import os
 import sys
 
 from genestack.genestack_exceptions import GenestackException
-from genestack.compression import ZIP, get_file_compression
 from genestack.frontend_object import GenestackObject, StorageUnit
 from genestack.metainfo import FileReference, StringValue
 from genestack.utils import to_list, opener, log_info, FormatPattern
@@ -26,7 +25,7 @@ def checked_filetype(filetype):
 
 def md5sum(filename_list):
     """
-    Count md5 for list of files or directories, unpack gzip archives before counting.
+    Count md5 for list of files or directories, unpack gzip, bzip2 and zip archives before counting.
     """
     md5 = hashlib.md5()
     for filename in filename_list:
@@ -41,14 +40,7 @@ def md5sum(filename_list):
 
 
 def _count_md5_for_file(md5, path):
-    compression = get_file_compression(path)
-    # opener does not support ZIP yet so count md5 for compressed file
-    if compression == ZIP:
-        _open = open
-    else:
-        _open = opener
-
-    with _open(path) as f:
+    with opener(path) as f:
         for chunk in iter(lambda: f.read(8192), b''):
             md5.update(chunk)
 
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import string
+from collections import deque
 from multiprocessing.dummy import Pool
 
 from genestack.genestack_exceptions import GenestackException
@@ -86,10 +87,20 @@ class Key(object):
 
 
 class Indexer(object):
-    def __init__(self, file_to_index):
+    def __init__(self, file_to_index, requests_in_flight=1):
+        """
+        :param file_to_index: file which index is filled
+        :param requests_in_flight: maximal number of index requests that are sent concurrently;
+                                   if it is greater than 1, records of different :py:meth:`index_records` calls
+                                   can be added to the index in any order
+        :type requests_in_flight: int
+        """
+        if requests_in_flight < 1:
+            raise GenestackException('Number of index requests in flight should be positive')
         self.__file = file_to_index
-        self.__indexing_pool = Pool(1)
-        self.__indexing_recent_response = None
+        self.__requests_in_flight = requests_in_flight
+        self.__indexing_pool = Pool(requests_in_flight)
+        self.__indexing_responses = deque()
         self.__inside_context = False
 
     def __enter__(self):
@@ -98,8 +109,9 @@ class Indexer(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.__inside_context = False
-        if exc_type is None and self.__indexing_recent_response is not None:
-            self.__indexing_recent_response.get()
+        if exc_type is None:
+            while self.__indexing_responses:
+                self.__indexing_responses.popleft().get()
 
     def index_records(self, records_list):
         """
@@ -107,6 +119,7 @@ class Indexer(object):
         Parameter records_list is a list of dicts. Every dict uses strings as keys.
         Note that this method is NOT thread-safe, so if you plan to index records from
         different threads you must synchronise manually.
+        Method blocks while the number of unfinished requests is equal to ``requests_in_flight``.
 
         :param records_list: list of dicts with str keys
         :type records_list: list
@@ -126,9 +139,11 @@ class Indexer(object):
                 raise
         new_records = [_make_record(record) for record in records_list]
 
-        if self.__indexing_recent_response is not None:
-            self.__indexing_recent_response.get()
-        self.__indexing_recent_response = self.__indexing_pool.apply_async(invoke, kwds={"values": new_records})
+        while len(self.__indexing_responses) >= self.__requests_in_flight:
+            self.__indexing_responses.popleft().get()
+        response = self.__indexing_pool.apply_async(invoke, kwds={"values": new_records})
+        self.__indexing_responses.append(response)
+        return response
 
 _ALLOWED_BYTES = set(bytearray(string.ascii_letters + string.digits))
 
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Detection of compression and format of files by their content.
+
+Only the beginning of a file is read: magic bytes for compression and the first block
+of decompressed data (see :py:data:`BLOCK_SIZE`) for format, files are never decompressed to disk.
+"""
+
+import bz2
+import os
+import re
+import struct
+import zlib
+
+from genestack.compression import GZIP, BZIP2, ZIP, UNCOMPRESSED, ZipReader
+
+BLOCK_SIZE = 64 * 1024  # size of the decompressed block that is used to detect format
+
+_READ_SIZE = 16 * 1024
+
+_GZIP_MAGIC = '\x1f\x8b'
+_BZIP2_MAGIC = 'BZh'
+_ZIP_MAGICS = ('PK\x03\x04', 'PK\x05\x06')  # local file header, end of central directory of empty archive
+
+# gzip header with extra field, see https://samtools.github.io/hts-specs/SAMv1.pdf, section 4.1
+_GZIP_HEADER_STRUCT = struct.Struct('<BBBBIBBH')  # ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN
+_GZIP_FLAG_EXTRA = 4
+_BGZF_SUBFIELD = 'BC'
+
+# formats, annotation formats have the same values as constants in genestack.bio.annotation_utils
+FASTA = 'FASTA'
+FASTQ = 'FASTQ'
+VCF = 'VCF'
+GFF2 = 'GFF2'
+GFF3 = 'GFF3'
+GTF = 'GTF'
+BED = 'BED'
+WIG = 'WIG'
+
+_GFF_VERSION_PATTERN = re.compile(r'##gff-version\s+(\S+)')
+_GTF_ATTRIBUTE_PATTERN = re.compile(r'\s*[^\s"=;]+\s+"')
+_GFF3_ATTRIBUTE_PATTERN = re.compile(r'\s*[^\s"=;]+=')
+_WIG_DECLARATIONS = ('variableStep', 'fixedStep')
+_STRANDS = ('+', '-', '.', '?')
+
+
+def _read_start(path, size):
+    """
+    Return first bytes of regular non-empty file, or ``None``.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(size)
+    except IOError:
+        return None
+    return data or None
+
+
+def sniff_compression(path):
+    """
+    Return compression of the file detected by magic bytes, BGZF files are reported as ``GZIP``.
+    Return ``None`` if file does not exist, is not a regular file or is empty.
+
+    :param path: path to file
+    :type path: str
+    :return: compression constant from :py:mod:`genestack.compression` or ``None``
+    :rtype: str
+    """
+    start = _read_start(path, 4)
+    if start is None:
+        return None
+    if start.startswith(_GZIP_MAGIC):
+        return GZIP
+    if start.startswith(_BZIP2_MAGIC):
+        return BZIP2
+    if start.startswith(_ZIP_MAGICS):
+        return ZIP
+    return UNCOMPRESSED
+
+
+def is_bgzf(path):
+    """
+    Return ``True`` if file is compressed by BGZF (blocked gzip used by ``bgzip`` and ``tabix``).
+
+    :param path: path to file
+    :type path: str
+    :rtype: bool
+    """
+    start = _read_start(path, _GZIP_HEADER_STRUCT.size + 4)
+    if start is None or len(start) < _GZIP_HEADER_STRUCT.size + 4 or not start.startswith(_GZIP_MAGIC):
+        return False
+    flags = _GZIP_HEADER_STRUCT.unpack_from(start)[3]
+    return bool(flags & _GZIP_FLAG_EXTRA) and start[_GZIP_HEADER_STRUCT.size:][:2] == _BGZF_SUBFIELD
+
+
+def _read_gzip_head(f, size):
+    chunks = []
+    received = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = f.read(_READ_SIZE)
+    while data and received < size:
+        chunk = decompressor.decompress(data, size - received)
+        chunks.append(chunk)
+        received += len(chunk)
+        if decompressor.unconsumed_tail:
+            data = decompressor.unconsumed_tail
+        elif decompressor.unused_data:
+            # the next gzip member, BGZF file consists of many members
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            data = f.read(_READ_SIZE)
+    return ''.join(chunks)
+
+
+def _read_bzip2_head(f, size):
+    chunks = []
+    received = 0
+    decompressor = bz2.BZ2Decompressor()
+    data = f.read(_READ_SIZE)
+    while data and received < size:
+        try:
+            chunk = decompressor.decompress(data)
+        except EOFError:
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+        data = f.read(_READ_SIZE)
+    return ''.join(chunks)[:size]
+
+
+def read_head(path, size=BLOCK_SIZE):
+    """
+    Return first decompressed bytes of the file.
+    Compression is detected by :py:func:`sniff_compression`, members of zip archive are read one after another.
+
+    :param path: path to file
+    :type path: str
+    :param size: maximal number of bytes to return
+    :type size: int
+    :return: first bytes of decompressed data, can be shorter than ``size``
+    :rtype: str
+    """
+    compression = sniff_compression(path)
+    if compression is None:
+        return ''
+    if compression == ZIP:
+        with ZipReader(path) as f:
+            return f.read(size)
+    with open(path, 'rb') as f:
+        if compression == GZIP:
+            return _read_gzip_head(f, size)
+        if compression == BZIP2:
+            return _read_bzip2_head(f, size)
+        return f.read(size)
+
+
+def _is_int(value):
+    return value.isdigit() or (value[:1] == '-' and value[1:].isdigit())
+
+
+def _sniff_gff_line(columns):
+    if len(columns) < 8 or not (_is_int(columns[3]) and _is_int(columns[4])) or columns[6] not in _STRANDS:
+        return None
+    attributes = columns[8] if len(columns) > 8 else ''
+    if _GTF_ATTRIBUTE_PATTERN.match(attributes):
+        return GTF
+    if _GFF3_ATTRIBUTE_PATTERN.match(attributes):
+        return GFF3
+    return GFF2
+
+
+def sniff_format(path):
+    """
+    Return format of the file detected by the first decompressed block.
+    Detected formats are :py:data:`FASTA`, :py:data:`FASTQ`, :py:data:`VCF`, :py:data:`GFF2`,
+    :py:data:`GFF3`, :py:data:`GTF`, :py:data:`BED` and :py:data:`WIG`.
+
+    :param path: path to file
+    :type path: str
+    :return: format constant or ``None`` if format is not recognized
+    :rtype: str
+    """
+    head = read_head(path)
+    lines = head.splitlines()
+    if len(head) == BLOCK_SIZE and lines:
+        # the last line can be truncated
+        lines.pop()
+    lines = [x for x in lines if x.strip()]
+
+    for index, line in enumerate(lines):
+        if line.startswith('##fileformat=VCF'):
+            return VCF
+        match = _GFF_VERSION_PATTERN.match(line)
+        if match:
+            return GFF3 if match.group(1).startswith('3') else _sniff_gff_lines(lines[index + 1:]) or GFF2
+        if line[0] == '#':
+            continue
+        if line[0] == '>':
+            return FASTA
+        if line[0] == '@':
+            if len(lines) > index + 2 and lines[index + 2].startswith('+'):
+                return FASTQ
+            return None
+        if line.startswith(_WIG_DECLARATIONS) or (line.startswith('track') and 'wiggle_0' in line):
+            return WIG
+        if line.startswith(('track', 'browser')):
+            continue
+        columns = line.split('\t')
+        gff_format = _sniff_gff_line(columns)
+        if gff_format is not None:
+            return gff_format
+        if len(columns) < 3:
+            columns = line.split()
+        if len(columns) >= 3 and _is_int(columns[1]) and _is_int(columns[2]):
+            return BED
+        return None
+    return None
+
+
+def _sniff_gff_lines(lines):
+    for line in lines:
+        if not line.startswith('#'):
+            return _sniff_gff_line(line.split('\t'))
+    return None
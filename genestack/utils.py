@@ -9,7 +9,9 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime, timedelta, tzinfo
@@ -88,10 +90,16 @@ def opener(filename, mode='r'):
     """
     Context manager for opening regular and compressed files.
     ``gzip`` and ``bzip2`` compression are supported.
+    ``zip`` archives can be read, data of all members is read one after another
+    (see :py:class:`~genestack.compression.ZipReader`).
     Always opens files in binary mode.
 
-    Looks like best way to check if file is gzipped is to check extension:
-    http://stackoverflow.com/a/3703300/1310066
+    Compression of existing file is detected by its first bytes,
+    compression of created file is chosen by its extension.
+
+    Files with ``.bgz`` extension are read and written as BGZF by
+    :py:class:`~genestack.bgzf.BgzfReader` and :py:class:`~genestack.bgzf.BgzfWriter`,
+    their ``tell`` and ``seek`` use virtual offsets.
 
     :param filename: name of file
     :type filename: str
@@ -100,19 +108,32 @@ def opener(filename, mode='r'):
     """
     # avoid circular imports
     # noinspection PyProtectedMember
-    from genestack.compression import _get_file_compression_unchecked, GZIP, BZIP2, UNCOMPRESSED
+    from genestack.compression import (_get_file_compression_unchecked, _get_compression_by_extension,
+                                       ZipReader, GZIP, BZIP2, ZIP, UNCOMPRESSED)
+    from genestack.bgzf import BgzfReader, BgzfWriter, BGZF_EXTENSION
+    from genestack.sniffing import is_bgzf
 
     if mode not in ['r', 'w']:
         raise GenestackException('Invalid mode: %s' % repr(mode))
-    mode = '%sb' % mode
 
-    compression = _get_file_compression_unchecked(filename)
+    # existing file is opened according to its content, new file is compressed according to its extension
+    if mode == 'r':
+        compression = _get_file_compression_unchecked(filename)
+        use_bgzf = compression == GZIP and filename.endswith(BGZF_EXTENSION) and is_bgzf(filename)
+        bgzf_class = BgzfReader
+    else:
+        compression = _get_compression_by_extension(filename)
+        use_bgzf = filename.endswith(BGZF_EXTENSION)
+        bgzf_class = BgzfWriter
+    mode = '%sb' % mode
 
     compression_map = {
-        GZIP: gzip.open,
+        GZIP: bgzf_class if use_bgzf else gzip.open,
         BZIP2: bz2.BZ2File,
         UNCOMPRESSED: open,
     }
+    if mode == 'rb':
+        compression_map[ZIP] = ZipReader
 
     _open = compression_map.get(compression)
     if _open is None:
@@ -372,6 +393,59 @@ class DumpData(object):
         fs.write(self.to_binary())
 
 
+class LRUCache(object):
+    """
+    Thread-safe mapping with limited number of items.
+    When the limit is exceeded the least recently used items are evicted.
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise GenestackException('Cache size should be positive integer, got: %s' % max_size)
+        self.max_size = max_size
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return value for the key and mark it as recently used.
+
+        :param key: hashable key
+        :param default: value returned if key is not present
+        :return: cached value or default
+        """
+        with self.__lock:
+            try:
+                value = self.__items.pop(key)
+            except KeyError:
+                return default
+            self.__items[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        Put value to the cache, evict the least recently used items if cache is full.
+
+        :param key: hashable key
+        :param value: value to store
+        :return: None
+        """
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = value
+            while len(self.__items) > self.max_size:
+                self.__items.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+
 UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 
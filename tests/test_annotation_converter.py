@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of :py:mod:`genestack.bio.annotation_converter`.
+
+Results of the in-process conversion are compared with ``gffread`` on Ensembl-like GFF3
+and GENCODE-like GTF samples, these tests are skipped if ``gffread`` is not found in ``PATH``.
+"""
+
+import os
+import re
+import subprocess
+from distutils.spawn import find_executable
+
+import pytest
+
+from genestack.bio.annotation_converter import (convert_gff3_to_gtf_file, convert_gtf_to_gff3_file,
+                                                UnsupportedAnnotationLayoutException)
+from genestack.bio.reference_genome.annotation_parser import parse_attributes
+
+GFFREAD = find_executable('gffread')
+
+requires_gffread = pytest.mark.skipif(GFFREAD is None, reason='gffread is not found')
+
+# gene -> transcripts -> exons/CDS/UTRs with Ensembl prefixes, exon shared by two transcripts
+# and escaped attribute value
+ENSEMBL_GFF3 = '''##gff-version 3
+1\tensembl_havana\tgene\t1000\t5000\t.\t+\t.\tID=gene:G1;Name=ABC%2C1;biotype=protein_coding
+1\tensembl_havana\tmRNA\t1000\t5000\t.\t+\t.\tID=transcript:T1;Parent=gene:G1;Name=ABC-201
+1\tensembl_havana\tmRNA\t1000\t4000\t.\t+\t.\tID=transcript:T2;Parent=gene:G1;Name=ABC-202
+1\tensembl_havana\tfive_prime_UTR\t1000\t1099\t.\t+\t.\tParent=transcript:T1
+1\tensembl_havana\texon\t1000\t1500\t.\t+\t.\tParent=transcript:T1,transcript:T2;Name=E1
+1\tensembl_havana\tCDS\t1100\t1500\t.\t+\t0\tID=CDS:P1;Parent=transcript:T1
+1\tensembl_havana\texon\t3000\t5000\t.\t+\t.\tParent=transcript:T1
+1\tensembl_havana\tCDS\t3000\t4500\t.\t+\t2\tID=CDS:P1;Parent=transcript:T1
+1\tensembl_havana\tthree_prime_UTR\t4501\t5000\t.\t+\t.\tParent=transcript:T1
+1\tensembl_havana\texon\t3000\t4000\t.\t+\t.\tParent=transcript:T2
+2\tensembl\tgene\t10\t900\t.\t-\t.\tID=gene:G2;Name=XYZ
+2\tensembl\tmRNA\t10\t900\t.\t-\t.\tID=transcript:T3;Parent=gene:G2
+2\tensembl\texon\t500\t900\t.\t-\t.\tParent=transcript:T3
+2\tensembl\texon\t10\t200\t.\t-\t.\tParent=transcript:T3
+'''
+
+GENCODE_GTF = '''##description: GENCODE-like sample
+chr1\tHAVANA\tgene\t11869\t14409\t.\t+\t.\tgene_id "ENSG01.5"; gene_type "protein_coding"; gene_name "DDX11L1";
+chr1\tHAVANA\ttranscript\t11869\t14409\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1";
+chr1\tHAVANA\texon\t11869\t12227\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1"; exon_number 1;
+chr1\tHAVANA\tCDS\t12010\t12227\t.\t+\t0\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1";
+chr1\tHAVANA\tstart_codon\t12010\t12012\t.\t+\t0\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1";
+chr1\tHAVANA\texon\t12613\t12721\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1"; exon_number 2;
+chr1\tHAVANA\tCDS\t12613\t12700\t.\t+\t1\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1";
+chr1\tHAVANA\tUTR\t12701\t12721\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1";
+chr1\tHAVANA\texon\t13221\t14409\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST01.1"; gene_name "DDX11L1"; exon_number 3;
+chr1\tHAVANA\ttranscript\t12010\t13670\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST02.1"; gene_name "DDX11L1";
+chr1\tHAVANA\texon\t12010\t12057\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST02.1"; gene_name "DDX11L1";
+chr1\tHAVANA\texon\t13403\t13670\t.\t+\t.\tgene_id "ENSG01.5"; transcript_id "ENST02.1"; gene_name "DDX11L1";
+chrX\tENSEMBL\ttranscript\t100\t900\t.\t-\t.\tgene_id "ENSG02.1"; transcript_id "ENST03.2"; gene_name "WASH7P";
+chrX\tENSEMBL\texon\t600\t900\t.\t-\t.\tgene_id "ENSG02.1"; transcript_id "ENST03.2"; gene_name "WASH7P";
+chrX\tENSEMBL\texon\t100\t300\t.\t-\t.\tgene_id "ENSG02.1"; transcript_id "ENST03.2"; gene_name "WASH7P";
+'''
+
+
+def _write(folder, name, text):
+    path = os.path.join(str(folder), name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def _read_records(path):
+    """
+    Return set of exon and CDS lines of GTF file, or exon, CDS and mRNA lines of GFF3 file as comparable tuples:
+    contig, type, start, end, strand and identifiers of transcript and gene (or of parent transcripts).
+    """
+    records = set()
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            parts = line.rstrip('\n').split('\t')
+            feature_type = 'mRNA' if parts[2] == 'transcript' else parts[2]
+            if feature_type not in ('exon', 'CDS', 'mRNA'):
+                continue
+            attributes, is_gtf = parse_attributes(parts[8])
+            if is_gtf and feature_type == 'mRNA':
+                # transcript lines are written to GTF only by some versions of gffread
+                continue
+            if is_gtf:
+                ids = attributes['transcript_id'][0], attributes['gene_id'][0]
+            elif feature_type == 'mRNA':
+                ids = attributes['ID'][0], attributes['geneID'][0]
+            else:
+                ids = tuple(sorted(attributes['Parent']))
+            records.add((parts[0], feature_type, int(parts[3]), int(parts[4]), parts[6], ids))
+    return records
+
+
+def _run_gffread(source_path, output_path, to_gtf):
+    if to_gtf:
+        # gene: and transcript: prefixes are removed before gffread, as in annotation_utils
+        with open(source_path) as f:
+            text = re.sub(r'([=,])(gene|transcript):', r'\1', f.read())
+        source_path = _write(os.path.dirname(output_path), 'normalized.gff3', text)
+        subprocess.check_call([GFFREAD, '-E', source_path, '-T', '-o', output_path])
+    else:
+        subprocess.check_call([GFFREAD, '-E', source_path, '-o', output_path])
+
+
+@requires_gffread
+def test_gff3_to_gtf_same_as_gffread(tmpdir):
+    source = _write(tmpdir, 'ensembl.gff3', ENSEMBL_GFF3)
+    converted = str(tmpdir.join('converted.gtf'))
+    expected = str(tmpdir.join('gffread.gtf'))
+    convert_gff3_to_gtf_file(source, converted)
+    _run_gffread(source, expected, to_gtf=True)
+    assert _read_records(converted) == _read_records(expected)
+
+
+@requires_gffread
+def test_gtf_to_gff3_same_as_gffread(tmpdir):
+    source = _write(tmpdir, 'gencode.gtf', GENCODE_GTF)
+    converted = str(tmpdir.join('converted.gff3'))
+    expected = str(tmpdir.join('gffread.gff3'))
+    convert_gtf_to_gff3_file(source, converted)
+    _run_gffread(source, expected, to_gtf=False)
+    assert _read_records(converted) == _read_records(expected)
+
+
+def test_gff3_to_gtf_groups_transcripts(tmpdir):
+    source = _write(tmpdir, 'ensembl.gff3', ENSEMBL_GFF3)
+    converted = str(tmpdir.join('converted.gtf'))
+    convert_gff3_to_gtf_file(source, converted)
+    records = _read_records(converted)
+    # prefixes are removed, exon with two parents belongs to both transcripts
+    assert ('1', 'exon', 1000, 1500, '+', ('T1', 'G1')) in records
+    assert ('1', 'exon', 1000, 1500, '+', ('T2', 'G1')) in records
+    assert ('1', 'CDS', 3000, 4500, '+', ('T1', 'G1')) in records
+    assert ('2', 'exon', 10, 200, '-', ('T3', 'G2')) in records
+    assert len([x for x in records if x[1] == 'exon']) == 6
+    # escaped value of the gene name is unquoted
+    with open(converted) as f:
+        assert 'gene_name "ABC,1";' in f.read()
+
+
+def test_gtf_to_gff3_groups_transcripts(tmpdir):
+    source = _write(tmpdir, 'gencode.gtf', GENCODE_GTF)
+    converted = str(tmpdir.join('converted.gff3'))
+    convert_gtf_to_gff3_file(source, converted)
+    records = _read_records(converted)
+    assert ('chr1', 'mRNA', 11869, 14409, '+', ('ENST01.1', 'ENSG01.5')) in records
+    assert ('chr1', 'mRNA', 12010, 13670, '+', ('ENST02.1', 'ENSG01.5')) in records
+    assert ('chrX', 'mRNA', 100, 900, '-', ('ENST03.2', 'ENSG02.1')) in records
+    assert ('chr1', 'CDS', 12613, 12700, '+', ('ENST01.1',)) in records
+    assert len([x for x in records if x[1] == 'exon']) == 7
+
+
+def test_ungrouped_contig_is_not_supported(tmpdir):
+    lines = GENCODE_GTF.splitlines(True)
+    # line of transcript on chr1 is repeated after lines of chrX
+    text = ''.join(lines[:-1]) + lines[3] + lines[-1]
+    source = _write(tmpdir, 'ungrouped.gtf', text)
+    with pytest.raises(UnsupportedAnnotationLayoutException):
+        convert_gtf_to_gff3_file(source, str(tmpdir.join('converted.gff3')))